@@ -0,0 +1,276 @@
+import argparse
+import json
+import mmap
+import sys
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from logger import iter_log_turns, turn_shape
+from parser import ResponseParser
+
+# Categorias de error (a partir de los mensajes de ResponseParser y de los turnos [ERROR])
+ERROR_CATEGORIES = (
+    "ok",
+    "json_decode",
+    "no_object",
+    "missing_keys",
+    "evento_invalido",
+    "opciones_invalidas",
+    "backend",
+    "otro",
+)
+_CATEGORY_CODE = {name: i for i, name in enumerate(ERROR_CATEGORIES)}
+
+
+def classify_error(error: str, raw: str, parse_ok: bool, format_ok: bool) -> int:
+    if format_ok:
+        return _CATEGORY_CODE["ok"]
+    if raw.startswith("[ERROR]"):
+        return _CATEGORY_CODE["backend"]
+    if not parse_ok:
+        return _CATEGORY_CODE["json_decode"]
+    if error.startswith("root no es"):
+        return _CATEGORY_CODE["no_object"]
+    if error.startswith("JSON parseado") or error.startswith("falta 'eventos'"):
+        return _CATEGORY_CODE["missing_keys"]
+    if error.startswith("eventos[") or error.startswith("'eventos'"):
+        return _CATEGORY_CODE["evento_invalido"]
+    if "'opciones'" in error:
+        return _CATEGORY_CODE["opciones_invalidas"]
+    return _CATEGORY_CODE["otro"]
+
+
+def iter_records(path: str) -> Iterator[Dict[str, Any]]:
+    # JSONL sin comprimir: lectura via mmap (sin copiar el fichero a memoria de Python)
+    if path.endswith(".jsonl"):
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return
+            with mm:
+                for line in iter(mm.readline, b""):
+                    if len(line) < 2:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(record, dict):
+                        yield record
+        return
+    yield from iter_log_turns(path)
+
+
+class TurnColumns:
+    # Columnas NumPy de todos los turnos; los eventos de dialogo van en columnas aparte
+
+    def __init__(self):
+        self.ts = np.empty(0, dtype="datetime64[s]")
+        self.latency_ms = np.empty(0, dtype=np.float64)
+        self.resp_len = np.empty(0, dtype=np.int32)
+        self.n_eventos = np.empty(0, dtype=np.int16)
+        self.n_opciones = np.empty(0, dtype=np.int16)
+        self.parse_ok = np.empty(0, dtype=bool)
+        self.format_ok = np.empty(0, dtype=bool)
+        self.err_cat = np.empty(0, dtype=np.int8)
+        self.prompt_rev = np.empty(0, dtype=np.int32)
+        self.prompt_revs: List[str] = []
+        self.speaker = np.empty(0, dtype=np.int32)
+        self.speaker_chars = np.empty(0, dtype=np.int32)
+        self.speakers: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+
+def _load_data(parser: ResponseParser, raw: str) -> Optional[Dict[str, Any]]:
+    # El estado de validacion ya viene en el log: basta con decodificar, sin revalidar
+    try:
+        data = json.loads(parser.maybe_wrap_json(parser.extract_json_object(parser.strip_code_fences(raw))))
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def load_columns(paths: List[str]) -> TurnColumns:
+    parser = ResponseParser()
+    ts: List[str] = []
+    latency: List[float] = []
+    resp_len: List[int] = []
+    n_eventos: List[int] = []
+    n_opciones: List[int] = []
+    parse_ok: List[bool] = []
+    format_ok: List[bool] = []
+    err_cat: List[int] = []
+    rev_codes: List[int] = []
+    speaker: List[int] = []
+    speaker_chars: List[int] = []
+    revs: Dict[str, int] = {}
+    names: Dict[str, int] = {}
+
+    for path in paths:
+        for r in iter_records(path):
+            raw = r.get("raw_response") or ""
+            ok = bool(r.get("format_ok"))
+            timings = r.get("timings") or {}
+            stats = r.get("stats") or {}
+
+            ts.append(str(r.get("ts", "NaT")))
+            latency.append(float(timings.get("total", timings.get("llm", np.nan))))
+            resp_len.append(len(raw))
+            parse_ok.append(bool(r.get("parse_ok")))
+            format_ok.append(ok)
+            err_cat.append(classify_error(r.get("error") or "", raw, bool(r.get("parse_ok")), ok))
+            rev_codes.append(revs.setdefault(str(stats.get("prompt_rev", "?")), len(revs)))
+
+            # Los logs actuales traen el resumen (shape); solo los antiguos obligan a decodificar raw
+            shape = r.get("shape")
+            if not isinstance(shape, dict):
+                shape = turn_shape(_load_data(parser, raw) if r.get("parse_ok") else None)
+            n_eventos.append(int(shape.get("eventos", -1)))
+            n_opciones.append(int(shape.get("opciones", -1)))
+            for nombre, chars in shape.get("dialogo") or ():
+                speaker.append(names.setdefault(nombre, len(names)))
+                speaker_chars.append(chars)
+
+    cols = TurnColumns()
+    cols.ts = np.array(ts, dtype="datetime64[s]")
+    cols.latency_ms = np.array(latency, dtype=np.float64)
+    cols.resp_len = np.array(resp_len, dtype=np.int32)
+    cols.n_eventos = np.array(n_eventos, dtype=np.int16)
+    cols.n_opciones = np.array(n_opciones, dtype=np.int16)
+    cols.parse_ok = np.array(parse_ok, dtype=bool)
+    cols.format_ok = np.array(format_ok, dtype=bool)
+    cols.err_cat = np.array(err_cat, dtype=np.int8)
+    cols.prompt_rev = np.array(rev_codes, dtype=np.int32)
+    cols.prompt_revs = list(revs)
+    cols.speaker = np.array(speaker, dtype=np.int32)
+    cols.speaker_chars = np.array(speaker_chars, dtype=np.int32)
+    cols.speakers = list(names)
+    return cols
+
+
+def _percentiles(values: np.ndarray) -> Dict[str, float]:
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return {}
+    p50, p90, p95, p99 = np.percentile(values, [50, 90, 95, 99])
+    return {"p50": float(p50), "p90": float(p90), "p95": float(p95), "p99": float(p99), "max": float(values.max())}
+
+
+def build_report(cols: TurnColumns, latency_bins: int = 12) -> Dict[str, Any]:
+    n = len(cols)
+    if n == 0:
+        return {"turns": 0}
+
+    report: Dict[str, Any] = {
+        "turns": n,
+        "desde": str(cols.ts.min()),
+        "hasta": str(cols.ts.max()),
+        "parse_fail_rate": float(1.0 - cols.parse_ok.mean()),
+        "format_fail_rate": float(1.0 - cols.format_ok.mean()),
+    }
+
+    # Fallos por revision del prompt
+    n_rev = len(cols.prompt_revs)
+    per_rev = np.bincount(cols.prompt_rev, minlength=n_rev)
+    fails_rev = np.bincount(cols.prompt_rev, weights=~cols.format_ok, minlength=n_rev)
+    report["por_revision"] = {
+        rev: {"turns": int(per_rev[i]), "format_fail_rate": float(fails_rev[i] / per_rev[i]) if per_rev[i] else 0.0}
+        for i, rev in enumerate(cols.prompt_revs)
+    }
+
+    cats = np.bincount(cols.err_cat, minlength=len(ERROR_CATEGORIES))
+    report["errores"] = {name: int(cats[i]) for i, name in enumerate(ERROR_CATEGORIES) if cats[i]}
+
+    # Latencias: percentiles e histograma con bins logaritmicos
+    lat = cols.latency_ms[np.isfinite(cols.latency_ms) & (cols.latency_ms > 0)]
+    report["latencia_ms"] = _percentiles(lat)
+    if len(lat):
+        if lat.max() > lat.min():
+            edges = np.logspace(np.log10(lat.min()), np.log10(lat.max()), latency_bins + 1)
+        else:
+            edges = np.array([lat.min(), lat.max() + 1.0])
+        counts, edges = np.histogram(lat, bins=edges)
+        report["latencia_hist"] = [
+            {"desde_ms": round(float(a), 1), "hasta_ms": round(float(b), 1), "turns": int(c)}
+            for a, b, c in zip(edges[:-1], edges[1:], counts)
+        ]
+
+    report["longitud_respuesta"] = _percentiles(cols.resp_len.astype(np.float64))
+    valid = cols.n_eventos >= 0
+    if valid.any():
+        report["eventos_por_turno"] = {
+            "media": float(cols.n_eventos[valid].mean()),
+            "distribucion": {int(k): int(v) for k, v in enumerate(np.bincount(cols.n_eventos[valid])) if v},
+        }
+    valid = cols.n_opciones >= 0
+    if valid.any():
+        report["opciones_por_turno"] = {int(k): int(v) for k, v in enumerate(np.bincount(cols.n_opciones[valid])) if v}
+
+    # Reparto del dialogo por personaje (por lineas y por caracteres)
+    if len(cols.speaker):
+        lines = np.bincount(cols.speaker, minlength=len(cols.speakers))
+        chars = np.bincount(cols.speaker, weights=cols.speaker_chars, minlength=len(cols.speakers))
+        order = np.argsort(-chars)
+        report["dialogo"] = {
+            cols.speakers[i]: {
+                "lineas": int(lines[i]),
+                "cuota_lineas": float(lines[i] / lines.sum()),
+                "cuota_caracteres": float(chars[i] / chars.sum()) if chars.sum() else 0.0,
+            }
+            for i in order
+        }
+
+    days, per_day = np.unique(cols.ts.astype("datetime64[D]"), return_counts=True)
+    report["turnos_por_dia"] = {str(d): int(c) for d, c in zip(days, per_day)}
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    if not report.get("turns"):
+        return "Sin turnos."
+    out = [
+        f"Turnos: {report['turns']}  ({report['desde']} -> {report['hasta']})",
+        f"Fallo de parseo: {report['parse_fail_rate']:.1%}   Fallo de formato: {report['format_fail_rate']:.1%}",
+        "",
+        "Por revision del prompt:",
+    ]
+    for rev, r in report["por_revision"].items():
+        out.append(f"  {rev:10s} {r['turns']:8d} turnos  fallo formato {r['format_fail_rate']:.1%}")
+    out += ["", "Errores:"] + [f"  {k:20s} {v}" for k, v in report["errores"].items()]
+    if report.get("latencia_ms"):
+        lat = report["latencia_ms"]
+        out += ["", f"Latencia ms: p50 {lat['p50']:.0f}  p90 {lat['p90']:.0f}  p95 {lat['p95']:.0f}  p99 {lat['p99']:.0f}"]
+        peak = max(b["turns"] for b in report["latencia_hist"]) or 1
+        for b in report["latencia_hist"]:
+            out.append(f"  {b['desde_ms']:>9.0f}-{b['hasta_ms']:<9.0f} {'#' * int(40 * b['turns'] / peak)} {b['turns']}")
+    lng = report["longitud_respuesta"]
+    out += ["", f"Longitud respuesta (chars): p50 {lng['p50']:.0f}  p95 {lng['p95']:.0f}  max {lng['max']:.0f}"]
+    if "eventos_por_turno" in report:
+        out.append(f"Eventos por turno: media {report['eventos_por_turno']['media']:.2f}")
+    if "dialogo" in report:
+        out += ["", "Dialogo por personaje:"]
+        for name, d in report["dialogo"].items():
+            out.append(f"  {name:15s} {d['lineas']:7d} lineas  {d['cuota_caracteres']:.1%} del texto")
+    return "\n".join(out)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Informe de calidad y rendimiento sobre los logs de partida")
+    ap.add_argument("logs", nargs="+", help="logs JSONL (tambien .gz rotados) o de texto antiguo")
+    ap.add_argument("--json", action="store_true", help="salida JSON en lugar de texto")
+    args = ap.parse_args(argv)
+
+    report = build_report(load_columns(args.logs))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
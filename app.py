@@ -1,34 +1,85 @@
 import os
 import queue
 import threading
-from typing import Any, Dict, Tuple
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, List, Optional, Tuple
 
 import tkinter as tk
-from tkinter import ttk
+from tkinter import filedialog, ttk
 from tkinter import font as tkfont
 
-from llm_service import LLMService
-from parser import ResponseParser
-from logger import GameLogger
+from parser import IncrementalParser, ResponseParser
 from renderer import ChatRenderer, CharacterColors
+from session_store import load_session, save_session, slot_filename
+
+if TYPE_CHECKING:
+    # El backend (requests, cliente, logger, metricas) se importa en segundo plano: _init_backend
+    from llm_client import CancelToken
+    from llm_service import LLMService
+    from logger import GameLogger
+    from metrics import TurnMetrics
+    from prefetch import Speculation, SpeculativePrefetcher
 
 
 class ChatUI(tk.Tk):
-    def __init__(self):
+    def __init__(self, started_at: Optional[float] = None):
+        # started_at: perf_counter al arrancar el proceso (antes de importar este modulo)
+        t_init = time.perf_counter()
+        self._t0 = started_at if started_at is not None else t_init
+        self.startup: Dict[str, Any] = {"imports_ms": round(1000 * (t_init - self._t0), 1)}
+
         super().__init__()
         self.title("Chat con IA")
         self.geometry("820x520")
         self.minsize(740, 460)
 
-        self.result_q: "queue.Queue[Tuple[str, str, str]]" = queue.Queue()
-
-        self.llm = LLMService(prompt_path="prompts/predefined_prompt.txt")
+        # (estado, turn_id, entrada, payload, stats): lo de turnos ya cancelados se descarta
+        self.result_q: "queue.Queue[Tuple[str, str, str, str, Dict[str, Any]]]" = queue.Queue()
+
+        # Arranque en dos fases: primero la ventana; llm/logger/metrics/prefetch los crea
+        # _init_backend en un hilo y despues precalienta la cache de prompt del servidor
+        self._backend_ready = threading.Event()
+        # Si el arranque del backend falla, el motivo (se muestra en el chat y al enviar)
+        self._backend_error = ""
+        self._painted = threading.Event()
+        self.llm: "LLMService"
+        self.logger: "GameLogger"
+        self.metrics: "TurnMetrics"
+        self.prefetch: Optional["SpeculativePrefetcher"] = None
         self.parser = ResponseParser()
-        self.logger = GameLogger(log_path=os.path.join("outputs", "log_partida.txt"))
+        self._turn_id = ""
+
+        # Turno en vuelo cancelable; TABERNA_REPLACE_PENDING=1: enviar con un turno en
+        # vuelo lo cancela y lo sustituye en lugar de bloquear la entrada
+        self._cancel: Optional["CancelToken"] = None
+        self.replace_pending = os.getenv("TABERNA_REPLACE_PENDING", "") == "1"
 
         palette = ["#f59e0b", "#22d3ee", "#b54a8a", "#9333ea", "#10b981", "#ef4444"]
         self.character_colors = CharacterColors(palette)
 
+        # Partida guardable: turnos tal cual llegaron ({"u", "r"} o {"u", "e"}) para repintarlos.
+        # TABERNA_AUTOSAVE: donde se guarda al cerrar (vacio = no se guarda)
+        self.transcript: List[Dict[str, str]] = []
+        self.session_dir = os.path.join("outputs", "sessions")
+        self.autosave_path = os.getenv("TABERNA_AUTOSAVE", os.path.join(self.session_dir, "autosave.taberna"))
+        # Al cerrar, el volcado del slot no espera mas de esto (segundos) antes de rendirse
+        self.close_save_timeout = float(os.getenv("TABERNA_CLOSE_SAVE_TIMEOUT", "10"))
+        self._closing = False
+        # Restaurando la cache KV de una partida: entrada bloqueada y sin nada que cancelar
+        self._restoring = False
+
+        # HUD de rendimiento en la barra superior (TABERNA_HUD=1 o F2): telemetria de llama.cpp
+        # del ultimo turno y media movil de tok/s de los ultimos turnos
+        self.hud_enabled = os.getenv("TABERNA_HUD", "") == "1"
+        self._hud_samples: Deque[Dict[str, Any]] = deque(maxlen=10)
+
+        # Streaming: se muestra la respuesta mientras llega
+        self.stream = True
+        self._stream_parser: Optional[IncrementalParser] = None
+        self._stream_dirty = False
+        self._rendered_events = 0
+
         # Colores base (oscuro en grises, sin negro puro)
         self.colors = {
             "bg": "#2b2f36",
@@ -49,15 +100,120 @@ class ChatUI(tk.Tk):
         self.ui_font = tkfont.nametofont("TkDefaultFont").copy()
         self.ui_font.configure(size=self.base_font_size)
 
+        t_ui = time.perf_counter()
         self._configure_theme()
         self._build_ui()
 
         self.renderer = ChatRenderer(self.chat, self.character_colors, base_font=self.ui_font)
+        self.renderer.attach_scrollbar(self.chat_scroll)
+        self.startup["ui_ms"] = round(1000 * (time.perf_counter() - t_ui), 1)
 
+        t_greeting = time.perf_counter()
         self._display_greeting()
+        self.startup["greeting_ms"] = round(1000 * (time.perf_counter() - t_greeting), 1)
 
         self._bind_zoom_shortcuts()
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
         self.after(100, self._poll_results)
+        # Primer hueco del bucle de eventos = ventana ya pintada
+        self.after_idle(self._on_first_paint)
+        threading.Thread(target=self._init_backend, name="backend-init", daemon=True).start()
+
+    def _on_first_paint(self):
+        self.startup["window_ms"] = round(1000 * (time.perf_counter() - self._t0), 1)
+        self._painted.set()
+
+    def _init_backend(self):
+        t_backend = time.perf_counter()
+        from llm_service import LLMService
+        from logger import GameLogger
+        from metrics import TurnMetrics
+        from prefetch import SpeculativePrefetcher
+        from transcript_store import SQLiteTranscriptStore
+
+        self.startup["backend_imports_ms"] = round(1000 * (time.perf_counter() - t_backend), 1)
+
+        try:
+            self.llm = LLMService(prompt_path="prompts/predefined_prompt.txt")
+            # TABERNA_TRANSCRIPT_DB: guarda los turnos en SQLite en lugar del JSONL
+            transcript_db = os.getenv("TABERNA_TRANSCRIPT_DB", "")
+            if transcript_db:
+                self.logger = SQLiteTranscriptStore(transcript_db)
+            else:
+                self.logger = GameLogger(log_path=os.path.join("outputs", "log_partida.jsonl"))
+
+            # Spans por etapa de cada turno; TABERNA_METRICS_PORT expone /metrics en local
+            self.metrics = TurnMetrics(jsonl_path=os.path.join("outputs", "metrics.jsonl"))
+            metrics_port = os.getenv("TABERNA_METRICS_PORT", "")
+            if metrics_port.isdigit():
+                self.metrics.serve(int(metrics_port))
+
+            # TABERNA_PREFETCH=1: mientras se lee el turno se generan las respuestas a las opciones
+            if os.getenv("TABERNA_PREFETCH", "") == "1":
+                self.prefetch = SpeculativePrefetcher(self.llm)
+        except Exception as e:
+            # Sin backend no se puede jugar: se cierra lo que llego a crearse y se avisa en el chat
+            self._backend_error = f"No se pudo iniciar el juego: {e}"
+            for part in ("prefetch", "logger", "metrics"):
+                obj = getattr(self, part, None)
+                if obj is not None:
+                    try:
+                        obj.close()
+                    except Exception:
+                        pass
+            self.result_q.put(("backend_error", "", "", self._backend_error, {}))
+            return
+
+        now = time.perf_counter()
+        self.startup["backend_ms"] = round(1000 * (now - t_backend), 1)
+        self.startup["ready_ms"] = round(1000 * (now - self._t0), 1)
+        self._backend_ready.set()
+
+        # LLAMA_WARMUP=off lo desactiva (p.ej. si el servidor es compartido)
+        if os.getenv("LLAMA_WARMUP", "on").lower() != "off":
+            t_warm = time.perf_counter()
+            try:
+                self.startup["warmup"] = self.llm.warm_up()
+            except Exception as e:
+                self.startup["warmup"] = {"error": str(e)}
+            self.startup["warmup_ms"] = round(1000 * (time.perf_counter() - t_warm), 1)
+        self._painted.wait(5.0)
+        self.metrics.record_event("startup", self.startup)
+
+    def _on_close(self):
+        # Corta la generacion en curso (libera el slot del servidor) y vacia el log pendiente
+        if self._closing:
+            return
+        if self._cancel is not None:
+            self._cancel.set()
+        if not self._backend_ready.is_set():
+            self.destroy()
+            return
+        if self.prefetch is not None:
+            self.prefetch.close()
+        if self.autosave_path and self.transcript:
+            # El volcado del slot va por HTTP y puede tardar: se guarda en segundo plano y la
+            # ventana se cierra cuando termina (ver "closed" en _poll_results)
+            self._closing = True
+            self._set_busy(True, cancellable=False)
+            self.renderer.append_notice("Guardando la partida...")
+            state = self._collect_session()
+
+            def worker():
+                self._write_session(self.autosave_path, state, timeout=self.close_save_timeout)
+                self.result_q.put(("closed", "", "", "", {}))
+
+            threading.Thread(target=worker, daemon=True).start()
+            return
+        self._finish_close()
+
+    def _finish_close(self):
+        # Balance de la sesion: aciertos y tokens/segundos gastados en especulaciones descartadas
+        if self.prefetch is not None:
+            self.metrics.record_event("prefetch", self.prefetch.stats())
+        self.logger.close()
+        self.metrics.close()
+        self.destroy()
 
     def _display_greeting(self):
         try:
@@ -125,6 +281,12 @@ class ChatUI(tk.Tk):
             foreground=[("disabled", "#8b93a3")],
         )
 
+        style.configure(
+            "Hud.TLabel",
+            background=self.colors["bg"],
+            foreground=self.colors["muted"],
+        )
+
         style.configure(
             "TScrollbar",
             background=self.colors["panel"],
@@ -147,8 +309,22 @@ class ChatUI(tk.Tk):
         topbar.grid(row=0, column=0, columnspan=2, sticky="ew", pady=(0, 8))
         topbar.columnconfigure(0, weight=1)
 
+        session_box = ttk.Frame(topbar, style="Main.TFrame")
+        session_box.grid(row=0, column=0, sticky="w")
+
+        self.save_btn = ttk.Button(session_box, text="Guardar", command=self.on_save_session)
+        self.save_btn.grid(row=0, column=0, padx=(0, 6))
+
+        self.load_btn = ttk.Button(session_box, text="Cargar", command=self.on_load_session)
+        self.load_btn.grid(row=0, column=1)
+
+        self.hud_lbl = ttk.Label(topbar, text="sin datos de rendimiento", style="Hud.TLabel")
+        self.hud_lbl.grid(row=0, column=1, sticky="e", padx=(0, 12))
+        if not self.hud_enabled:
+            self.hud_lbl.grid_remove()
+
         zoom_box = ttk.Frame(topbar, style="Main.TFrame")
-        zoom_box.grid(row=0, column=1, sticky="e")
+        zoom_box.grid(row=0, column=2, sticky="e")
 
         self.zoom_out_btn = ttk.Button(zoom_box, text="A-", width=4, command=lambda: self._zoom(-1))
         self.zoom_out_btn.grid(row=0, column=0, padx=(0, 6))
@@ -178,6 +354,7 @@ class ChatUI(tk.Tk):
         scroll = ttk.Scrollbar(main_frame, command=self.chat.yview)
         scroll.grid(row=1, column=1, sticky="ns")
         self.chat["yscrollcommand"] = scroll.set
+        self.chat_scroll = scroll
 
         bottom = ttk.Frame(self, padding=10, style="Main.TFrame")
         bottom.grid(row=1, column=0, sticky="ew")
@@ -190,12 +367,17 @@ class ChatUI(tk.Tk):
         self.send_btn = ttk.Button(bottom, text="Enviar", command=self.on_send)
         self.send_btn.grid(row=0, column=1, padx=(10, 0))
 
+        self.cancel_btn = ttk.Button(bottom, text="Cancelar", command=self.on_cancel, state="disabled")
+        self.cancel_btn.grid(row=0, column=2, padx=(10, 0))
+        self.bind("<Escape>", lambda _e: self.on_cancel())
+
     def _bind_zoom_shortcuts(self):
         # Atajos de zoom (según teclado, el + suele venir como "equal")
         self.bind("<Control-plus>", lambda _e: self._zoom(+1))
         self.bind("<Control-equal>", lambda _e: self._zoom(+1))
         self.bind("<Control-minus>", lambda _e: self._zoom(-1))
         self.bind("<Control-0>", lambda _e: self._set_font_size(12))
+        self.bind("<F2>", lambda _e: self._toggle_hud())
 
         # Ctrl + rueda (Windows/macOS)
         self.bind("<Control-MouseWheel>", self._on_ctrl_wheel)
@@ -229,9 +411,35 @@ class ChatUI(tk.Tk):
         if hasattr(self, "renderer"):
             self.renderer.set_font_size(self.base_font_size)
 
-    def _set_busy(self, busy: bool):
-        # Bloquea input mientras llega la respuesta
-        if busy:
+    def _toggle_hud(self):
+        self.hud_enabled = not self.hud_enabled
+        if self.hud_enabled:
+            self.hud_lbl.grid()
+        else:
+            self.hud_lbl.grid_remove()
+
+    def _update_hud(self, completion: Optional[Dict[str, Any]]):
+        # Las respuestas de la cache local no dicen nada del backend
+        if not completion or completion.get("cached") or not completion.get("predicted_n"):
+            return
+        self._hud_samples.append(completion)
+        rates = [c["predicted_per_second"] for c in self._hud_samples]
+        avg = sum(rates) / len(rates)
+        tps = completion["predicted_per_second"]
+        self.hud_lbl.configure(
+            text=(
+                f"{tps:.1f} tok/s · prefill {completion['prompt_ms']:.0f} ms ({completion['prompt_n']} tk)"
+                f" · decode {completion['predicted_ms'] / 1000:.1f} s · media {avg:.1f} tok/s"
+            ),
+            # Muy por debajo de la media reciente: el backend se esta degradando
+            foreground=self.colors["error"] if len(rates) >= 3 and tps < 0.7 * avg else self.colors["muted"],
+        )
+
+    def _set_busy(self, busy: bool, cancellable: bool = True):
+        # Bloquea input mientras llega la respuesta (salvo en modo "enviar sustituye").
+        # cancellable=False: trabajo que no es un turno (restaurar, guardar al cerrar)
+        self.cancel_btn.configure(state="normal" if busy and cancellable else "disabled")
+        if busy and (not self.replace_pending or not cancellable):
             self.send_btn.configure(state="disabled")
             self.entry.configure(state="disabled")
         else:
@@ -239,80 +447,377 @@ class ChatUI(tk.Tk):
             self.entry.configure(state="normal")
             self.entry.focus_set()
 
+    def on_cancel(self):
+        if self._cancel is None:
+            return
+        # Aborta el stream HTTP; lo que siga llegando de este turno se ignora en _poll_results
+        self._cancel.set()
+        self._cancel = None
+        turn_id, self._turn_id = self._turn_id, ""
+        self._stream_parser = None
+        self._stream_dirty = False
+        self.renderer.discard_turn()
+        self.renderer.append_notice("Turno cancelado.")
+        self.metrics.finish_turn(turn_id, cancelled=True)
+        self._set_busy(False)
+
+    def _collect_session(self) -> Dict[str, Any]:
+        return {
+            "transcript": list(self.transcript),
+            "colors": dict(self.character_colors.map),
+            "llm": self.llm.snapshot(),
+        }
+
+    def _write_session(self, path: str, state: Dict[str, Any], timeout: Optional[float] = None) -> str:
+        # Primero la cache KV en el servidor (si falla se guarda igual: al cargar habra prefill)
+        slot_note = "sin cache KV"
+        try:
+            slot = self.llm.save_slot(slot_filename(self.llm.affinity_key), timeout=timeout)
+            if slot:
+                state["slot"] = slot
+                slot_note = f"cache KV de {slot.get('n_saved')} tokens en {slot.get('save_ms')} ms"
+        except Exception as e:
+            slot_note = f"sin cache KV ({e})"
+        try:
+            size = save_session(path, state)
+        except OSError as e:
+            return f"No se pudo guardar la partida: {e}"
+        return f"Partida guardada en {path} ({size // 1024 + 1} KB, {slot_note})."
+
+    def on_save_session(self):
+        if not self._backend_ready.is_set():
+            return
+        if self._cancel is not None or self._restoring:
+            self.renderer.append_notice("Espera a que termine el turno para guardar.")
+            return
+        path = filedialog.asksaveasfilename(
+            parent=self,
+            initialdir=self.session_dir,
+            defaultextension=".taberna",
+            filetypes=[("Partidas", "*.taberna")],
+        )
+        if not path:
+            return
+        state = self._collect_session()
+
+        def worker():
+            self.result_q.put(("session", "", "", self._write_session(path, state), {}))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def on_load_session(self):
+        if not self._backend_ready.is_set():
+            return
+        if self._cancel is not None or self._restoring:
+            self.renderer.append_notice("Espera a que termine el turno para cargar otra partida.")
+            return
+        os.makedirs(self.session_dir, exist_ok=True)
+        path = filedialog.askopenfilename(
+            parent=self, initialdir=self.session_dir, filetypes=[("Partidas", "*.taberna")]
+        )
+        if not path:
+            return
+        try:
+            state = load_session(path)
+        except (OSError, ValueError) as e:
+            self.renderer.append_error(f"No se pudo cargar la partida: {e}")
+            return
+        self._apply_session(state)
+
+    def _apply_session(self, state: Dict[str, Any]):
+        if self.prefetch is not None:
+            self.prefetch.discard()
+        self.transcript = [t for t in state.get("transcript", []) if isinstance(t, dict)]
+        # Mismos colores por personaje que en la partida original
+        self.character_colors.map = dict(state.get("colors", {}))
+        self.llm.restore(state.get("llm", {}))
+
+        self.renderer.clear()
+        self._display_greeting()
+        opciones: Any = None
+        for turn in self.transcript:
+            self.renderer.append_user(turn.get("u", ""))
+            if "e" in turn:
+                self.renderer.append_error(turn["e"])
+                continue
+            outcome = self.parser.parse(turn.get("r", ""))
+            # Una respuesta truncada y reparada se pinta aunque haya perdido las opciones
+            if outcome.data and (outcome.format_ok or outcome.repaired):
+                self._render_new_format(outcome.data)
+                opciones = outcome.data.get("opciones")
+            else:
+                self.renderer.append_raw_ai(turn.get("r", ""))
+                opciones = None
+        if self.prefetch is not None:
+            self.prefetch.schedule(opciones)
+
+        slot = state.get("slot")
+        if not slot:
+            self.renderer.append_notice(f"Partida cargada ({len(self.transcript)} turnos).")
+            return
+
+        # La cache KV se restaura en segundo plano; mientras, la entrada queda bloqueada
+        # (sin boton Cancelar: no hay turno que cortar)
+        self._restoring = True
+        self._set_busy(True, cancellable=False)
+
+        def worker():
+            try:
+                info = self.llm.restore_slot(slot)
+                msg = (
+                    f"Partida cargada ({len(self.transcript)} turnos); cache KV restaurada "
+                    f"({info.get('n_restored')} tokens en {info.get('restore_ms')} ms)."
+                )
+            except Exception as e:
+                msg = f"Partida cargada ({len(self.transcript)} turnos); cache KV no restaurada ({e})."
+            self.result_q.put(("session", "", "", msg, {}))
+
+        threading.Thread(target=worker, daemon=True).start()
+
     def on_send(self):
         user_text = self.entry.get().strip()
         if not user_text:
             return
+        if self._backend_error:
+            self.renderer.append_error(self._backend_error)
+            return
+        if not self._backend_ready.is_set():
+            # Backend aun arrancando (son milisegundos): se reintenta sin perder lo escrito
+            self.after(50, self.on_send)
+            return
+        from llm_client import CancelToken
+        if self._restoring or self._closing:
+            return
+        if self._cancel is not None:
+            if not self.replace_pending:
+                return
+            self.on_cancel()
 
         self.entry.delete(0, "end")
         self.renderer.append_user(user_text)
+        self.renderer.mark_turn()
 
         self._set_busy(True)
-        self._ask_llm_async(user_text)
+        self._turn_id = self.metrics.start_turn()
+        self._rendered_events = 0
+        self._stream_dirty = False
+        self._stream_parser = None
+        if self.stream:
+            self._stream_parser = IncrementalParser(self.parser)
+            self.renderer.begin_live()
+        self._cancel = CancelToken()
+        # Una entrada que no coincide con ninguna opcion cancela las especulaciones en curso
+        spec = self.prefetch.claim(user_text) if self.prefetch is not None else None
+        self._ask_llm_async(user_text, self._turn_id, self._cancel, spec)
+
+    def _ask_llm_async(
+        self,
+        user_input: str,
+        turn_id: str,
+        cancel: "CancelToken",
+        spec: Optional["Speculation"] = None,
+    ):
+        from llm_client import RequestCancelled
 
-    def _ask_llm_async(self, user_input: str):
         # Hilo para no bloquear la interfaz
         def worker():
+            self.metrics.record_since(turn_id, "thread_spawn", "spawn")
+            self.metrics.mark(turn_id, "llm_start")
             try:
-                raw = self.llm.chat(user_input, temperature=0.7, max_tokens=1024)
-                self.result_q.put(("ok", user_input, raw))
+                with self.metrics.span(turn_id, "llm"):
+                    raw = spec.wait(cancel) if spec is not None else None
+                    if cancel.is_set():
+                        raise RequestCancelled()
+                    if raw is not None:
+                        # Respuesta especulada: ya esta completa, solo falta recordarla
+                        self.llm.client.adopt_call_stats(spec.call_stats)
+                        self.llm.remember(user_input, raw)
+                        if self.stream:
+                            self.result_q.put(("chunk", turn_id, user_input, raw, {}))
+                    elif self.stream:
+                        parts = []
+
+                        def restart(reason: str):
+                            # El guard corto la generacion: la interfaz descarta lo pintado
+                            parts.clear()
+                            self.result_q.put(("restart", turn_id, user_input, reason, {}))
+
+                        for piece in self.llm.chat_stream(
+                            user_input, temperature=0.7, max_tokens=1024, cancel=cancel, on_restart=restart
+                        ):
+                            if not parts:
+                                self.metrics.record_since(turn_id, "first_chunk", "llm_start")
+                            parts.append(piece)
+                            self.result_q.put(("chunk", turn_id, user_input, piece, {}))
+                        raw = "".join(parts).strip()
+                    else:
+                        raw = self.llm.chat(user_input, temperature=0.7, max_tokens=1024, cancel=cancel)
+                self.metrics.mark(turn_id, "queued")
+                stats = self._turn_stats(turn_id)
+                if spec is not None:
+                    stats["prefetch"] = "hit" if spec.raw is not None else "failed"
+                self.result_q.put(("ok", turn_id, user_input, raw, stats))
+            except RequestCancelled:
+                # La interfaz ya cerro el turno en on_cancel
+                return
             except Exception as e:
-                self.result_q.put(("err", user_input, str(e)))
+                self.metrics.mark(turn_id, "queued")
+                self.result_q.put(("err", turn_id, user_input, str(e), self._turn_stats(turn_id)))
 
+        self.metrics.mark(turn_id, "spawn")
         threading.Thread(target=worker, daemon=True).start()
 
-    def _render_new_format(self, data: Dict[str, Any]):
+    def _turn_stats(self, turn_id: str) -> Dict[str, Any]:
+        # Se llama desde el hilo del turno: los contadores del cliente son por hilo
+        stats: Dict[str, Any] = {
+            "turn_id": turn_id,
+            "prompt_rev": self.llm.prompt_revision,
+            "retries": self.llm.client.last_retries,
+        }
+        if self.llm.client.last_truncation:
+            stats["truncation"] = dict(self.llm.client.last_truncation)
+        if self.llm.last_candidates:
+            stats["candidates"] = dict(self.llm.last_candidates)
+        if self.llm.last_guard:
+            stats["guard"] = dict(self.llm.last_guard)
+        # Telemetria de llama.cpp: va aparte al log (campo completion) y al HUD
+        result = self.llm.client.last_result
+        if result is not None:
+            stats["completion"] = result.as_dict()
+        return stats
+
+    def _render_new_format(self, data: Dict[str, Any], skip: int = 0):
+        # skip: eventos ya pintados durante el streaming
         eventos = data.get("eventos", [])
-        for ev in eventos:
-            if not isinstance(ev, dict):
-                continue
-            tipo = (ev.get("tipo") or "").strip().lower()
-            texto = ev.get("texto", "")
-            if tipo == "narracion" and isinstance(texto, str):
-                self.renderer.append_narration(texto)
-            elif tipo == "dialogo":
-                nombre = ev.get("nombre", "")
-                if isinstance(nombre, str) and isinstance(texto, str):
-                    self.renderer.append_character(nombre, texto)
+        self.renderer.render_turn(eventos[skip:] if isinstance(eventos, list) else [], data.get("opciones"))
 
-        self.renderer.append_choices(data.get("opciones"))
+    def _on_stream_chunk(self, piece: str):
+        if self._stream_parser is None:
+            return
+        with self.metrics.span(self._turn_id, "parse"):
+            items = self._stream_parser.feed(piece)
+        with self.metrics.span(self._turn_id, "render"):
+            closed = [value for kind, value in items if kind == "evento"]
+            if closed:
+                # Eventos cerrados: se pintan de forma definitiva antes de la zona en vivo
+                self.renderer.end_live()
+                self.renderer.render_turn(closed)
+                self._rendered_events += len(closed)
+                self.renderer.begin_live()
+        self._stream_dirty = True
+
+    def _on_stream_restart(self, reason: str):
+        # Reintento tras abortar una generacion degenerada: se empieza el turno de cero
+        self.renderer.discard_turn()
+        self.renderer.append_notice(f"Respuesta descartada ({reason}), reintentando...")
+        self.renderer.mark_turn()
+        self._stream_parser = IncrementalParser(self.parser)
+        self._rendered_events = 0
+        self._stream_dirty = False
+        self.renderer.begin_live()
 
     def _poll_results(self):
         try:
             while True:
-                status, user_input, payload = self.result_q.get_nowait()
+                status, item_turn, user_input, payload, stats = self.result_q.get_nowait()
+                if status == "backend_error":
+                    self.renderer.append_error(payload)
+                    continue
+                if status == "closed":
+                    # Partida guardada al cerrar: ya se puede destruir la ventana
+                    self._finish_close()
+                    return
+                if status == "session":
+                    # Guardado/carga de partida terminado en segundo plano
+                    self.renderer.append_notice(payload)
+                    if self._restoring:
+                        self._restoring = False
+                        self._set_busy(False)
+                    continue
+                if item_turn != self._turn_id:
+                    # Restos de un turno cancelado o sustituido
+                    continue
+
+                if status == "chunk":
+                    self._on_stream_chunk(payload)
+                    continue
+                if status == "restart":
+                    self._on_stream_restart(payload)
+                    continue
+
+                # Fin de turno: la zona en vivo se sustituye por el render definitivo
+                turn_id = self._turn_id
+                completion = stats.pop("completion", None)
+                self.metrics.record_since(turn_id, "queue_wait", "queued")
+                self._stream_dirty = False
+                self.renderer.end_live()
 
                 if status == "ok":
                     raw = payload
-                    outcome = self.parser.parse(raw)
-
-                    if outcome.parse_ok and outcome.format_ok and outcome.data:
-                        self._render_new_format(outcome.data)
-                    else:
-                        self.renderer.append_raw_ai(raw)
-
-                    self.logger.log_turn(
-                        user_input=user_input,
-                        raw_response=raw,
-                        parse_ok=outcome.parse_ok,
-                        format_ok=outcome.format_ok,
-                        error=outcome.error,
-                    )
+                    with self.metrics.span(turn_id, "parse"):
+                        if self._stream_parser is not None:
+                            outcome = self._stream_parser.finish()
+                        else:
+                            outcome = self.parser.parse(raw)
+
+                    with self.metrics.span(turn_id, "render"):
+                        # Truncada y reparada: se pintan los eventos salvados aunque falten las opciones
+                        if outcome.data and (outcome.format_ok or outcome.repaired):
+                            self._render_new_format(outcome.data, skip=self._rendered_events)
+                            if self.prefetch is not None:
+                                self.prefetch.schedule(outcome.data.get("opciones"))
+                        else:
+                            self.renderer.discard_turn()
+                            self.renderer.append_raw_ai(raw)
+                    self.transcript.append({"u": user_input, "r": raw})
+
+                    with self.metrics.span(turn_id, "log"):
+                        self.logger.log_turn(
+                            user_input=user_input,
+                            raw_response=raw,
+                            parse_ok=outcome.parse_ok,
+                            format_ok=outcome.format_ok,
+                            error=outcome.error,
+                            stats=stats,
+                            timings=self.metrics.spans_ms(turn_id),
+                            completion=completion,
+                            data=outcome.data,
+                        )
+                    parse_ok, format_ok = outcome.parse_ok, outcome.format_ok
+                    self._update_hud(completion)
 
                 else:
                     err = payload
-                    self.renderer.append_error(err)
-                    self.logger.log_turn(
-                        user_input=user_input,
-                        raw_response=f"[ERROR] {err}",
-                        parse_ok=False,
-                        format_ok=False,
-                        error=err,
-                    )
-
+                    with self.metrics.span(turn_id, "render"):
+                        self.renderer.discard_turn()
+                        self.renderer.append_error(err)
+                    self.transcript.append({"u": user_input, "e": err})
+                    with self.metrics.span(turn_id, "log"):
+                        self.logger.log_turn(
+                            user_input=user_input,
+                            raw_response=f"[ERROR] {err}",
+                            parse_ok=False,
+                            format_ok=False,
+                            error=err,
+                            stats=stats,
+                            timings=self.metrics.spans_ms(turn_id),
+                            completion=completion,
+                        )
+                    parse_ok = format_ok = False
+
+                self.metrics.finish_turn(turn_id, parse_ok=parse_ok, format_ok=format_ok)
+                self._cancel = None
+                self._turn_id = ""
                 self._set_busy(False)
 
         except queue.Empty:
             pass
 
+        # Un solo repintado por ciclo aunque hayan llegado varios fragmentos
+        if self._stream_dirty and self._stream_parser is not None:
+            self._stream_dirty = False
+            pending = self._stream_parser.pending_text()
+            with self.metrics.span(self._turn_id, "render"):
+                self.renderer.update_live(self.parser.preview_events(pending))
+
         self.after(100, self._poll_results)
@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.stub_server import MALFORMED, SAMPLE_TURN, StubConfig, StubLlamaServer  # noqa: E402
+from logger import GameLogger  # noqa: E402
+from parser import IncrementalParser, ResponseParser  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def bench(fn: Callable[[], Any], *, number: int, repeat: int = 5) -> Dict[str, float]:
+    # Como timeit: se queda con la mediana y el minimo por operacion (en microsegundos)
+    fn()
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - t0) / number * 1e6)
+    return {
+        "median_us": round(statistics.median(samples), 3),
+        "min_us": round(min(samples), 3),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def large_turn(n_events: int = 40) -> str:
+    eventos = [SAMPLE_TURN["eventos"][i % len(SAMPLE_TURN["eventos"])] for i in range(n_events)]
+    return json.dumps({"eventos": eventos, "opciones": SAMPLE_TURN["opciones"]}, ensure_ascii=False, indent=2)
+
+
+def bench_parser(quick: bool) -> Dict[str, Dict[str, float]]:
+    parser = ResponseParser()
+    small = json.dumps(SAMPLE_TURN, ensure_ascii=False)
+    large = large_turn()
+    fenced = f"```json\n{small}\n```"
+    n = 200 if quick else 2000
+
+    def incremental():
+        p = IncrementalParser(parser)
+        for i in range(0, len(large), 16):
+            p.feed(large[i : i + 16])
+        p.finish()
+
+    return {
+        "parser.parse.small": bench(lambda: parser.parse(small), number=n),
+        "parser.parse.large": bench(lambda: parser.parse(large), number=n // 4),
+        "parser.parse.fenced": bench(lambda: parser.parse(fenced), number=n),
+        "parser.parse.broken": bench(lambda: [parser.parse(b) for b in MALFORMED], number=n),
+        "parser.incremental.large": bench(incremental, number=max(1, n // 20)),
+    }
+
+
+def bench_logger(quick: bool) -> Dict[str, Dict[str, float]]:
+    raw = json.dumps(SAMPLE_TURN, ensure_ascii=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Cola grande para medir el coste de encolar sin descartes
+        logger = GameLogger(log_path=os.path.join(tmp, "log.jsonl"), max_queue=100000)
+        try:
+            return {
+                "logger.log_turn": bench(
+                    lambda: logger.log_turn("hola", raw, True, True, stats={"retries": 0}),
+                    number=100 if quick else 1000,
+                )
+            }
+        finally:
+            logger.close()
+
+
+def bench_renderer(quick: bool) -> Dict[str, Dict[str, float]]:
+    # Necesita display; sin el se omite
+    try:
+        import tkinter as tk
+
+        from renderer import CharacterColors, ChatRenderer
+
+        root = tk.Tk()
+    except Exception as e:
+        print(f"[renderer] omitido: {e}", file=sys.stderr)
+        return {}
+
+    try:
+        root.withdraw()
+        text = tk.Text(root)
+        renderer = ChatRenderer(text, CharacterColors(["#f59e0b", "#22d3ee", "#b54a8a"]))
+        history = 200 if quick else 2000
+
+        def turn():
+            renderer.append_user("*entro en la taberna* saludos")
+            renderer.render_turn(SAMPLE_TURN["eventos"], SAMPLE_TURN["opciones"])
+
+        for _ in range(history):
+            turn()
+        root.update()
+        return {f"renderer.turn.history_{history}": bench(turn, number=20 if quick else 100)}
+    finally:
+        root.destroy()
+
+
+def bench_client(quick: bool) -> Dict[str, Dict[str, float]]:
+    from llm_client import LLMClient
+
+    server = StubLlamaServer(config=StubConfig()).start()
+    # Sin cache de respuestas: se mide el viaje completo. El entorno se restaura al terminar
+    env = {"LLAMA_CACHE": "off", "LLAMA_COMPLETION_URL": server.completion_url}
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    client = None
+    try:
+        client = LLMClient()
+        n = 20 if quick else 200
+        return {
+            "client.complete.roundtrip": bench(lambda: client.complete_with_grammar("hola", max_tokens=1024), number=n),
+            "client.stream.roundtrip": bench(lambda: list(client.stream_with_grammar("hola", max_tokens=1024)), number=n),
+        }
+    finally:
+        if client is not None:
+            client.close()
+        server.stop()
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+SUITES = {
+    "parser": bench_parser,
+    "logger": bench_logger,
+    "renderer": bench_renderer,
+    "client": bench_client,
+}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for name, cur in results["benchmarks"].items():
+        base = baseline.get("benchmarks", {}).get(name)
+        if not base:
+            continue
+        ratio = cur["median_us"] / base["median_us"] if base["median_us"] else 1.0
+        if ratio > 1.0 + tolerance:
+            regressions.append(f"{name}: {base['median_us']:.1f}us -> {cur['median_us']:.1f}us (x{ratio:.2f})")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmarks de los caminos calientes (parser, renderer, logger, cliente)")
+    ap.add_argument("--suite", action="append", choices=sorted(SUITES), help="por defecto todas")
+    ap.add_argument("--quick", action="store_true", help="menos iteraciones")
+    ap.add_argument("--out", help="guardar resultados en este JSON")
+    ap.add_argument("--save-baseline", action="store_true", help=f"sobrescribir {os.path.relpath(DEFAULT_BASELINE, ROOT)}")
+    ap.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, help="comparar con una linea base")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="empeoramiento admitido (0.25 = +25%%)")
+    args = ap.parse_args(argv)
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "benchmarks": {},
+    }
+    for name in args.suite or list(SUITES):
+        results["benchmarks"].update(SUITES[name](args.quick))
+
+    for name, r in sorted(results["benchmarks"].items()):
+        print(f"{name:40s} {r['median_us']:12.1f} us  (min {r['min_us']:.1f})")
+
+    for path in filter(None, [args.out, DEFAULT_BASELINE if args.save_baseline else None]):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("machine") != results["meta"]["machine"]:
+            print("Aviso: la linea base es de otra maquina", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
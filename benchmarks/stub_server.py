@@ -0,0 +1,288 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+SAMPLE_TURN = {
+    "eventos": [
+        {
+            "tipo": "narracion",
+            "texto": "Empujas la puerta y una rafaga de aire humedo mete el olor de la lluvia en la taberna. "
+            "El suelo de tablas cruje bajo tus botas.",
+        },
+        {"tipo": "dialogo", "nombre": "Aida", "texto": "Pasa. Pero no me encharques el suelo mas de la cuenta."},
+        {"tipo": "narracion", "texto": "Al fondo, Sable no levanta la cabeza, pero su mano se queda quieta sobre la jarra."},
+    ],
+    "opciones": [
+        "Pedir una bebida caliente.",
+        "Preguntar por el hombre del fondo.",
+        "Ofrecer 10 monedas de cobre.",
+    ],
+}
+
+MALFORMED = (
+    "de Sable \nCerrar la puerta \nSentarme en una mesa aleatoria \nPedir un trago\n",
+    '{ "eventos": [ { "tipo": "narracion", "texto": "Entras en la taberna y',
+    '```json\n{ "eventos": [ { "tipo": "dialogo", "texto": "sin nombre" } ], "opciones": [] }\n```',
+)
+
+
+def split_tokens(text: str, size: int = 4) -> List[str]:
+    # Aproximacion de tokens: trozos de ~4 caracteres
+    return [text[i : i + size] for i in range(0, len(text), size)] or [""]
+
+
+class StubConfig:
+    def __init__(
+        self,
+        *,
+        latency_s: float = 0.0,
+        tokens_per_s: float = 0.0,
+        malformed_rate: float = 0.0,
+        content: Optional[str] = None,
+        seed: int = 1234,
+    ):
+        # latency_s: espera antes del primer token (simula el prefill)
+        # tokens_per_s: 0 = sin limite de velocidad de generacion
+        self.latency_s = latency_s
+        self.tokens_per_s = tokens_per_s
+        self.malformed_rate = malformed_rate
+        self.content = content or json.dumps(SAMPLE_TURN, ensure_ascii=False)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def pick_content(self) -> str:
+        with self.lock:
+            if self.malformed_rate and self.rng.random() < self.malformed_rate:
+                return self.rng.choice(MALFORMED)
+        return self.content
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Cabeceras y cuerpo van en escrituras separadas: sin esto el ACK retardado mete ~40 ms
+    disable_nagle_algorithm = True
+    server: "StubLlamaServer"
+
+    def log_message(self, *_args):
+        pass
+
+    def _send_json(self, status: int, data: Any):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", "0") or 0)
+        try:
+            data = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            data = {}
+        return data if isinstance(data, dict) else {}
+
+    def do_GET(self):
+        if self.path == "/health":
+            if self.server.healthy:
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(503, {"error": {"code": 503, "message": "Loading model"}})
+        elif self.path == "/slots":
+            busy = self.server.active
+            self._send_json(200, [{"id": i, "is_processing": i < busy} for i in range(self.server.n_slots)])
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.path == "/tokenize":
+            n = len(split_tokens(str(body.get("content", ""))))
+            self._send_json(200, {"tokens": list(range(n))})
+            return
+        if self.path.startswith("/slots/"):
+            self._slot_action(body)
+            return
+        if self.path != "/completion":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        cfg = self.server.config
+        # Como llama.cpp: como mucho n_slots generaciones a la vez, el resto espera
+        with self.server.slots:
+            with self.server.active_lock:
+                self.server.active += 1
+            try:
+                self._completion(body, cfg)
+            finally:
+                with self.server.active_lock:
+                    self.server.active -= 1
+
+    def _slot_action(self, body: Dict[str, Any]):
+        # /slots/<id>?action=save|restore como llama-server --slot-save-path (en memoria)
+        slot, _, query = self.path[len("/slots/") :].partition("?")
+        action = query.partition("action=")[2].partition("&")[0]
+        filename = str(body.get("filename", ""))
+        if not slot.isdigit() or int(slot) >= self.server.n_slots or not filename:
+            self._send_json(400, {"error": {"code": 400, "message": "Invalid request"}})
+        elif action == "save":
+            n = self.server.slot_tokens.get(int(slot), 0)
+            self.server.saved_slots[filename] = n
+            self._send_json(
+                200,
+                {"id_slot": int(slot), "filename": filename, "n_saved": n, "timings": {"save_ms": 0.05 * n}},
+            )
+        elif action == "restore" and filename in self.server.saved_slots:
+            n = self.server.saved_slots[filename]
+            self.server.slot_tokens[int(slot)] = n
+            self._send_json(
+                200,
+                {"id_slot": int(slot), "filename": filename, "n_restored": n, "timings": {"restore_ms": 0.02 * n}},
+            )
+        else:
+            self._send_json(400, {"error": {"code": 400, "message": "Failed to restore slot"}})
+
+    def _completion(self, body: Dict[str, Any], cfg: StubConfig):
+        content = cfg.pick_content()
+        prompt = str(body.get("prompt", ""))
+        # Continuacion: si el prompt termina con un prefijo de la respuesta, se sigue desde ahi
+        anchor = prompt.rfind(content[:16])
+        if anchor != -1 and content.startswith(prompt[anchor:]):
+            content = content[len(prompt) - anchor :]
+        tokens = split_tokens(content)
+        n_predict = int(body.get("n_predict", -1))
+        truncated = 0 <= n_predict < len(tokens)
+        if truncated:
+            tokens = tokens[:n_predict]
+        prompt_n = len(split_tokens(prompt))
+        id_slot = int(body.get("id_slot", -1))
+        if not 0 <= id_slot < self.server.n_slots:
+            id_slot = 0
+        self.server.slot_tokens[id_slot] = prompt_n + len(tokens)
+
+        t0 = time.perf_counter()
+        if cfg.latency_s:
+            time.sleep(cfg.latency_s)
+        prompt_ms = 1000 * (time.perf_counter() - t0)
+        delay = 1.0 / cfg.tokens_per_s if cfg.tokens_per_s else 0.0
+
+        def final(text: str) -> Dict[str, Any]:
+            predicted_ms = max(1e-3, 1000 * (time.perf_counter() - t0) - prompt_ms)
+            return {
+                "content": text,
+                "stop": True,
+                "stop_type": "limit" if truncated else "eos",
+                "stopped_limit": truncated,
+                "stopped_eos": not truncated,
+                # En llama.cpp "truncated" es recorte del prompt por contexto: aqui nunca
+                "truncated": False,
+                "tokens_predicted": len(tokens),
+                "tokens_evaluated": prompt_n,
+                "tokens_cached": 0,
+                "id_slot": id_slot,
+                "timings": {
+                    "prompt_n": prompt_n,
+                    "prompt_ms": prompt_ms,
+                    "predicted_n": len(tokens),
+                    "predicted_ms": predicted_ms,
+                    "predicted_per_second": 1000 * len(tokens) / predicted_ms,
+                },
+            }
+
+        if not body.get("stream"):
+            if delay:
+                time.sleep(delay * len(tokens))
+            self._send_json(200, final("".join(tokens)))
+            return
+
+        # Como llama-server: un chunk HTTP por evento, enviado en cuanto se genera el token
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for tok in tokens:
+                if delay:
+                    time.sleep(delay)
+                self._send_event({"content": tok, "stop": False})
+            self._send_event(final(""))
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Cliente que cancela cerrando la conexion
+            self.close_connection = True
+
+    def _send_event(self, data: Dict[str, Any]):
+        event = b"data: " + json.dumps(data).encode("utf-8") + b"\n\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+        self.wfile.flush()
+
+
+class StubLlamaServer(ThreadingHTTPServer):
+    # Sustituto local del endpoint /completion de llama.cpp para benchmarks y pruebas
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, config: Optional[StubConfig] = None, n_slots: int = 4):
+        super().__init__((host, port), _Handler)
+        self.config = config or StubConfig()
+        self.n_slots = n_slots
+        self.slots = threading.Semaphore(n_slots)
+        self.healthy = True
+        # Tokens en la cache KV de cada slot y volcados por nombre de fichero
+        self.slot_tokens: Dict[int, int] = {}
+        self.saved_slots: Dict[str, int] = {}
+        self.active = 0
+        self.active_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def completion_url(self) -> str:
+        return f"{self.base_url}/completion"
+
+    def start(self) -> "StubLlamaServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Un cliente que cierra una conexion keep-alive (p.ej. client.close()) no es un fallo del stub
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Servidor llama.cpp simulado")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=10000)
+    ap.add_argument("--latency", type=float, default=0.0, help="segundos antes del primer token")
+    ap.add_argument("--tokens-per-s", type=float, default=0.0)
+    ap.add_argument("--malformed-rate", type=float, default=0.0)
+    ap.add_argument("--slots", type=int, default=4)
+    args = ap.parse_args()
+
+    cfg = StubConfig(latency_s=args.latency, tokens_per_s=args.tokens_per_s, malformed_rate=args.malformed_rate)
+    server = StubLlamaServer(args.host, args.port, cfg, n_slots=args.slots)
+    print(f"Stub llama.cpp en {server.completion_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
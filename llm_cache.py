@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class ResponseCache:
+    # Cache de completados direccionada por contenido: LRU en memoria + almacen en disco
+    # con expulsion por tamano. Solo se usa con parametros deterministas salvo force=True.
+
+    def __init__(
+        self,
+        cache_dir: str = os.path.join("outputs", "cache"),
+        *,
+        max_entries: int = 256,
+        max_disk_bytes: int = 64 * 1024 * 1024,
+        force: bool = False,
+    ):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.force = force
+
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._disk_bytes = sum(os.path.getsize(p) for p in self._disk_files())
+
+    @staticmethod
+    def make_key(prompt: str, grammar: str, temperature: float, n_predict: int, seed: Optional[int]) -> str:
+        material = json.dumps([prompt, grammar, round(float(temperature), 4), int(n_predict), seed], ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, temperature: float, seed: Optional[int]) -> bool:
+        # Con temperatura 0 o semilla fija la salida es reproducible
+        return self.force or float(temperature) == 0.0 or (seed is not None and seed >= 0)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, value)
+            return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._remember(key, value)
+        self._write_disk(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _remember(self, key: str, value: str):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _disk_files(self):
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    yield os.path.join(root, name)
+
+    def _read_disk(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f).get("content")
+            # mtime como marca de ultimo uso para la expulsion
+            os.utime(path)
+        except (OSError, ValueError, AttributeError):
+            return None
+        return value if isinstance(value, str) else None
+
+    def _write_disk(self, key: str, value: str):
+        path = self._path(key)
+        tmp = f"{path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"content": value}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+            size = os.path.getsize(path)
+        except OSError:
+            # La cache en disco es opcional: si falla, queda la de memoria
+            return
+
+        with self._lock:
+            self._disk_bytes += size - old_size
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        # Se borran los menos usados hasta bajar al 90% del limite
+        entries = []
+        for path in self._disk_files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        total = sum(size for _mtime, size, _path in entries)
+        target = int(self.max_disk_bytes * 0.9)
+        for _mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+        with self._lock:
+            self._disk_bytes = total
@@ -1,44 +1,335 @@
+import json
 import os
-from typing import Any, Dict, Optional
+import random
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
+from llm_cache import ResponseCache
+from llm_router import Endpoint, EndpointRouter
+from parser import JsonPrefixScanner
+from turn_schema import DEFAULT_SCHEMA, TurnSchema, compile_grammar, describe_schema
 
-class LLMClient:
+# Errores del servidor que suelen ser transitorios (modelo ocupado, proxy, sin slots libres)
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class CancelToken(threading.Event):
+    # Event que al activarse ademas ejecuta los cierres registrados (p.ej. cerrar la respuesta
+    # HTTP en curso): la lectura del stream se corta al momento y llama.cpp libera el slot
     def __init__(self):
+        super().__init__()
+        self._callbacks_lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    def register(self, callback: Callable[[], None]) -> Callable[[], None]:
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._unregister(callback)
+        callback()
+        return lambda: None
+
+    def _unregister(self, callback: Callable[[], None]):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def set(self):
+        with self._callbacks_lock:
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+
+def _connect_failed(e: BaseException) -> bool:
+    # True si la peticion no llego a salir: timeout o rechazo al abrir la conexion.
+    # requests envuelve el error de urllib3 (MaxRetryError.reason) dentro de sus args
+    pending: List[Any] = [e]
+    while pending:
+        err = pending.pop()
+        if isinstance(err, (requests.exceptions.ConnectTimeout, NewConnectionError)):
+            return True
+        if isinstance(err, BaseException):
+            pending.extend(a for a in (*err.args, getattr(err, "reason", None)) if isinstance(a, BaseException))
+    return False
+
+
+def _stop_type(data: Dict[str, Any]) -> str:
+    # llama.cpp reciente manda stop_type; las versiones antiguas, un booleano por motivo
+    stop_type = data.get("stop_type")
+    if isinstance(stop_type, str) and stop_type:
+        return stop_type
+    for key, name in (("stopped_eos", "eos"), ("stopped_word", "word"), ("stopped_limit", "limit")):
+        if data.get(key):
+            return name
+    return "none" if data.get("stop") else ""
+
+
+@dataclass
+class CompletionResult:
+    # Texto de una llamada a /completion junto con la telemetria que devuelve llama.cpp:
+    # prefill (prompt_*) frente a generacion (predicted_*), motivo de parada y slot.
+    # truncated es el de llama.cpp: el prompt no cabia en el contexto y se recorto
+    content: str = ""
+    stop_type: str = ""
+    truncated: bool = False
+    prompt_n: int = 0
+    prompt_ms: float = 0.0
+    predicted_n: int = 0
+    predicted_ms: float = 0.0
+    tokens_cached: Optional[int] = None
+    id_slot: Optional[int] = None
+    continuations: int = 0
+    cached: bool = False
+    base_url: str = ""
+
+    @classmethod
+    def from_response(cls, data: Dict[str, Any], content: str = "", base_url: str = "") -> "CompletionResult":
+        timings = data.get("timings") if isinstance(data.get("timings"), dict) else {}
+        id_slot = data.get("id_slot", data.get("slot_id"))
+        tokens_cached = data.get("tokens_cached")
+        return cls(
+            content=content,
+            stop_type=_stop_type(data),
+            truncated=bool(data.get("truncated")),
+            prompt_n=int(timings.get("prompt_n", data.get("tokens_evaluated", 0)) or 0),
+            prompt_ms=float(timings.get("prompt_ms", 0.0) or 0.0),
+            predicted_n=int(timings.get("predicted_n", data.get("tokens_predicted", 0)) or 0),
+            predicted_ms=float(timings.get("predicted_ms", 0.0) or 0.0),
+            tokens_cached=tokens_cached if isinstance(tokens_cached, int) else None,
+            id_slot=id_slot if isinstance(id_slot, int) else None,
+            base_url=base_url,
+        )
+
+    @property
+    def predicted_per_second(self) -> float:
+        return 1000.0 * self.predicted_n / self.predicted_ms if self.predicted_ms > 0 else 0.0
+
+    @property
+    def prompt_per_second(self) -> float:
+        return 1000.0 * self.prompt_n / self.prompt_ms if self.prompt_ms > 0 else 0.0
+
+    def add_continuation(self, data: Dict[str, Any]):
+        # Una continuacion suma su prefill (el texto parcial) y su generacion; la parada es la suya.
+        # continuations lo fija _settle_continuation (el stream puede cortarse antes del final)
+        more = CompletionResult.from_response(data)
+        self.prompt_n += more.prompt_n
+        self.prompt_ms += more.prompt_ms
+        self.predicted_n += more.predicted_n
+        self.predicted_ms += more.predicted_ms
+        self.stop_type = more.stop_type
+
+    def as_dict(self) -> Dict[str, Any]:
+        # Sin el texto (ya va en raw_response): solo la telemetria, lista para JSON
+        return {
+            "stop_type": self.stop_type,
+            "truncated": self.truncated,
+            "prompt_n": self.prompt_n,
+            "prompt_ms": round(self.prompt_ms, 1),
+            "prompt_per_second": round(self.prompt_per_second, 1),
+            "predicted_n": self.predicted_n,
+            "predicted_ms": round(self.predicted_ms, 1),
+            "predicted_per_second": round(self.predicted_per_second, 2),
+            "tokens_cached": self.tokens_cached,
+            "id_slot": self.id_slot,
+            "continuations": self.continuations,
+            "cached": self.cached,
+            "base_url": self.base_url,
+        }
+
+
+class LLMClient:
+    def __init__(
+        self,
+        *,
+        pool_size: Optional[int] = None,
+        max_retries: Optional[int] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        cache: Optional[ResponseCache] = None,
+        schema: Optional[TurnSchema] = None,
+        router: Optional[EndpointRouter] = None,
+    ):
+        # El esquema del turno genera la gramatica y las reglas del system prompt
+        self.schema = schema or DEFAULT_SCHEMA
         self.completion_url = os.getenv("LLAMA_COMPLETION_URL", "http://localhost:10000/completion")
+
+        # LLAMA_COMPLETION_URLS (separadas por comas): varios servidores llama.cpp tras un router
+        if router is None:
+            urls = [u.strip() for u in os.getenv("LLAMA_COMPLETION_URLS", "").split(",") if u.strip()]
+            if len(urls) > 1:
+                router = EndpointRouter(urls, probe_interval=float(os.getenv("LLAMA_PROBE_INTERVAL", "5")))
+            elif urls:
+                self.completion_url = urls[0]
+        self.router = router
+        if router is not None:
+            self.completion_url = router.endpoints[0].completion_url
+        self.base_url = self.completion_url.rsplit("/completion", 1)[0]
         self.system_prompt = self._build_system_prompt()
         self.grammar = self._build_grammar()
 
+        self.pool_size = pool_size if pool_size is not None else int(os.getenv("LLAMA_POOL_SIZE", "4"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("LLAMA_MAX_RETRIES", "3"))
+        self.connect_timeout = (
+            connect_timeout if connect_timeout is not None else float(os.getenv("LLAMA_CONNECT_TIMEOUT", "5"))
+        )
+        self.read_timeout = read_timeout if read_timeout is not None else float(os.getenv("LLAMA_READ_TIMEOUT", "120"))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # Sesion con keep-alive: reutiliza las conexiones TCP entre turnos
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # LLAMA_CACHE: "on" (solo parametros deterministas), "force" (siempre) u "off"
+        if cache is None:
+            mode = os.getenv("LLAMA_CACHE", "on").lower()
+            if mode in ("on", "force"):
+                cache = ResponseCache(os.getenv("LLAMA_CACHE_DIR", os.path.join("outputs", "cache")), force=mode == "force")
+        self.cache = cache
+
+        # Si la respuesta se corta en n_predict se pide al servidor que siga desde el texto
+        # parcial (reutilizando la cache KV) en vez de regenerar desde cero
+        self.max_continuations = int(os.getenv("LLAMA_MAX_CONTINUATIONS", "1"))
+        self.continue_tokens = int(os.getenv("LLAMA_CONTINUE_TOKENS", "384"))
+        self._truncation_lock = threading.Lock()
+        self._truncation: Dict[str, Any] = {
+            "detected": 0,
+            "continued": 0,
+            "repaired": 0,
+            "lost": 0,
+            "salvaged_tokens": 0,
+            "salvaged_ms": 0.0,
+            "lost_tokens": 0,
+            "lost_ms": 0.0,
+        }
+
+        # Reintentos de la ultima llamada, por hilo (cada turno corre en su propio hilo)
+        self._local = threading.local()
+
+    @property
+    def last_retries(self) -> int:
+        return getattr(self._local, "retries", 0)
+
+    def call_stats(self) -> Dict[str, Any]:
+        # Contadores de la ultima llamada de este hilo, para trasladarlos a otro hilo
+        return {
+            "retries": self.last_retries,
+            "truncation": dict(self.last_truncation),
+            "base_url": self.last_base_url,
+            "result": replace(self.last_result) if self.last_result is not None else None,
+        }
+
+    def adopt_call_stats(self, stats: Dict[str, Any]):
+        self._local.retries = stats.get("retries", 0)
+        self._local.truncation = stats.get("truncation", {})
+        self._local.base_url = stats.get("base_url", self.base_url)
+        self._local.result = stats.get("result")
+
+    @property
+    def last_result(self) -> Optional[CompletionResult]:
+        # Telemetria de la ultima completion de este hilo (tambien en stream); None si no hubo
+        return getattr(self._local, "result", None)
+
+    @property
+    def last_base_url(self) -> str:
+        # Servidor que atendio la ultima llamada de este hilo (con router puede variar)
+        return getattr(self._local, "base_url", self.base_url)
+
+    @property
+    def last_truncation(self) -> Dict[str, Any]:
+        # Vacio si la ultima respuesta de este hilo no se corto; si no, tokens/ms generados,
+        # continuaciones pedidas y si quedo resuelta
+        return getattr(self._local, "truncation", {})
+
+    def count_truncation(self, outcome: str, info: Dict[str, Any]):
+        # outcome: "continued" (completada por el servidor), "repaired" (recuperada por el
+        # parser) o "lost" (turno perdido); se acumulan los tokens/ms generados en cada caso
+        bucket = "lost" if outcome == "lost" else "salvaged"
+        with self._truncation_lock:
+            self._truncation[outcome] += 1
+            self._truncation[f"{bucket}_tokens"] += int(info.get("predicted_n", 0))
+            self._truncation[f"{bucket}_ms"] += float(info.get("predicted_ms", 0.0))
+
+    def truncation_stats(self) -> Dict[str, Any]:
+        with self._truncation_lock:
+            stats = dict(self._truncation)
+        stats["salvaged_ms"] = round(stats["salvaged_ms"], 1)
+        stats["lost_ms"] = round(stats["lost_ms"], 1)
+        return stats
+
+    def _hit_limit(self, result: CompletionResult) -> bool:
+        # truncated no cuenta: en llama.cpp indica que se recorto el prompt, no la respuesta
+        return result.stop_type == "limit"
+
+    def _begin_truncation(self, result: CompletionResult) -> Dict[str, Any]:
+        # Se llama antes de pedir continuaciones: tokens/ms de la generacion que se corto
+        info = {
+            "predicted_n": result.predicted_n,
+            "predicted_ms": round(result.predicted_ms, 1),
+            "continuations": 0,
+            "resolved": False,
+        }
+        with self._truncation_lock:
+            self._truncation["detected"] += 1
+        self._local.truncation = info
+        return info
+
+    def _continuation_payload(self, payload: Dict[str, Any], partial: str) -> Dict[str, Any]:
+        # Mismo prompt + lo ya generado: llama.cpp reutiliza el prefijo de la cache KV.
+        # Sin gramatica: la GBNF solo admite el documento desde su raiz
+        cont = {
+            "prompt": payload["prompt"] + partial,
+            "stream": payload["stream"],
+            "cache_prompt": True,
+            "temperature": payload["temperature"],
+            "n_predict": self.continue_tokens,
+        }
+        if "seed" in payload:
+            cont["seed"] = payload["seed"]
+        return cont
+
+    def _settle_continuation(self, info: Dict[str, Any], scan: JsonPrefixScanner):
+        if self.last_result is not None:
+            self.last_result.continuations = info["continuations"]
+        if scan.end is not None:
+            info["resolved"] = True
+            self.count_truncation("continued", info)
+
+    def close(self):
+        if self.router is not None:
+            self.router.close()
+        self.session.close()
+
     def _build_system_prompt(self) -> str:
         return (
             "Salida JSON estricto\n"
             "Responder solo con un unico JSON valido sin texto extra sin bloques de codigo\n"
-            "Estructura\n"
-            '{ "eventos": [ { "tipo": "narracion", "texto": string }, { "tipo": "dialogo", "nombre": string, "texto": string } ], "opciones": [ string, string ] }\n'
-            "Eventos en orden cronologico alterna lo necesario\n"
-            "Tipos narracion o dialogo\n"
-            "Narracion solo texto dialogo nombre y texto\n"
-            "Opciones 2 a 4 strings coherentes\n"
-            "Sin comillas dobles dentro de textos usar comillas simples o reescribir si imprescindible escapar \\\"\n"
+            + describe_schema(self.schema)
+            + "Sin comillas dobles dentro de textos usar comillas simples o reescribir si imprescindible escapar \\\"\n"
             "Sin comas colgantes nada fuera del JSON\n"
         )
 
     def _build_grammar(self) -> str:
-        return r"""
-root ::= object
-object ::= "{" wsp "\"eventos\"" wsp ":" wsp event_array wsp "," wsp "\"opciones\"" wsp ":" wsp opciones wsp "}"
-event_array ::= "[" wsp evento (wsp "," wsp evento)* wsp "]"
-evento ::= narracion / dialogo
-narracion ::= "{" wsp "\"tipo\"" wsp ":" wsp "\"narracion\"" wsp "," wsp "\"texto\"" wsp ":" wsp string wsp "}"
-dialogo ::= "{" wsp "\"tipo\"" wsp ":" wsp "\"dialogo\"" wsp "," wsp "\"nombre\"" wsp ":" wsp string wsp "," wsp "\"texto\"" wsp ":" wsp string wsp "}"
-opciones ::= "[" wsp opcion_items wsp "]"
-opcion_items ::= string wsp "," wsp string (wsp "," wsp string (wsp "," wsp string)?)?
-string ::= "\"" (escape / safe_char)* "\""
-escape ::= "\\" ["\\/bfnrt\""]
-safe_char ::= ~["\\]
-wsp ::= [ \t\n\r]*
-"""
+        return compile_grammar(self.schema)
 
     def _extract_content(self, data: Dict[str, Any]) -> Optional[str]:
         if isinstance(data.get("content"), str):
@@ -53,22 +344,399 @@ wsp ::= [ \t\n\r]*
                     return text
         return None
 
-    def complete_with_grammar(self, prompt: str, temperature: float = 0.7, max_tokens: int = 260) -> str:
+    def _backoff_delay(self, attempt: int, resp: Optional[requests.Response] = None) -> float:
+        # Si el servidor indica Retry-After se respeta; si no, backoff exponencial con jitter completo
+        if resp is not None:
+            retry_after = resp.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(self.backoff_max, float(retry_after))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _post(
+        self,
+        payload: Dict[str, Any],
+        *,
+        stream: bool = False,
+        path: str = "/completion",
+        record: bool = True,
+        affinity: Optional[str] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> requests.Response:
+        # record=False para llamadas auxiliares que no deben pisar los contadores del turno
+        if record:
+            self._local.retries = 0
+        attempt = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()
+            resp: Optional[requests.Response] = None
+            # Con router cada intento elige nodo: un reintento puede ir a otro servidor
+            ep = self.router.acquire(affinity) if self.router is not None else None
+            base = ep.base_url if ep is not None else self.base_url
+            if record:
+                self._local.base_url = base
+            try:
+                resp = self.session.post(
+                    base + path,
+                    json=payload,
+                    timeout=(self.connect_timeout, self.read_timeout),
+                    stream=stream,
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout) as e:
+                if ep is not None:
+                    self.router.release(ep, error=type(e).__name__)
+                # Solo se repite si no se llego a conectar. Un reset con la peticion ya enviada
+                # puede haber puesto al servidor a generar: repetirla duplicaria la carga
+                if attempt >= self.max_retries or not _connect_failed(e):
+                    raise
+            except Exception:
+                if ep is not None:
+                    self.router.release(ep)
+                raise
+            else:
+                if resp.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                    if ep is not None:
+                        self._release_on_close(resp, ep, stream)
+                    try:
+                        resp.raise_for_status()
+                    except requests.exceptions.HTTPError:
+                        resp.close()
+                        raise
+                    return resp
+                resp.close()
+                if ep is not None:
+                    self.router.release(ep)
+
+            delay = self._backoff_delay(attempt, resp)
+            if cancel is not None:
+                cancel.wait(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+            if record:
+                self._local.retries = attempt
+
+    def _release_on_close(self, resp: requests.Response, ep: Endpoint, stream: bool):
+        # Sin stream el cuerpo ya esta leido; con stream el nodo sigue ocupado hasta cerrar
+        if not stream:
+            self.router.release(ep)
+            return
+        close = resp.close
+        released = []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.router.release(ep)
+
+        resp.close = close_and_release
+
+    def build_full_prompt(self, prompt: str) -> str:
+        # Sin strip(): el prefijo (system prompt + plantilla) debe ser identico byte a byte
+        # entre turnos para que llama.cpp reutilice la cache KV
+        return f"{self.system_prompt}\n\n{prompt}"
+
+    def _build_payload(
+        self,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        stream: bool,
+        seed: Optional[int] = None,
+        sampling: Optional[Dict[str, Any]] = None,
+        id_slot: Optional[int] = None,
+    ) -> Dict[str, Any]:
         payload = {
-            "prompt": f"{self.system_prompt}\n\n{prompt.strip()}",
+            "prompt": self.build_full_prompt(prompt),
             "grammar": self.grammar,
-            "stream": False,
+            "stream": stream,
+            "cache_prompt": True,
             "temperature": float(temperature),
             "n_predict": int(max_tokens),
         }
+        if seed is not None:
+            payload["seed"] = int(seed)
+        if id_slot is not None:
+            # Fija el slot (p.ej. el recien restaurado); por defecto llama.cpp elige el mas parecido
+            payload["id_slot"] = int(id_slot)
+        if sampling:
+            # Parametros extra de muestreo de llama.cpp (repeat_penalty, top_p, ...)
+            payload.update(sampling)
+        return payload
 
-        resp = requests.post(self.completion_url, json=payload, timeout=120)
-        resp.raise_for_status()
+    def _cache_key(self, payload: Dict[str, Any], sampling: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        if self.cache is None or sampling or not self.cache.is_cacheable(payload["temperature"], payload.get("seed")):
+            return None
+        return self.cache.make_key(
+            payload["prompt"], payload["grammar"], payload["temperature"], payload["n_predict"], payload.get("seed")
+        )
 
+    def _cached(self, key: Optional[str]) -> Optional[str]:
+        if key is None or self.cache is None:
+            return None
+        content = self.cache.get(key)
+        if content is not None:
+            # Un acierto no trae truncado: no debe quedar el de la llamada anterior de este hilo
+            self._local.retries = 0
+            self._local.truncation = {}
+            self._local.result = CompletionResult(content=content, cached=True)
+        return content
+
+    def complete(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 260,
+        seed: Optional[int] = None,
+        affinity: Optional[str] = None,
+        id_slot: Optional[int] = None,
+    ) -> CompletionResult:
+        # affinity: clave de sesion para que el router repita nodo (y su cache de prompt)
+        payload = self._build_payload(prompt, temperature, max_tokens, stream=False, seed=seed, id_slot=id_slot)
+        key = self._cache_key(payload)
+        if self._cached(key) is not None:
+            return self._local.result
+
+        self._local.truncation = {}
+        self._local.result = None
+        resp = self._post(payload, affinity=affinity)
         data = resp.json()
+        if not isinstance(data, dict) or not isinstance(self._extract_content(data), str):
+            raise ValueError("La respuesta del servidor de Llama no contiene texto utilizable.")
+        result = CompletionResult.from_response(data, base_url=self.last_base_url)
+        self._local.result = result
         content = self._extract_content(data)
 
+        if self._hit_limit(result):
+            content = self._continue(payload, content, result, affinity)
+
+        result.content = content.strip()
+        if key is not None and self.cache is not None:
+            self.cache.put(key, result.content)
+        return result
+
+    def complete_with_grammar(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 260,
+        seed: Optional[int] = None,
+        affinity: Optional[str] = None,
+        id_slot: Optional[int] = None,
+    ) -> str:
+        return self.complete(prompt, temperature, max_tokens, seed, affinity, id_slot).content
+
+    def _continue(
+        self,
+        payload: Dict[str, Any],
+        content: str,
+        result: CompletionResult,
+        affinity: Optional[str] = None,
+    ) -> str:
+        scan = JsonPrefixScanner()
+        scan.feed(content)
+        if not scan.truncated:
+            return content
+        info = self._begin_truncation(result)
+        while scan.end is None and info["continuations"] < self.max_continuations:
+            info["continuations"] += 1
+            more_data = self._post(
+                self._continuation_payload(payload, content), record=False, affinity=affinity
+            ).json()
+            more = self._extract_content(more_data) if isinstance(more_data, dict) else None
+            if not more:
+                break
+            result.add_continuation(more_data)
+            content += more
+            end = scan.feed(more)
+            if end is not None:
+                # Lo que venga tras cerrar el objeto raiz (sin gramatica) se descarta
+                content = content[:end]
+        self._settle_continuation(info, scan)
+        return content
+
+    def complete_plain(self, prompt: str, temperature: float = 0.3, max_tokens: int = 256) -> str:
+        # Completado libre (sin gramatica ni system prompt JSON), p.ej. para resumenes
+        payload = {
+            "prompt": prompt,
+            "stream": False,
+            "temperature": float(temperature),
+            "n_predict": int(max_tokens),
+        }
+        data = self._post(payload, record=False).json()
+        content = self._extract_content(data) if isinstance(data, dict) else None
         if not isinstance(content, str):
             raise ValueError("La respuesta del servidor de Llama no contiene texto utilizable.")
-
         return content.strip()
+
+    def warm_up(self, prompt: str, affinity: Optional[str] = None) -> Dict[str, Any]:
+        # Evalua el prompt sin generar nada (n_predict 0) para que quede en la cache del servidor.
+        # Pasa por _post: si el modelo aun esta cargando (503) se reintenta con backoff
+        payload = {
+            "prompt": self.build_full_prompt(prompt),
+            "stream": False,
+            "cache_prompt": True,
+            "n_predict": 0,
+        }
+        data = self._post(payload, record=False, affinity=affinity).json()
+        result = CompletionResult.from_response(data if isinstance(data, dict) else {})
+        return {"prompt_n": result.prompt_n, "prompt_ms": round(result.prompt_ms, 1)}
+
+    def slot_action(
+        self,
+        action: str,
+        id_slot: int,
+        filename: str,
+        base_url: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        # action "save"/"restore": vuelca o recarga la cache KV de un slot en el disco del servidor
+        # (llama-server --slot-save-path; sin el responde 501). filename sin rutas
+        resp = self.session.post(
+            f"{base_url or self.base_url}/slots/{int(id_slot)}",
+            params={"action": action},
+            json={"filename": filename},
+            timeout=(self.connect_timeout, timeout if timeout is not None else self.read_timeout),
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        return data if isinstance(data, dict) else {}
+
+    def count_tokens(self, text: str) -> int:
+        # Cuenta exacta via /tokenize; si el servidor no responde se estima (~4 caracteres/token)
+        try:
+            resp = self._post({"content": text}, path="/tokenize", record=False)
+            tokens = resp.json().get("tokens")
+            if isinstance(tokens, list):
+                return len(tokens)
+        except (requests.exceptions.RequestException, ValueError, AttributeError):
+            pass
+        return len(text) // 4 + 1
+
+    def stream_with_grammar(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 260,
+        seed: Optional[int] = None,
+        cancel: Optional[threading.Event] = None,
+        affinity: Optional[str] = None,
+        sampling: Optional[Dict[str, Any]] = None,
+        id_slot: Optional[int] = None,
+        cache: bool = True,
+    ) -> Iterator[str]:
+        # Consume el stream SSE de llama.cpp ("data: {...}") y va entregando los fragmentos de texto.
+        # Si se activa cancel se cierra la conexion y llama.cpp deja de generar.
+        # cache=False: ni se consulta ni se escribe la cache local (p.ej. semillas aleatorias)
+        payload = self._build_payload(
+            prompt, temperature, max_tokens, stream=True, seed=seed, sampling=sampling, id_slot=id_slot
+        )
+        key = self._cache_key(payload, sampling) if cache else None
+        cached = self._cached(key)
+        if cached is not None:
+            yield cached
+            return
+
+        self._local.truncation = {}
+        self._local.result = None
+        parts = []
+        result: Optional[CompletionResult] = None
+        try:
+            resp = self._post(payload, stream=True, affinity=affinity, cancel=cancel)
+        except RequestCancelled:
+            return
+        with resp:
+            for data in self._iter_sse(resp, cancel):
+                content = self._extract_content(data)
+                if content:
+                    parts.append(content)
+                    yield content
+                if data.get("stop"):
+                    # El ultimo evento del stream trae los timings
+                    result = CompletionResult.from_response(data, base_url=self.last_base_url)
+                    self._local.result = result
+                    break
+
+        if result is not None and self._hit_limit(result):
+            yield from self._continue_stream(payload, parts, result, cancel, affinity)
+        if result is not None:
+            result.content = "".join(parts).strip()
+        if cancel is not None and cancel.is_set():
+            return
+
+        if result is not None and key is not None and self.cache is not None:
+            self.cache.put(key, "".join(parts).strip())
+
+    def _iter_sse(self, resp: requests.Response, cancel: Optional[threading.Event] = None) -> Iterator[Dict[str, Any]]:
+        # Con un CancelToken la respuesta se cierra desde el hilo que cancela; la lectura
+        # bloqueada falla entonces con un error de socket que aqui se trata como fin del stream
+        unregister = cancel.register(resp.close) if isinstance(cancel, CancelToken) else None
+        try:
+            for line in resp.iter_lines():
+                if cancel is not None and cancel.is_set():
+                    return
+                if not line or not line.startswith(b"data:"):
+                    continue
+                body = line[len(b"data:") :].strip()
+                if body == b"[DONE]":
+                    return
+                try:
+                    data = json.loads(body)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(data, dict):
+                    yield data
+        except Exception:
+            if cancel is None or not cancel.is_set():
+                raise
+        finally:
+            if unregister is not None:
+                unregister()
+
+    def _continue_stream(
+        self,
+        payload: Dict[str, Any],
+        parts: List[str],
+        result: CompletionResult,
+        cancel: Optional[threading.Event] = None,
+        affinity: Optional[str] = None,
+    ) -> Iterator[str]:
+        # Igual que _continue pero entregando los fragmentos nuevos segun llegan;
+        # al cerrarse el objeto raiz se corta la conexion (el servidor deja de generar)
+        scan = JsonPrefixScanner()
+        scan.feed("".join(parts))
+        if not scan.truncated:
+            return
+        info = self._begin_truncation(result)
+        offset = sum(len(p) for p in parts)
+        while scan.end is None and info["continuations"] < self.max_continuations:
+            info["continuations"] += 1
+            got = False
+            cont = self._continuation_payload(payload, "".join(parts))
+            try:
+                resp = self._post(cont, stream=True, record=False, affinity=affinity, cancel=cancel)
+            except RequestCancelled:
+                return
+            with resp:
+                for data in self._iter_sse(resp, cancel):
+                    content = self._extract_content(data)
+                    if content:
+                        got = True
+                        end = scan.feed(content)
+                        if end is not None:
+                            content = content[: end - offset]
+                        offset += len(content)
+                        if content:
+                            parts.append(content)
+                            yield content
+                        if end is not None:
+                            break
+                    if data.get("stop"):
+                        result.add_continuation(data)
+                        break
+            if not got:
+                break
+        self._settle_continuation(info, scan)
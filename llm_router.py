@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import requests
+
+
+class Endpoint:
+    def __init__(self, completion_url: str):
+        self.completion_url = completion_url
+        self.base_url = completion_url.rsplit("/completion", 1)[0]
+        self.healthy = True
+        self.outstanding = 0
+        self.n_slots: Optional[int] = None
+        self.idle_slots: Optional[int] = None
+        self.failures = 0
+        self.requests = 0
+        self.last_error = ""
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.completion_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "n_slots": self.n_slots,
+            "idle_slots": self.idle_slots,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class EndpointRouter:
+    # Reparte las peticiones entre varios servidores llama.cpp: el de menos peticiones en
+    # vuelo, salvo que el que ya tiene en cache el prefijo de la sesion no vaya mucho peor.
+    # Un hilo de fondo sondea /health y /slots; los nodos caidos salen de la rotacion.
+    def __init__(
+        self,
+        completion_urls: List[str],
+        *,
+        probe_interval: float = 5.0,
+        probe_timeout: float = 2.0,
+        max_failures: int = 2,
+        affinity_slack: int = 1,
+        max_affinity_keys: int = 1024,
+    ):
+        if not completion_urls:
+            raise ValueError("EndpointRouter necesita al menos un endpoint")
+        self.endpoints = [Endpoint(url) for url in completion_urls]
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.max_failures = max_failures
+        self.affinity_slack = affinity_slack
+        self.max_affinity_keys = max_affinity_keys
+
+        self._lock = threading.Lock()
+        self._affinity: "OrderedDict[str, Endpoint]" = OrderedDict()
+        self._rr = 0
+        self.affinity_hits = 0
+
+        self._http = requests.Session()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if probe_interval > 0:
+            self._thread = threading.Thread(target=self._probe_loop, name="llm-router-probe", daemon=True)
+            self._thread.start()
+
+    def acquire(self, affinity: Optional[str] = None) -> Endpoint:
+        with self._lock:
+            # Si no queda ningun nodo sano se prueba con todos antes que fallar sin intentarlo
+            pool = [ep for ep in self.endpoints if ep.healthy] or self.endpoints
+            least = min(ep.outstanding for ep in pool)
+
+            chosen: Optional[Endpoint] = None
+            if affinity is not None:
+                ep = self._affinity.get(affinity)
+                if ep is not None and ep in pool and ep.outstanding <= least + self.affinity_slack:
+                    chosen = ep
+                    self.affinity_hits += 1
+
+            if chosen is None:
+                candidates = [ep for ep in pool if ep.outstanding == least]
+                # Desempate: mas slots libres segun el ultimo sondeo y luego round-robin
+                candidates.sort(key=lambda ep: -(ep.idle_slots or 0))
+                best = [ep for ep in candidates if (ep.idle_slots or 0) == (candidates[0].idle_slots or 0)]
+                chosen = best[self._rr % len(best)]
+                self._rr += 1
+
+            if affinity is not None:
+                self._affinity[affinity] = chosen
+                self._affinity.move_to_end(affinity)
+                while len(self._affinity) > self.max_affinity_keys:
+                    self._affinity.popitem(last=False)
+
+            chosen.outstanding += 1
+            chosen.requests += 1
+            return chosen
+
+    def bind(self, affinity: str, base_url: str) -> bool:
+        # Asocia la sesion a un nodo concreto (p.ej. donde se acaba de restaurar su cache KV)
+        with self._lock:
+            for ep in self.endpoints:
+                if ep.base_url == base_url.rstrip("/"):
+                    self._affinity[affinity] = ep
+                    self._affinity.move_to_end(affinity)
+                    return True
+        return False
+
+    def release(self, ep: Endpoint, *, error: str = ""):
+        # error: fallo de conexion/servidor; tras max_failures seguidos el nodo sale de la rotacion
+        with self._lock:
+            ep.outstanding = max(0, ep.outstanding - 1)
+            if error:
+                ep.failures += 1
+                ep.last_error = error
+                if ep.failures >= self.max_failures:
+                    ep.healthy = False
+            else:
+                ep.failures = 0
+
+    def probe(self):
+        for ep in self.endpoints:
+            healthy, n_slots, idle, error = self._probe_one(ep)
+            with self._lock:
+                ep.healthy = healthy
+                if healthy:
+                    ep.failures = 0
+                else:
+                    ep.last_error = error
+                if n_slots is not None:
+                    ep.n_slots, ep.idle_slots = n_slots, idle
+
+    def _probe_one(self, ep: Endpoint):
+        try:
+            # llama.cpp responde 503 mientras carga el modelo
+            resp = self._http.get(f"{ep.base_url}/health", timeout=self.probe_timeout)
+            if resp.status_code != 200:
+                return False, None, None, f"/health {resp.status_code}"
+        except requests.exceptions.RequestException as e:
+            return False, None, None, f"/health {type(e).__name__}"
+
+        try:
+            # /slots puede estar desactivado (--no-slots): no es motivo para sacar el nodo
+            resp = self._http.get(f"{ep.base_url}/slots", timeout=self.probe_timeout)
+            slots = resp.json() if resp.status_code == 200 else None
+        except (requests.exceptions.RequestException, ValueError):
+            slots = None
+        if not isinstance(slots, list):
+            return True, None, None, ""
+        idle = sum(1 for s in slots if isinstance(s, dict) and not s.get("is_processing", s.get("state", 0) != 0))
+        return True, len(slots), idle, ""
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            t0 = time.perf_counter()
+            self.probe()
+            self._stop.wait(max(0.0, self.probe_interval - (time.perf_counter() - t0)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "endpoints": [ep.snapshot() for ep in self.endpoints],
+                "affinity_keys": len(self._affinity),
+                "affinity_hits": self.affinity_hits,
+            }
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.probe_timeout + 1)
+        self._http.close()
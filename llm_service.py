@@ -1,16 +1,451 @@
-from llm_client import LLMClient
+import hashlib
+import os
+import queue
+import random
+import threading
+import uuid
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from llm_client import CancelToken, LLMClient, RequestCancelled
+from memory import ConversationMemory
+from parser import ResponseParser
+from stream_guard import GenerationGuard, GuardTripped
+
+# La memoria de la partida se inserta justo antes de esta linea de la plantilla
+USER_MARKER = "Entrada del usuario:"
 
 
 class LLMService:
-    def __init__(self, prompt_path: str = "prompts/predefined_prompt.txt"):
-        self.client = LLMClient()
+    def __init__(
+        self,
+        prompt_path: str = "prompts/predefined_prompt.txt",
+        *,
+        memory_tokens: int = 1200,
+        client: Optional[LLMClient] = None,
+        candidates: Optional[int] = None,
+        guard: Optional[bool] = None,
+        memory_gate: Optional[Callable[[], ContextManager[Any]]] = None,
+    ):
+        # Se puede compartir un cliente (y su pool de conexiones) entre varias sesiones
+        self.client = client or LLMClient()
         self.prompt_path = prompt_path
+        self.parser = ResponseParser(self.client.schema)
+        # Clave de afinidad: con varios servidores, los turnos de esta partida van al mismo
+        # nodo mientras no este mucho mas cargado (su cache KV ya tiene nuestro prefijo)
+        self.affinity_key = uuid.uuid4().hex[:12]
+
+        # LLAMA_CANDIDATES > 1: cada turno lanza K generaciones en paralelo (slots de llama.cpp,
+        # semillas distintas) y se queda con la primera que pasa validate_new_format
+        if candidates is None:
+            candidates = int(os.getenv("LLAMA_CANDIDATES", "1"))
+        self.candidates = max(1, candidates)
+        self._candidate_lock = threading.Lock()
+        self._candidate_counts = {"turns": 0, "won": 0, "all_invalid": 0, "cancelled": 0, "failed": 0}
+        self._local = threading.local()
+
+        # LLAMA_GUARD=on: corta generaciones degeneradas (repeticion, eco de las instrucciones,
+        # sin progreso) y las reintenta LLAMA_GUARD_RETRIES veces con el muestreo ajustado
+        if guard is None:
+            guard = os.getenv("LLAMA_GUARD", "off").lower() == "on"
+        self.guard = guard
+        self.guard_retries = int(os.getenv("LLAMA_GUARD_RETRIES", "1"))
+        self._guard_counts: Dict[str, int] = {"tripped": 0, "retried": 0, "aborted": 0, "tokens_saved": 0}
+
+        # memory_tokens=0 desactiva la memoria (cada turno va solo con la plantilla).
+        # memory_gate: envuelve el trabajo de fondo de la memoria (ver ConversationMemory)
+        self.memory: Optional[ConversationMemory] = (
+            ConversationMemory(self.client, token_budget=memory_tokens, gate=memory_gate) if memory_tokens > 0 else None
+        )
+
+        # Plantilla cacheada en memoria; se recarga solo si cambia su mtime
+        self._template = ""
+        self._template_mtime: Optional[int] = None
+        self._template_lock = threading.Lock()
+        # Huella corta de la plantilla: permite comparar metricas entre revisiones del prompt
+        self.prompt_revision = ""
+
+        # Slot de llama.cpp (y servidor) del ultimo turno recordado: es el que se vuelca a disco
+        # al guardar la partida. Tras restaurar uno, el siguiente turno se fija a ese slot
+        self._slot_lock = threading.Lock()
+        self.last_slot: Dict[str, Any] = {}
+        self._slot_hint: Optional[int] = None
+
+    def load_template(self) -> str:
+        mtime = os.stat(self.prompt_path).st_mtime_ns
+        with self._template_lock:
+            if mtime != self._template_mtime:
+                with open(self.prompt_path, "r", encoding="utf-8") as f:
+                    self._template = f.read()
+                self._template_mtime = mtime
+                self.prompt_revision = hashlib.sha1(self._template.encode("utf-8")).hexdigest()[:8]
+            return self._template
 
     def build_prompt(self, user_input: str) -> str:
-        with open(self.prompt_path, "r", encoding="utf-8") as f:
-            predefined_prompt = f.read()
-        return f"{predefined_prompt}{user_input}"
+        # Prefijo estatico (plantilla) intacto + memoria + entrada del usuario al final
+        template = self.load_template()
+        history = self.memory.render() if self.memory else ""
+        if not history:
+            return f"{template}{user_input.strip()}"
+
+        head, marker, tail = template.rpartition(USER_MARKER)
+        if not marker:
+            return f"{template}{history}{user_input.strip()}"
+        return f"{head}{history}{marker}{tail}{user_input.strip()}"
+
+    def warm_up(self) -> Dict[str, Any]:
+        # Precalienta el servidor con el prefijo exacto del proximo turno (plantilla + memoria):
+        # el primer turno solo tiene que evaluar la entrada del usuario
+        return self.client.warm_up(self.build_prompt(""), affinity=self.affinity_key)
+
+    def _condense(self, data: Dict[str, Any]) -> str:
+        # Version compacta de la respuesta para la memoria (sin JSON ni opciones)
+        parts = []
+        for ev in data.get("eventos", []):
+            if ev.get("tipo") == "dialogo":
+                parts.append(f"{ev.get('nombre', '')}: {ev.get('texto', '')}")
+            else:
+                parts.append(ev.get("texto", ""))
+        return " ".join(p.strip() for p in parts if p.strip())
+
+    def remember(self, user_input: str, raw: str):
+        # Solo se recuerdan los turnos validos: la basura en la memoria empeora los siguientes
+        if self.memory is None:
+            return
+        outcome = self.parser.parse(raw)
+        if outcome.parse_ok and outcome.format_ok and outcome.data:
+            self.memory.add_turn(user_input, self._condense(outcome.data))
+            self._note_slot()
+
+    def _note_slot(self):
+        # Se llama en el hilo del turno: la telemetria del cliente es por hilo
+        result = self.client.last_result
+        if result is not None and result.id_slot is not None:
+            with self._slot_lock:
+                self.last_slot = {"base_url": result.base_url or self.client.base_url, "id_slot": result.id_slot}
+
+    def _take_slot_hint(self) -> Optional[int]:
+        with self._slot_lock:
+            id_slot, self._slot_hint = self._slot_hint, None
+        return id_slot
+
+    def snapshot(self) -> Dict[str, Any]:
+        # Estado de la partida para guardarla (la cache KV va aparte, ver save_slot)
+        return {
+            "affinity_key": self.affinity_key,
+            "prompt_rev": self.prompt_revision,
+            "memory": self.memory.snapshot() if self.memory is not None else None,
+        }
+
+    def restore(self, state: Dict[str, Any]):
+        # Misma clave de afinidad: el router vuelve a mandar la partida al mismo nodo
+        self.affinity_key = str(state.get("affinity_key") or self.affinity_key)
+        if self.memory is not None:
+            if state.get("memory"):
+                self.memory.restore(state["memory"])
+            else:
+                self.memory.clear()
+
+    def save_slot(self, filename: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        # Vuelca a disco (del servidor) la cache KV del slot del ultimo turno. {} si no hay slot
+        # conocido; errores HTTP/de red se propagan (p.ej. 501 sin --slot-save-path).
+        # timeout: limite de lectura en segundos (por defecto el del cliente)
+        with self._slot_lock:
+            slot = dict(self.last_slot)
+        if not slot:
+            return {}
+        self.load_template()
+        data = self.client.slot_action("save", slot["id_slot"], filename, slot["base_url"], timeout=timeout)
+        timings = data.get("timings") if isinstance(data.get("timings"), dict) else {}
+        return {
+            **slot,
+            "filename": filename,
+            "prompt_rev": self.prompt_revision,
+            "n_saved": data.get("n_saved"),
+            "save_ms": round(float(timings.get("save_ms", 0.0) or 0.0), 1),
+        }
+
+    def restore_slot(self, info: Dict[str, Any]) -> Dict[str, Any]:
+        # Recarga la cache KV guardada con save_slot; el siguiente turno ya no repite el prefill.
+        # Con otra revision de la plantilla el prefijo no coincidiria: no merece la pena
+        self.load_template()
+        if info.get("prompt_rev") != self.prompt_revision:
+            raise ValueError("la plantilla del prompt ha cambiado desde que se guardo la partida")
+        base_url = info.get("base_url") or self.client.base_url
+        data = self.client.slot_action("restore", info["id_slot"], info["filename"], base_url)
+        if self.client.router is not None:
+            self.client.router.bind(self.affinity_key, base_url)
+        with self._slot_lock:
+            self.last_slot = {"base_url": base_url, "id_slot": info["id_slot"]}
+            self._slot_hint = info["id_slot"]
+        timings = data.get("timings") if isinstance(data.get("timings"), dict) else {}
+        return {
+            "n_restored": data.get("n_restored"),
+            "restore_ms": round(float(timings.get("restore_ms", 0.0) or 0.0), 1),
+        }
+
+    def _settle_truncation(self, raw: str):
+        # Respuesta cortada que el servidor no pudo completar: cuenta si el parser la salva
+        info = self.client.last_truncation
+        if not info or info.get("resolved"):
+            return
+        outcome = self.parser.parse(raw)
+        self.client.count_truncation("repaired" if outcome.repaired else "lost", info)
 
-    def chat(self, user_input: str, temperature: float = 0.7, max_tokens: int = 1024) -> str:
+    @property
+    def last_guard(self) -> Dict[str, Any]:
+        # Ultimo disparo del guard en este hilo: motivo, tokens generados e intento
+        return getattr(self._local, "guard", {})
+
+    def guard_stats(self) -> Dict[str, int]:
+        with self._candidate_lock:
+            return dict(self._guard_counts)
+
+    def _echo_reference(self) -> str:
+        # El eco se mide solo contra lo estatico (system prompt + plantilla): la memoria y la
+        # entrada del jugador se pueden citar con normalidad en la respuesta
+        return f"{self.client.system_prompt}\n\n{self.load_template()}"
+
+    def _guarded_stream(
+        self,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        seed: Optional[int],
+        cancel: Optional[CancelToken],
+        on_restart: Optional[Callable[[str], None]] = None,
+        id_slot: Optional[int] = None,
+        cache: bool = True,
+    ) -> Iterator[str]:
+        # Sin on_restart no se reintenta: quien consume el stream no sabria que empieza de nuevo.
+        # cache=False: la semilla no es reproducible y la respuesta no se guarda en la cache local
+        retries = self.guard_retries if on_restart is not None else 0
+        sampling: Optional[Dict[str, Any]] = None
+        attempt = 0
+        while True:
+            inner = CancelToken()
+            unregister = cancel.register(inner.set) if cancel is not None else None
+            guard = GenerationGuard(self._echo_reference(), self.parser) if self.guard else None
+            stream = self.client.stream_with_grammar(
+                prompt,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                seed=seed,
+                cancel=inner,
+                affinity=self.affinity_key,
+                sampling=sampling,
+                id_slot=id_slot,
+                cache=cache,
+            )
+            try:
+                for piece in stream:
+                    if guard is not None and guard.feed(piece):
+                        # Cierra la conexion: llama.cpp deja de generar en el acto
+                        inner.set()
+                        break
+                    yield piece
+            finally:
+                stream.close()
+                if unregister is not None:
+                    unregister()
+
+            if guard is None or not guard.reason or (cancel is not None and cancel.is_set()):
+                return
+            attempt += 1
+            self._local.guard = {"reason": guard.reason, "tokens": guard.tokens, "attempt": attempt}
+            with self._candidate_lock:
+                self._guard_counts["tripped"] += 1
+                self._guard_counts["tokens_saved"] += max(0, max_tokens - guard.tokens)
+                self._guard_counts["retried" if attempt <= retries else "aborted"] += 1
+            if attempt > retries:
+                raise GuardTripped(guard.reason, guard.tokens)
+
+            # Reintento: otra semilla, algo mas de temperatura y penalizacion de repeticiones
+            temperature = min(1.2, temperature + 0.15)
+            seed = None if seed is None else seed + attempt
+            sampling = {"repeat_penalty": 1.18, "repeat_last_n": 256}
+            on_restart(guard.reason)
+
+    @property
+    def last_candidates(self) -> Dict[str, Any]:
+        # Resumen de la ultima carrera de candidatos de este hilo (vacio con K=1)
+        return getattr(self._local, "candidates", {})
+
+    def candidate_stats(self) -> Dict[str, int]:
+        with self._candidate_lock:
+            return dict(self._candidate_counts)
+
+    def _run_candidate(
+        self,
+        index: int,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        seed: int,
+        cancel: threading.Event,
+        results: "queue.Queue[Tuple[int, Optional[str], Any, Dict[str, Any]]]",
+        cache: bool,
+    ):
+        try:
+            parts = []
+            for piece in self._guarded_stream(prompt, temperature, max_tokens, seed, cancel, cache=cache):
+                parts.append(piece)
+            if cancel.is_set():
+                results.put((index, None, None, {}))
+                return
+            raw = "".join(parts).strip()
+            results.put((index, raw, self.parser.parse(raw), self.client.call_stats()))
+        except Exception as e:
+            results.put((index, None, e, {}))
+
+    def _race_candidates(
+        self,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        seed: Optional[int],
+        outer: Optional[CancelToken] = None,
+    ) -> str:
+        # Las K candidatas se validan segun terminan; la primera valida gana y el resto se cancela
+        k = self.candidates
+        # Semillas aleatorias: cada carrera usa otras, asi que sus respuestas nunca se volverian
+        # a pedir y no se guardan en la cache local (con semilla del llamador si se repiten)
+        base = seed if seed is not None else random.randrange(2**31)
+        cancel = CancelToken()
+        unregister = outer.register(cancel.set) if outer is not None else None
+        results: "queue.Queue[Tuple[int, Optional[str], Any, Dict[str, Any]]]" = queue.Queue()
+        for i in range(k):
+            threading.Thread(
+                target=self._run_candidate,
+                args=(i, prompt, temperature, max_tokens, base + i, cancel, results, seed is not None),
+                daemon=True,
+            ).start()
+
+        first: Optional[Tuple[int, str, Dict[str, Any]]] = None
+        errors: List[Exception] = []
+        winner: Optional[Tuple[int, str, Dict[str, Any]]] = None
+        completed = 0
+        for _ in range(k):
+            index, raw, outcome, call_stats = results.get()
+            completed += 1
+            if raw is None:
+                if isinstance(outcome, Exception):
+                    errors.append(outcome)
+                continue
+            if first is None:
+                first = (index, raw, call_stats)
+            if outcome.parse_ok and outcome.format_ok and not outcome.repaired:
+                winner = (index, raw, call_stats)
+                break
+        cancel.set()
+        if unregister is not None:
+            unregister()
+        if outer is not None and outer.is_set():
+            raise RequestCancelled()
+
+        with self._candidate_lock:
+            self._candidate_counts["turns"] += 1
+            self._candidate_counts["cancelled"] += k - completed
+            self._candidate_counts["failed"] += len(errors)
+            if winner is not None:
+                self._candidate_counts["won"] += 1
+            elif first is not None:
+                self._candidate_counts["all_invalid"] += 1
+
+        chosen = winner or first
+        if chosen is None:
+            raise errors[0]
+        index, raw, call_stats = chosen
+        # Los contadores del cliente son por hilo: se trasladan los de la candidata elegida
+        self.client.adopt_call_stats(call_stats)
+        self._local.candidates = {
+            "k": k,
+            "winner": index if winner is not None else None,
+            "completed": completed,
+            "seed": base + index,
+        }
+        return raw
+
+    def chat(
+        self,
+        user_input: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        seed: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+        remember: bool = True,
+    ) -> str:
+        # cancel: al activarse se corta la generacion en el servidor y se lanza RequestCancelled.
+        # remember=False genera sin tocar la memoria (p.ej. respuestas especulativas)
         prompt = self.build_prompt(user_input)
-        return self.client.complete_with_grammar(prompt, temperature=temperature, max_tokens=max_tokens)
+        self._local.candidates = {}
+        self._local.guard = {}
+        if self.candidates > 1:
+            raw = self._race_candidates(prompt, temperature, max_tokens, seed, cancel)
+            return self._finish(user_input, raw, remember)
+        # Las especulativas no consumen el slot recien restaurado
+        id_slot = self._take_slot_hint() if remember else None
+        if cancel is not None or self.guard:
+            # Solo una respuesta en stream se puede abortar a mitad
+            parts: List[str] = []
+            for piece in self._guarded_stream(
+                prompt, temperature, max_tokens, seed, cancel, lambda _r: parts.clear(), id_slot
+            ):
+                parts.append(piece)
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()
+            raw = "".join(parts).strip()
+        else:
+            raw = self.client.complete_with_grammar(
+                prompt,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                seed=seed,
+                affinity=self.affinity_key,
+                id_slot=id_slot,
+            )
+        return self._finish(user_input, raw, remember)
+
+    def _finish(self, user_input: str, raw: str, remember: bool) -> str:
+        self._settle_truncation(raw)
+        if remember:
+            self.remember(user_input, raw)
+        return raw
+
+    def chat_stream(
+        self,
+        user_input: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        seed: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+        remember: bool = True,
+        on_restart: Optional[Callable[[str], None]] = None,
+    ) -> Iterator[str]:
+        # on_restart(motivo): el guard aborto la generacion y lo que sigue es un reintento desde cero
+        if self.candidates > 1:
+            # Con varias candidatas no hay un unico stream que mostrar: se entrega la ganadora entera
+            yield self.chat(
+                user_input, temperature=temperature, max_tokens=max_tokens, seed=seed, cancel=cancel, remember=remember
+            )
+            return
+
+        prompt = self.build_prompt(user_input)
+        self._local.candidates = {}
+        self._local.guard = {}
+        parts: List[str] = []
+
+        def restart(reason: str):
+            parts.clear()
+            if on_restart is not None:
+                on_restart(reason)
+
+        id_slot = self._take_slot_hint() if remember else None
+        for piece in self._guarded_stream(
+            prompt, temperature, max_tokens, seed, cancel, restart if on_restart is not None else None, id_slot
+        ):
+            parts.append(piece)
+            yield piece
+        if cancel is not None and cancel.is_set():
+            # Turno abandonado: no cuenta para la memoria
+            raise RequestCancelled()
+        self._finish(user_input, "".join(parts).strip(), remember)
@@ -1,27 +1,347 @@
+import glob
+import gzip
+import json
 import os
+import queue
+import re
+import shutil
+import threading
+import time
 from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+_BLOCK_RE = re.compile(r"^----- (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) -----$")
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+FSYNC_POLICIES = ("always", "interval", "never")
+
+_STOP = object()
+
+
+def turn_shape(data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # Lo que analytics necesita de la respuesta (numero de eventos/opciones y quien habla):
+    # se guarda con el turno para no tener que volver a decodificar raw_response al analizar
+    eventos = data.get("eventos") if isinstance(data, dict) else None
+    opciones = data.get("opciones") if isinstance(data, dict) else None
+    dialogo = [
+        [ev["nombre"].strip(), len(ev.get("texto") or "")]
+        for ev in (eventos if isinstance(eventos, list) else ())
+        if isinstance(ev, dict) and ev.get("tipo") == "dialogo" and isinstance(ev.get("nombre"), str)
+    ]
+    return {
+        "eventos": len(eventos) if isinstance(eventos, list) else -1,
+        "opciones": len(opciones) if isinstance(opciones, list) else -1,
+        "dialogo": dialogo,
+    }
 
 
 class GameLogger:
-    def __init__(self, log_path: str):
+    # Log de turnos en JSONL escrito por un hilo de fondo: log_turn solo encola (nunca
+    # bloquea la UI). Cola acotada: si se llena, el registro se descarta y se cuenta.
+
+    def __init__(
+        self,
+        log_path: str,
+        *,
+        max_queue: int = 1000,
+        batch_size: int = 64,
+        flush_interval: float = 0.5,
+        fsync: str = "interval",
+        fsync_interval: float = 5.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        max_age_s: Optional[float] = None,
+        compress: bool = True,
+        backup_count: int = 10,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync debe ser uno de {FSYNC_POLICIES}")
+
         self.log_path = log_path
-        os.makedirs(os.path.dirname(log_path), exist_ok=True)
-
-    def log_turn(self, user_input: str, raw_response: str, parse_ok: bool, format_ok: bool, error: str = ""):
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        block = (
-            f"\n----- {ts} -----\n"
-            f"USER: {user_input}\n"
-            f"PARSE_OK: {parse_ok}\n"
-            f"FORMAT_OK: {format_ok}\n"
-        )
-        if error:
-            block += f"ERROR: {error}\n"
-        block += f"RAW:\n{raw_response}\n"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.compress = compress
+        self.backup_count = backup_count
+
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.last_error = ""
+
+        os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_started: Optional[float] = None
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="game-logger", daemon=True)
+        self._thread.start()
+
+    def log_turn(
+        self,
+        user_input: str,
+        raw_response: str,
+        parse_ok: bool,
+        format_ok: bool,
+        error: str = "",
+        stats: Optional[Dict[str, Any]] = None,
+        timings: Optional[Dict[str, float]] = None,
+        session: str = "",
+        completion: Optional[Dict[str, Any]] = None,
+        data: Optional[Dict[str, Any]] = None,
+    ):
+        # completion: telemetria de llama.cpp del turno (CompletionResult.as_dict).
+        # data: el turno ya parseado (ParseOutcome.data); de el sale el campo shape
+        record: Dict[str, Any] = {
+            "ts": datetime.now().strftime(TS_FORMAT),
+            "user_input": user_input,
+            "parse_ok": parse_ok,
+            "format_ok": format_ok,
+            "error": error,
+            "raw_response": raw_response,
+        }
+        if session:
+            record["session"] = session
+        if stats:
+            record["stats"] = stats
+        if timings:
+            record["timings"] = timings
+        if completion:
+            record["completion"] = completion
+        if parse_ok:
+            record["shape"] = turn_shape(data)
+        self.log_record(record)
+
+    def log_record(self, record: Dict[str, Any]):
+        # Encola una linea JSONL cualquiera (tambien la usa TurnMetrics para sus registros)
+        try:
+            self._q.put_nowait(record)
+        except queue.Full:
+            # El log no debe tumbar (ni frenar) la app
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # Espera a que se escriba todo lo encolado
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._q.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout: float = 5.0):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._q.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "written": self.written,
+                "dropped": self.dropped,
+                "write_errors": self.write_errors,
+                "last_error": self.last_error,
+                "queued": self._q.qsize(),
+            }
+
+    def _run(self):
+        while True:
+            try:
+                item = self._q.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._maybe_fsync(force=False)
+                continue
+
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(x is _STOP for x in batch)
+            records = [x for x in batch if x is not _STOP]
+            if records:
+                self._write(records)
+            for _ in batch:
+                self._q.task_done()
+
+            if stop:
+                self._close_file()
+                return
+
+    def _write(self, records: List[Dict[str, Any]]):
+        try:
+            self._maybe_rotate()
+            f = self._open()
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+            f.flush()
+            with self._lock:
+                self.written += len(records)
+            self._maybe_fsync(force=self.fsync == "always")
+        except (OSError, ValueError) as e:
+            with self._lock:
+                self.write_errors += 1
+                self.last_error = str(e)
+            self._close_file()
+
+    def _open(self):
+        if self._file is None:
+            self._file_started = self._first_record_time()
+            self._file = open(self.log_path, "a", encoding="utf-8")
+            if self._file_started is None:
+                self._file_started = time.time()
+        return self._file
+
+    def _first_record_time(self) -> Optional[float]:
+        # Antiguedad del fichero = fecha del primer registro (sobrevive a reinicios de la app)
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                first = f.readline()
+            return datetime.strptime(json.loads(first)["ts"], TS_FORMAT).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _maybe_fsync(self, force: bool):
+        if self._file is None or self.fsync == "never":
+            return
+        now = time.monotonic()
+        if force or now - self._last_fsync >= self.fsync_interval:
+            try:
+                os.fsync(self._file.fileno())
+            except OSError:
+                pass
+            self._last_fsync = now
 
+    def _close_file(self):
+        if self._file is None:
+            return
         try:
-            with open(self.log_path, "a", encoding="utf-8") as f:
-                f.write(block)
-        except Exception:
-            # El log no debe tumbar la app
+            self._file.flush()
+            if self.fsync != "never":
+                os.fsync(self._file.fileno())
+            self._file.close()
+        except (OSError, ValueError):
             pass
+        self._file = None
+
+    def _maybe_rotate(self):
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            return
+        if size == 0:
+            return
+
+        too_big = self.max_bytes and size >= self.max_bytes
+        started = self._file_started if self._file is not None else self._first_record_time()
+        too_old = self.max_age_s and started is not None and time.time() - started >= self.max_age_s
+        if not (too_big or too_old):
+            return
+
+        self._close_file()
+        root, ext = os.path.splitext(self.log_path)
+        rotated = f"{root}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{ext}"
+        os.replace(self.log_path, rotated)
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        self._prune_backups(root, ext)
+
+    def _prune_backups(self, root: str, ext: str):
+        backups = sorted(glob.glob(f"{glob.escape(root)}.*{ext}*"))
+        for old in backups[: max(0, len(backups) - self.backup_count)]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def _open_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def _iter_jsonl_turns(log_path: str) -> Iterator[Dict[str, Any]]:
+    with _open_log(log_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict):
+                record.setdefault("stats", {})
+                yield record
+
+
+def iter_log_turns(log_path: str) -> Iterator[Dict[str, Any]]:
+    # Lee en streaming los turnos de un log: JSONL actual (tambien .gz rotados)
+    # o el formato de texto antiguo ("----- fecha -----")
+    with _open_log(log_path) as f:
+        first = ""
+        for line in f:
+            if line.strip():
+                first = line.strip()
+                break
+    if first.startswith("{"):
+        yield from _iter_jsonl_turns(log_path)
+        return
+
+    turn: Optional[Dict[str, Any]] = None
+    raw_lines: List[str] = []
+    in_raw = False
+
+    with _open_log(log_path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            m = _BLOCK_RE.match(line)
+            if m:
+                if turn is not None:
+                    turn["raw_response"] = "\n".join(raw_lines).strip("\n")
+                    yield turn
+                turn = {"ts": m.group(1), "user_input": "", "parse_ok": False, "format_ok": False, "error": "", "stats": {}}
+                raw_lines = []
+                in_raw = False
+                continue
+            if turn is None:
+                continue
+
+            if in_raw:
+                raw_lines.append(line)
+                continue
+
+            key, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if key == "RAW":
+                in_raw = True
+            elif key == "USER":
+                turn["user_input"] = value
+            elif key == "PARSE_OK":
+                turn["parse_ok"] = value == "True"
+            elif key == "FORMAT_OK":
+                turn["format_ok"] = value == "True"
+            elif key == "ERROR":
+                turn["error"] = value
+            elif key == "STATS":
+                for item in value.split():
+                    k, _, v = item.partition("=")
+                    turn["stats"][k] = v
+
+    if turn is not None:
+        turn["raw_response"] = "\n".join(raw_lines).strip("\n")
+        yield turn
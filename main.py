@@ -1,5 +1,10 @@
-from app import ChatUI
+import time
+
+# Antes de cualquier import pesado: base del desglose de tiempos de arranque
+STARTED_AT = time.perf_counter()
+
+from app import ChatUI  # noqa: E402
 
 if __name__ == "__main__":
-    app = ChatUI()
+    app = ChatUI(started_at=STARTED_AT)
     app.mainloop()
@@ -0,0 +1,186 @@
+import threading
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+
+from llm_client import LLMClient
+
+
+@dataclass
+class MemoryTurn:
+    user: str
+    master: str
+    tokens: Optional[int] = None
+    # True mientras tokens sea la estimacion local y no la cuenta de /tokenize
+    estimated: bool = False
+
+    def as_text(self) -> str:
+        return f"Jugador: {self.user}\nMaster: {self.master}\n"
+
+
+class ConversationMemory:
+    # Memoria de la partida: los turnos recientes van literales dentro de un presupuesto
+    # de tokens; los mas antiguos se pliegan en un resumen que se genera en segundo plano.
+
+    def __init__(
+        self,
+        client: LLMClient,
+        *,
+        token_budget: int = 1200,
+        summary_tokens: int = 256,
+        summarize: bool = True,
+        gate: Optional[Callable[[], ContextManager[Any]]] = None,
+    ):
+        self.client = client
+        # gate: envuelve las llamadas al servidor hechas en segundo plano (p.ej. el servidor
+        # multi-sesion las hace pasar por su scheduler como un turno mas)
+        self.gate = gate or nullcontext
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.summarize = summarize
+
+        self.summary = ""
+        self.turns: List[MemoryTurn] = []
+        # Turnos que han salido del presupuesto y esperan a entrar en el resumen
+        self._pending: List[MemoryTurn] = []
+        self._summarizing = False
+        # Turnos con tokens estimados que esperan la cuenta exacta del servidor
+        self._uncounted: List[MemoryTurn] = []
+        self._counting = False
+        self._lock = threading.Lock()
+
+    def add_turn(self, user: str, master: str):
+        turn = MemoryTurn(user=user.strip(), master=master.strip())
+        # Estimacion local (~4 caracteres/token) para no esperar a /tokenize en el turno; la cuenta
+        # exacta llega en segundo plano (una vez por turno) y entonces se reajusta el presupuesto
+        turn.tokens = len(turn.as_text()) // 4 + 1
+        turn.estimated = True
+
+        with self._lock:
+            self.turns.append(turn)
+            self._uncounted.append(turn)
+            start_worker = self._enforce_budget()
+            start_counter = not self._counting
+            self._counting = True
+
+        if start_counter:
+            threading.Thread(target=self._count_worker, daemon=True).start()
+        if start_worker:
+            threading.Thread(target=self._summarize_worker, daemon=True).start()
+
+    def recent_tokens(self) -> int:
+        with self._lock:
+            return sum(t.tokens or 0 for t in self.turns)
+
+    def render(self) -> str:
+        with self._lock:
+            summary = self.summary
+            # Mientras se resume, los turnos pendientes siguen apareciendo literales
+            turns = self._pending + self.turns
+
+        if not summary and not turns:
+            return ""
+
+        block = ""
+        if summary:
+            block += f"Resumen de lo ocurrido hasta ahora:\n{summary}\n\n"
+        if turns:
+            block += "Turnos recientes:\n" + "".join(t.as_text() for t in turns) + "\n"
+        return block
+
+    def snapshot(self) -> Dict[str, Any]:
+        # Estado serializable (tokens incluidos: al restaurar no hay que volver a contarlos)
+        with self._lock:
+            return {
+                "summary": self.summary,
+                "turns": [[t.user, t.master, t.tokens] for t in self.turns],
+                "pending": [[t.user, t.master, t.tokens] for t in self._pending],
+            }
+
+    def restore(self, state: Dict[str, Any]):
+        with self._lock:
+            self.summary = str(state.get("summary", ""))
+            self.turns = [MemoryTurn(u, m, n) for u, m, n in state.get("turns", [])]
+            self._pending = [MemoryTurn(u, m, n) for u, m, n in state.get("pending", [])]
+            self._uncounted = []
+            start_worker = self._enforce_budget()
+
+        if start_worker:
+            threading.Thread(target=self._summarize_worker, daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self.summary = ""
+            self.turns = []
+            self._pending = []
+            self._uncounted = []
+
+    def _enforce_budget(self) -> bool:
+        # Llamar con el lock tomado. Devuelve True si hay que lanzar el resumidor.
+        total = sum(t.tokens or 0 for t in self.turns)
+        while total > self.token_budget and len(self.turns) > 1:
+            old = self.turns.pop(0)
+            total -= old.tokens or 0
+            if self.summarize:
+                self._pending.append(old)
+
+        if self._pending and not self._summarizing:
+            self._summarizing = True
+            return True
+        return False
+
+    def _count_worker(self):
+        while True:
+            with self._lock:
+                if not self._uncounted:
+                    self._counting = False
+                    return
+                turn = self._uncounted.pop(0)
+
+            try:
+                with self.gate():
+                    tokens: Optional[int] = self.client.count_tokens(turn.as_text())
+            except Exception:
+                # Se queda la estimacion
+                tokens = None
+
+            with self._lock:
+                if tokens is not None:
+                    turn.tokens = tokens
+                turn.estimated = False
+                start_worker = self._enforce_budget()
+            if start_worker:
+                threading.Thread(target=self._summarize_worker, daemon=True).start()
+
+    def _build_summary_prompt(self, summary: str, turns: List[MemoryTurn]) -> str:
+        return (
+            "Resume en pocas frases lo ocurrido en esta partida de rol. Conserva nombres, "
+            "acuerdos, pagos, informacion revelada y el estado actual de la escena. "
+            "Responde solo con el resumen, sin JSON.\n\n"
+            f"Resumen previo:\n{summary or '(ninguno)'}\n\n"
+            "Nuevos sucesos:\n" + "".join(t.as_text() for t in turns) + "\nResumen actualizado:\n"
+        )
+
+    def _summarize_worker(self):
+        while True:
+            with self._lock:
+                batch = list(self._pending)
+                summary = self.summary
+                if not batch:
+                    self._summarizing = False
+                    return
+
+            try:
+                with self.gate():
+                    new_summary = self.client.complete_plain(
+                        self._build_summary_prompt(summary, batch),
+                        temperature=0.3,
+                        max_tokens=self.summary_tokens,
+                    )
+            except Exception:
+                # Sin servidor no hay resumen: se descartan para que la memoria siga acotada
+                new_summary = summary
+
+            with self._lock:
+                self.summary = new_summary
+                self._pending = self._pending[len(batch) :]
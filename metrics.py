@@ -0,0 +1,203 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from logger import GameLogger
+
+# Limites de los buckets en segundos (estilo Prometheus)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS, samples: int = 2048):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # Ventana de muestras recientes para percentiles exactos
+        self._recent: Deque[float] = deque(maxlen=samples)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self._recent.append(value)
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def percentile(self, q: float) -> float:
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "p50_ms": round(1000 * self.percentile(0.50), 2),
+            "p95_ms": round(1000 * self.percentile(0.95), 2),
+            "p99_ms": round(1000 * self.percentile(0.99), 2),
+        }
+
+
+class _Turn:
+    __slots__ = ("started", "spans", "marks", "ts")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.ts = time.time()
+        self.spans: Dict[str, float] = {}
+        self.marks: Dict[str, float] = {}
+
+
+class TurnMetrics:
+    # Spans por etapa de cada turno (clave: turn_id) con histogramas en proceso.
+    # Al cerrar un turno se encola una linea JSONL (la escribe el hilo de fondo de un GameLogger,
+    # finish_turn se llama desde el hilo de Tk); opcionalmente se sirve /metrics en formato Prometheus.
+
+    def __init__(self, jsonl_path: Optional[str] = None):
+        self.jsonl_path = jsonl_path
+        self.histograms: Dict[str, Histogram] = {}
+        self.turns_total = 0
+        self._turns: Dict[str, _Turn] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._http: Optional[ThreadingHTTPServer] = None
+        # Sin rotacion ni fsync: son metricas, no la partida
+        self._writer = GameLogger(jsonl_path, fsync="never", max_bytes=0) if jsonl_path else None
+
+    def start_turn(self) -> str:
+        with self._lock:
+            self._next_id += 1
+            turn_id = f"{int(time.time())}-{self._next_id}"
+            self._turns[turn_id] = _Turn()
+        return turn_id
+
+    def record(self, turn_id: str, stage: str, seconds: float):
+        # Si una etapa se repite en el turno (p.ej. render durante el streaming) se acumula
+        with self._lock:
+            turn = self._turns.get(turn_id)
+            if turn is not None:
+                turn.spans[stage] = turn.spans.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, turn_id: str, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(turn_id, stage, time.perf_counter() - t0)
+
+    def mark(self, turn_id: str, name: str):
+        with self._lock:
+            turn = self._turns.get(turn_id)
+            if turn is not None:
+                turn.marks[name] = time.perf_counter()
+
+    def record_since(self, turn_id: str, stage: str, mark: str):
+        # Etapa medida entre dos hilos: desde una marca previa hasta ahora
+        with self._lock:
+            turn = self._turns.get(turn_id)
+            t0 = turn.marks.pop(mark, None) if turn is not None else None
+        if t0 is not None:
+            self.record(turn_id, stage, time.perf_counter() - t0)
+
+    def spans_ms(self, turn_id: str) -> Dict[str, float]:
+        # Spans del turno en curso (para adjuntarlos al log antes de cerrarlo)
+        with self._lock:
+            turn = self._turns.get(turn_id)
+            return {k: round(1000 * v, 2) for k, v in turn.spans.items()} if turn is not None else {}
+
+    def finish_turn(self, turn_id: str, **extra: Any):
+        with self._lock:
+            turn = self._turns.pop(turn_id, None)
+            if turn is None:
+                return
+            total = time.perf_counter() - turn.started
+            spans = dict(turn.spans)
+            spans["total"] = total
+            for stage, seconds in spans.items():
+                self.histograms.setdefault(stage, Histogram()).observe(seconds)
+            self.turns_total += 1
+
+        record = {
+            "turn_id": turn_id,
+            "ts": round(turn.ts, 3),
+            "spans_ms": {k: round(1000 * v, 2) for k, v in spans.items()},
+        }
+        record.update(extra)
+        self._append(record)
+
+    def record_event(self, event: str, data: Dict[str, Any]):
+        # Eventos sueltos que no son turnos (p.ej. el desglose del arranque)
+        self._append({"event": event, "ts": round(time.time(), 3), **data})
+
+    def _append(self, record: Dict[str, Any]):
+        if self._writer is not None:
+            self._writer.log_record(record)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return self._writer.flush(timeout) if self._writer is not None else True
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {stage: h.summary() for stage, h in sorted(self.histograms.items())}
+
+    def prometheus_text(self) -> str:
+        lines: List[str] = [
+            "# HELP taberna_turns_total Turnos completados",
+            "# TYPE taberna_turns_total counter",
+        ]
+        with self._lock:
+            lines.append(f"taberna_turns_total {self.turns_total}")
+            lines.append("# HELP taberna_stage_duration_seconds Duracion de cada etapa del turno")
+            lines.append("# TYPE taberna_stage_duration_seconds histogram")
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for le, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    lines.append(f'taberna_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'taberna_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'taberna_stage_duration_seconds_sum{{stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'taberna_stage_duration_seconds_count{{stage="{stage}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        # Endpoint local opcional: /metrics (Prometheus) y /metrics.json (resumen p50/p95/p99)
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, ctype = metrics.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, ctype = json.dumps(metrics.summary()).encode("utf-8"), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._http = ThreadingHTTPServer((host, port), Handler)
+        self._http.daemon_threads = True
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
+        if self._writer is not None:
+            self._writer.close()
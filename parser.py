@@ -1,6 +1,14 @@
 import json
+import re
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+
+from turn_schema import DEFAULT_SCHEMA, TurnSchema
+
+_EVENT_START_RE = re.compile(r'\{\s*"tipo"\s*:\s*"(narracion|dialogo)"')
+_NOMBRE_RE = re.compile(r'"nombre"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_TEXTO_RE = re.compile(r'"texto"\s*:\s*"((?:[^"\\]|\\.)*)')
+_STRING_PLAIN_RE = re.compile(r'[^"\\\x00-\x1f]*')
 
 
 @dataclass
@@ -9,9 +17,93 @@ class ParseOutcome:
     format_ok: bool
     error: str
     data: Optional[Dict[str, Any]]
+    # True si la respuesta venia cortada y se recuperaron sus eventos completos
+    repaired: bool = False
+
+
+class JsonPrefixScanner:
+    # Sigue la estructura de un JSON a medio generar: contenedores abiertos, si se esta dentro
+    # de un string y el ultimo punto donde se puede cortar dejando solo valores completos
+    def __init__(self):
+        self.stack: List[str] = []
+        self.in_string = False
+        self.started = False
+        self.end: Optional[int] = None
+        self.cut = -1
+        self.cut_stack: List[str] = []
+        self._expect_key: List[bool] = []
+        self._escape = False
+        self._offset = 0
+
+    @property
+    def truncated(self) -> bool:
+        return self.started and self.end is None
+
+    def _push(self, ch: str):
+        self.stack.append(ch)
+        self._expect_key.append(ch == "{")
+
+    def _mark_cut(self, pos: int):
+        self.cut = pos
+        self.cut_stack = list(self.stack)
+
+    def feed(self, chunk: str) -> Optional[int]:
+        # Devuelve el offset (en el texto acumulado) justo despues del cierre del objeto raiz
+        if self.end is not None:
+            return self.end
+        base = self._offset
+        self._offset += len(chunk)
+        i, n = 0, len(chunk)
+        while i < n:
+            if self.in_string:
+                if self._escape:
+                    self._escape = False
+                    i += 1
+                    continue
+                i = _STRING_PLAIN_RE.match(chunk, i).end()
+                if i >= n:
+                    break
+                if chunk[i] == "\\":
+                    self._escape = True
+                elif chunk[i] == '"':
+                    self.in_string = False
+                    if not (self.stack[-1] == "{" and self._expect_key[-1]):
+                        self._mark_cut(base + i + 1)
+                i += 1
+                continue
+
+            ch = chunk[i]
+            i += 1
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self._push(ch)
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self._push(ch)
+            elif ch in "}]":
+                self.stack.pop()
+                self._expect_key.pop()
+                if not self.stack:
+                    self.end = base + i
+                    return self.end
+                self._mark_cut(base + i)
+            elif ch == ":":
+                self._expect_key[-1] = False
+            elif ch == ",":
+                self._mark_cut(base + i - 1)
+                if self.stack[-1] == "{":
+                    self._expect_key[-1] = True
+        return None
 
 
 class ResponseParser:
+    def __init__(self, schema: Optional[TurnSchema] = None):
+        # Mismo esquema que genera la gramatica: los limites se validan igual en los dos lados
+        self.schema = schema or DEFAULT_SCHEMA
+
     def strip_code_fences(self, s: str) -> str:
         s = (s or "").strip()
         if s.startswith("```"):
@@ -36,6 +128,45 @@ class ResponseParser:
             return "{\n" + t.strip().strip(",") + "\n}"
         return t
 
+    def _decode_partial_string(self, body: str) -> str:
+        try:
+            return json.loads(f'"{body}"')
+        except json.JSONDecodeError:
+            # Escape unicode a medias al final del fragmento
+            cut = body.rfind("\\u")
+            if cut != -1:
+                try:
+                    return json.loads(f'"{body[:cut]}"')
+                except json.JSONDecodeError:
+                    pass
+            return body.replace('\\"', '"')
+
+    def preview_events(self, partial: str) -> List[Dict[str, Any]]:
+        # Lectura tolerante de una respuesta a medio generar (streaming):
+        # devuelve los eventos vistos hasta ahora, el ultimo puede tener el texto incompleto
+        s = partial or ""
+        cut = s.find('"opciones"')
+        if cut != -1:
+            s = s[:cut]
+
+        starts = list(_EVENT_START_RE.finditer(s))
+        events: List[Dict[str, Any]] = []
+        for i, m in enumerate(starts):
+            end = starts[i + 1].start() if i + 1 < len(starts) else len(s)
+            chunk = s[m.end() : end]
+
+            texto_m = _TEXTO_RE.search(chunk)
+            if not texto_m:
+                continue
+            ev: Dict[str, Any] = {"tipo": m.group(1), "texto": self._decode_partial_string(texto_m.group(1))}
+            if ev["tipo"] == "dialogo":
+                nombre_m = _NOMBRE_RE.search(chunk, 0, texto_m.start())
+                if not nombre_m:
+                    continue
+                ev["nombre"] = self._decode_partial_string(nombre_m.group(1))
+            events.append(ev)
+        return events
+
     def parse(self, raw: str) -> ParseOutcome:
         cleaned = self.strip_code_fences(raw)
         cleaned = self.extract_json_object(cleaned)
@@ -44,6 +175,18 @@ class ResponseParser:
         try:
             data = json.loads(cleaned)
         except json.JSONDecodeError as e:
+            repaired = self.repair_truncated(raw) if self._maybe_repairable(cleaned, e) else None
+            if repaired is not None:
+                # Sin opciones validas el turno no cumple el formato: repaired lo distingue de un fallo
+                ok, _ = self.validate_new_format(repaired)
+                note = "" if ok else ", sin opciones"
+                return ParseOutcome(
+                    parse_ok=True,
+                    format_ok=ok,
+                    error=f"respuesta truncada: reparada con {len(repaired['eventos'])} eventos{note}",
+                    data=repaired,
+                    repaired=True,
+                )
             return ParseOutcome(parse_ok=False, format_ok=False, error=f"JSONDecodeError: {e}", data=None)
 
         if not isinstance(data, dict):
@@ -55,34 +198,372 @@ class ResponseParser:
 
         return ParseOutcome(parse_ok=True, format_ok=False, error="JSON parseado pero no tiene 'eventos'/'opciones'", data=data)
 
+    @staticmethod
+    def _maybe_repairable(cleaned: str, e: json.JSONDecodeError) -> bool:
+        # Filtro barato antes de escanear: un JSON cortado falla al llegar al final (o con un
+        # string sin cerrar) y solo se puede salvar si hay al menos un evento cerrado
+        if e.pos < len(cleaned) - 1 and not e.msg.startswith("Unterminated string"):
+            return False
+        eventos = cleaned.find('"eventos"')
+        return eventos != -1 and cleaned.find("}", eventos) != -1
+
+    def is_truncated(self, raw: str) -> bool:
+        # El objeto raiz se abrio pero no llego a cerrarse
+        scan = JsonPrefixScanner()
+        scan.feed(raw or "")
+        return scan.truncated
+
+    def repair_truncated(self, raw: str) -> Optional[Dict[str, Any]]:
+        # Cierra strings/arrays/objetos abiertos cortando en el ultimo valor completo y se
+        # queda con los eventos validos; las opciones solo si llegaron a completarse (2-4)
+        s = self.strip_code_fences(raw)
+        start = s.find("{")
+        if start == -1:
+            return None
+        # Sin ningun evento cerrado no hay nada que salvar: se evita el escaneo caracter a caracter
+        eventos = s.find('"eventos"', start)
+        if eventos == -1 or s.find("}", eventos) == -1:
+            return None
+        scan = JsonPrefixScanner()
+        scan.feed(s[start:])
+        if not scan.truncated or scan.cut < 0:
+            return None
+
+        closers = "".join("}" if c == "{" else "]" for c in reversed(scan.cut_stack))
+        try:
+            data = json.loads(s[start : start + scan.cut] + closers)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(data, dict) or not isinstance(data.get("eventos"), list):
+            return None
+
+        eventos = []
+        for i, ev in enumerate(data["eventos"][: self.schema.max_events]):
+            if not self.validate_evento(i, ev)[0]:
+                break
+            eventos.append(ev)
+        if not eventos:
+            return None
+
+        opciones = data.get("opciones")
+        ok, _ = self.validate_opciones(opciones)
+        return {"eventos": eventos, "opciones": opciones if ok else []}
+
+    def validate_evento(self, i: int, ev: Any) -> Tuple[bool, str]:
+        if not isinstance(ev, dict):
+            return False, f"eventos[{i}] no es objeto"
+
+        tipo = ev.get("tipo")
+        spec = self.schema.event_type(tipo) if isinstance(tipo, str) else None
+        if spec is None:
+            return False, f"eventos[{i}].tipo invalido: {tipo}"
+
+        for field in spec.fields:
+            value = ev.get(field.name)
+            if not isinstance(value, str):
+                return False, f"eventos[{i}].{field.name} no es string"
+            if len(value.strip()) < field.min_chars:
+                return False, f"eventos[{i}].{field.name} invalido o vacio"
+            if len(value) > field.max_chars:
+                return False, f"eventos[{i}].{field.name} supera {field.max_chars} caracteres"
+
+        return True, ""
+
+    def validate_opciones(self, opciones: Any) -> Tuple[bool, str]:
+        schema = self.schema
+        if not isinstance(opciones, list):
+            return False, "falta 'opciones' o no es lista"
+        clean = [c for c in opciones if isinstance(c, str) and c.strip()]
+        if len(clean) < schema.min_opciones or len(clean) > schema.max_opciones:
+            return False, f"'opciones' debe tener {schema.min_opciones}-{schema.max_opciones} strings (tiene {len(clean)})"
+        for j, c in enumerate(clean):
+            if len(c) > schema.opcion_max_chars:
+                return False, f"'opciones'[{j}] supera {schema.opcion_max_chars} caracteres"
+        return True, ""
+
     def validate_new_format(self, data: Dict[str, Any]) -> Tuple[bool, str]:
         eventos = data.get("eventos")
-        opciones = data.get("opciones")
 
         if not isinstance(eventos, list):
             return False, "falta 'eventos' o no es lista"
 
+        if not self.schema.min_events <= len(eventos) <= self.schema.max_events:
+            return (
+                False,
+                f"'eventos' debe tener {self.schema.min_events}-{self.schema.max_events} elementos (tiene {len(eventos)})",
+            )
+
         for i, ev in enumerate(eventos):
-            if not isinstance(ev, dict):
-                return False, f"eventos[{i}] no es objeto"
+            ok, err = self.validate_evento(i, ev)
+            if not ok:
+                return False, err
 
-            tipo = ev.get("tipo")
-            texto = ev.get("texto")
+        return self.validate_opciones(data.get("opciones"))
 
-            if tipo not in ("narracion", "dialogo"):
-                return False, f"eventos[{i}].tipo invalido: {tipo}"
-            if not isinstance(texto, str):
-                return False, f"eventos[{i}].texto no es string"
 
-            if tipo == "dialogo":
-                nombre = ev.get("nombre")
-                if not isinstance(nombre, str) or not nombre.strip():
-                    return False, f"eventos[{i}].nombre invalido o vacio"
+class _Frame:
+    __slots__ = ("kind", "state", "key", "start", "count")
 
-        if not isinstance(opciones, list):
-            return False, "falta 'opciones' o no es lista"
-        clean = [c for c in opciones if isinstance(c, str) and c.strip()]
-        if len(clean) < 2 or len(clean) > 4:
-            return False, f"'opciones' debe tener 2-4 strings (tiene {len(clean)})"
+    def __init__(self, kind: str, state: str, start: int):
+        self.kind = kind
+        self.state = state
+        self.key: Optional[str] = None
+        self.start = start
+        self.count = 0
 
-        return True, ""
+
+class IncrementalParser:
+    # Parser "push": recibe la respuesta a trozos y entrega cada eventos[i] (y luego
+    # las opciones) en cuanto se cierra, validado igual que en validate_new_format.
+    # El primer error estructural se reporta con su offset en bytes (UTF-8).
+
+    def __init__(self, validator: Optional[ResponseParser] = None):
+        self.validator = validator or ResponseParser()
+        self.error = ""
+        self.error_offset: Optional[int] = None
+        self.format_error = ""
+        self.eventos_emitted = 0
+        self.opciones_emitted = False
+
+        self._text = ""
+        self._pos = 0
+        self._bytes = 0
+        self._stack: List[_Frame] = []
+        self._started = False
+        self._done = False
+
+        self._in_string = False
+        self._string_is_key = False
+        self._string_start = 0
+        self._scalar_start: Optional[int] = None
+        self._event_start: Optional[int] = None
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def pending_text(self) -> str:
+        # Texto del evento que se esta generando ahora mismo (para la vista en vivo)
+        if self._event_start is None or self.error:
+            return ""
+        return self._text[self._event_start :]
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self._text += chunk or ""
+        out: List[Tuple[str, Any]] = []
+
+        text = self._text
+        n = len(text)
+        while self._pos < n and not self.error and not self._done:
+            if self._in_string:
+                if not self._scan_string(text, out):
+                    break
+                continue
+
+            ch = text[self._pos]
+
+            if not self._started:
+                # Igual que extract_json_object: se ignora lo anterior a la primera llave
+                if ch == "{":
+                    self._started = True
+                    self._stack.append(_Frame("obj", "key_or_end", self._pos))
+                self._advance(ch)
+                continue
+
+            if self._scalar_start is not None:
+                if ch in ",}] \t\n\r":
+                    self._finish_scalar(out)
+                else:
+                    self._advance(ch)
+                continue
+
+            if ch in " \t\n\r":
+                self._advance(ch)
+                continue
+
+            self._structural(ch, out)
+
+        return out
+
+    def finish(self) -> ParseOutcome:
+        # Al terminar el stream se usa el mismo camino que la respuesta completa
+        outcome = self.validator.parse(self._text)
+        if not outcome.parse_ok and self.error:
+            outcome.error = f"{self.error} (byte {self.error_offset})"
+        return outcome
+
+    def _advance(self, ch: str):
+        self._pos += 1
+        o = ord(ch)
+        self._bytes += 1 if o < 0x80 else 2 if o < 0x800 else 3 if o < 0x10000 else 4
+
+    def _fail(self, msg: str):
+        if not self.error:
+            self.error = msg
+            self.error_offset = self._bytes
+
+    def _scan_string(self, text: str, out: List[Tuple[str, Any]]) -> bool:
+        # Devuelve False si hace falta mas texto para continuar
+        m = _STRING_PLAIN_RE.match(text, self._pos)
+        if m.end() > self._pos:
+            self._bytes += len(m.group(0).encode("utf-8"))
+            self._pos = m.end()
+        if self._pos >= len(text):
+            return False
+
+        ch = text[self._pos]
+        if ch == '"':
+            self._advance(ch)
+            self._in_string = False
+            self._string_done(out)
+            return True
+
+        if ch != "\\":
+            self._fail("caracter de control sin escapar dentro de string")
+            return True
+
+        # Escape: se espera a tenerlo completo
+        if self._pos + 1 >= len(text):
+            return False
+        esc = text[self._pos + 1]
+        if esc == "u":
+            hexa = text[self._pos + 2 : self._pos + 6]
+            if any(c not in "0123456789abcdefABCDEF" for c in hexa):
+                self._fail("escape unicode invalido en string")
+                return True
+            if len(hexa) < 4:
+                return False
+            self._pos += 6
+            self._bytes += 6
+        elif esc in '"\\/bfnrt':
+            self._pos += 2
+            self._bytes += 2
+        else:
+            self._fail(f"escape invalido en string: \\{esc}")
+        return True
+
+    def _string_done(self, out: List[Tuple[str, Any]]):
+        start, end = self._string_start, self._pos
+        top = self._stack[-1]
+        if self._string_is_key:
+            top.key = json.loads(self._text[start:end])
+            top.state = "colon"
+        else:
+            self._value_done(start, end, out)
+
+    def _finish_scalar(self, out: List[Tuple[str, Any]]):
+        start = self._scalar_start
+        self._scalar_start = None
+        token = self._text[start : self._pos]
+        try:
+            json.loads(token)
+        except json.JSONDecodeError:
+            self._bytes -= len(token.encode("utf-8"))
+            self._fail(f"literal invalido: {token[:20]}")
+            return
+        self._value_done(start, self._pos, out)
+
+    def _begin_value(self, ch: str, out: List[Tuple[str, Any]]):
+        top = self._stack[-1]
+        if ch == "{" or ch == "[":
+            if self._is_eventos_array(top) and ch == "{":
+                self._event_start = self._pos
+            self._stack.append(_Frame("obj" if ch == "{" else "arr", "key_or_end" if ch == "{" else "value_or_end", self._pos))
+            self._advance(ch)
+        elif ch == '"':
+            self._in_string = True
+            self._string_is_key = False
+            self._string_start = self._pos
+            self._advance(ch)
+        elif ch in "-0123456789tfn":
+            self._scalar_start = self._pos
+            self._advance(ch)
+        else:
+            self._fail(f"se esperaba un valor y llego {ch!r}")
+
+    def _structural(self, ch: str, out: List[Tuple[str, Any]]):
+        top = self._stack[-1]
+        state = top.state
+
+        if top.kind == "obj":
+            if state in ("key_or_end", "key"):
+                if ch == '"':
+                    self._in_string = True
+                    self._string_is_key = True
+                    self._string_start = self._pos
+                    self._advance(ch)
+                elif ch == "}" and state == "key_or_end":
+                    self._close(ch, out)
+                else:
+                    self._fail(f"se esperaba una clave y llego {ch!r}")
+            elif state == "colon":
+                if ch == ":":
+                    top.state = "value"
+                    self._advance(ch)
+                else:
+                    self._fail(f"se esperaba ':' y llego {ch!r}")
+            elif state == "value":
+                self._begin_value(ch, out)
+            else:
+                if ch == ",":
+                    top.state = "key"
+                    self._advance(ch)
+                elif ch == "}":
+                    self._close(ch, out)
+                else:
+                    self._fail(f"se esperaba ',' o '}}' y llego {ch!r}")
+        else:
+            if state in ("value_or_end", "value"):
+                if ch == "]" and state == "value_or_end":
+                    self._close(ch, out)
+                else:
+                    self._begin_value(ch, out)
+            else:
+                if ch == ",":
+                    top.state = "value"
+                    self._advance(ch)
+                elif ch == "]":
+                    self._close(ch, out)
+                else:
+                    self._fail(f"se esperaba ',' o ']' y llego {ch!r}")
+
+    def _close(self, ch: str, out: List[Tuple[str, Any]]):
+        frame = self._stack.pop()
+        self._advance(ch)
+        if not self._stack:
+            self._done = True
+            return
+        self._value_done(frame.start, self._pos, out)
+
+    def _is_eventos_array(self, frame: _Frame) -> bool:
+        return len(self._stack) == 2 and frame is self._stack[1] and self._stack[0].key == "eventos"
+
+    def _value_done(self, start: int, end: int, out: List[Tuple[str, Any]]):
+        top = self._stack[-1]
+        top.state = "comma_or_end"
+
+        if self._is_eventos_array(top):
+            i = top.count
+            top.count += 1
+            self._event_start = None
+            if self.format_error:
+                return
+            ev = json.loads(self._text[start:end])
+            ok, err = self.validator.validate_evento(i, ev)
+            if not ok:
+                self.format_error = err
+                return
+            self.eventos_emitted += 1
+            out.append(("evento", ev))
+        elif len(self._stack) == 1 and top.key == "opciones" and not self.format_error:
+            opciones = json.loads(self._text[start:end])
+            ok, err = self.validator.validate_opciones(opciones)
+            if not ok:
+                self.format_error = err
+                return
+            self.opciones_emitted = True
+            out.append(("opciones", opciones))
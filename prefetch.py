@@ -0,0 +1,178 @@
+import queue
+import re
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+from llm_client import CancelToken
+from llm_service import LLMService
+
+_PUNCT_RE = re.compile(r"[^\w\s]")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_option(text: str) -> str:
+    # Comparacion tolerante: sin tildes, mayusculas, puntuacion ni espacios repetidos
+    s = unicodedata.normalize("NFKD", text or "")
+    s = "".join(c for c in s if not unicodedata.combining(c)).lower()
+    s = _PUNCT_RE.sub(" ", s)
+    return _SPACES_RE.sub(" ", s).strip()
+
+
+class Speculation:
+    def __init__(self, option: str):
+        self.option = option
+        self.key = normalize_option(option)
+        self.cancel = CancelToken()
+        self.done = threading.Event()
+        self.raw: Optional[str] = None
+        self.error: Optional[Exception] = None
+        self.call_stats: Dict[str, Any] = {}
+        # Fragmentos del stream de llama.cpp (~1 token cada uno) y segundos de backend
+        self.tokens = 0
+        self.seconds = 0.0
+        # "hit" / "wasted" una vez decidido; se contabiliza cuando ademas ha terminado
+        self.fate: Optional[str] = None
+        self.settled = False
+
+    def wait(self, cancel: Optional[CancelToken] = None) -> Optional[str]:
+        # Espera a que termine (si aun se esta generando); None si se cancelo o fallo
+        unregister = cancel.register(self.cancel.set) if cancel is not None else None
+        self.done.wait()
+        if unregister is not None:
+            unregister()
+        return self.raw
+
+
+class SpeculativePrefetcher:
+    # Mientras el jugador lee, genera en segundo plano (de una en una, sin memoria) la respuesta
+    # a cada opcion sugerida. Si la entrada coincide con una opcion se entrega esa respuesta;
+    # si no, se cancelan todas para dejar libre el backend al turno real.
+    def __init__(self, service: LLMService, *, temperature: float = 0.7, max_tokens: int = 1024):
+        self.service = service
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+        self._lock = threading.Lock()
+        self._specs: List[Speculation] = []
+        self._queue: "queue.Queue[Optional[Speculation]]" = queue.Queue()
+        self._counts: Dict[str, Any] = {
+            "scheduled": 0,
+            "hits": 0,
+            "misses": 0,
+            "used_tokens": 0,
+            "wasted_tokens": 0,
+            "wasted_s": 0.0,
+        }
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def schedule(self, opciones: Any):
+        self.discard()
+        if self._closed or not isinstance(opciones, list):
+            return
+        specs = [Speculation(o.strip()) for o in opciones if isinstance(o, str) and o.strip()]
+        with self._lock:
+            self._specs = specs
+            self._counts["scheduled"] += len(specs)
+        for spec in specs:
+            self._queue.put(spec)
+
+    def claim(self, user_input: str) -> Optional[Speculation]:
+        # Entrega la especulacion que coincide con la entrada y cancela el resto
+        key = normalize_option(user_input)
+        with self._lock:
+            specs, self._specs = self._specs, []
+        if not specs:
+            return None
+
+        hit: Optional[Speculation] = None
+        for spec in specs:
+            if hit is None and spec.key == key and spec.error is None and not spec.cancel.is_set():
+                hit = spec
+                self._decide(spec, "hit")
+            else:
+                spec.cancel.set()
+                self._decide(spec, "wasted")
+        with self._lock:
+            self._counts["hits" if hit is not None else "misses"] += 1
+        return hit
+
+    def discard(self):
+        with self._lock:
+            specs, self._specs = self._specs, []
+        for spec in specs:
+            spec.cancel.set()
+            self._decide(spec, "wasted")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counts)
+        turns = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / turns, 4) if turns else 0.0
+        stats["wasted_s"] = round(stats["wasted_s"], 2)
+        return stats
+
+    def close(self):
+        # Lo que aun no empezo a generarse se da por terminado: nadie queda esperando en wait()
+        self._closed = True
+        self.discard()
+        while True:
+            try:
+                spec = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if spec is not None:
+                spec.cancel.set()
+                spec.done.set()
+                self._settle(spec)
+        self._queue.put(None)
+
+    def _decide(self, spec: Speculation, fate: str):
+        with self._lock:
+            spec.fate = fate
+        self._settle(spec)
+
+    def _settle(self, spec: Speculation):
+        # Se contabiliza una sola vez, cuando se sabe su destino y ha dejado de generar
+        with self._lock:
+            if spec.settled or spec.fate is None or not spec.done.is_set():
+                return
+            spec.settled = True
+            if spec.fate == "hit" and spec.raw is not None:
+                self._counts["used_tokens"] += spec.tokens
+            else:
+                self._counts["wasted_tokens"] += spec.tokens
+                self._counts["wasted_s"] += spec.seconds
+
+    def _run(self):
+        while True:
+            spec = self._queue.get()
+            if spec is None:
+                return
+            if not spec.cancel.is_set():
+                self._generate(spec)
+            spec.done.set()
+            self._settle(spec)
+
+    def _generate(self, spec: Speculation):
+        t0 = time.perf_counter()
+        parts = []
+        try:
+            for piece in self.service.chat_stream(
+                spec.option,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                cancel=spec.cancel,
+                remember=False,
+            ):
+                parts.append(piece)
+                spec.tokens += 1
+            spec.raw = "".join(parts).strip()
+            spec.call_stats = self.service.client.call_stats()
+        except Exception as e:
+            # RequestCancelled incluido: la especulacion se descarta sin mas
+            spec.error = e
+        spec.seconds = time.perf_counter() - t0
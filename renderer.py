@@ -1,10 +1,17 @@
+import json
+import os
 import re
+import zlib
 from typing import Any, Dict, List, Tuple, Optional
 
 import tkinter as tk
 from tkinter import font as tkfont
 
 
+# Tramos *en cursiva* dentro del texto del usuario
+_ASTERISK_RE = re.compile(r"\*(.+?)\*")
+
+
 class CharacterColors:
     def __init__(self, palette: List[str]):
         self.palette = palette
@@ -21,6 +28,63 @@ class CharacterColors:
         return color
 
 
+# Segmento de texto con sus tags, tal como se reinserta en el widget
+Segment = Tuple[str, List[str]]
+
+
+class ScrollbackArchive:
+    # Pila de turnos archivados (el ultimo es el mas cercano a la zona visible),
+    # comprimidos con zlib. Con path se vuelcan a disco y en memoria solo quedan offsets.
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._blobs: List[bytes] = []
+        self._offsets: List[Tuple[int, int]] = []
+        self.bytes_raw = 0
+        self.bytes_stored = 0
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            open(path, "wb").close()
+
+    def __len__(self) -> int:
+        return len(self._offsets) if self.path else len(self._blobs)
+
+    def push(self, segments: List[Segment]):
+        raw = json.dumps(segments, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        blob = zlib.compress(raw, 6)
+        self.bytes_raw += len(raw)
+        self.bytes_stored += len(blob)
+        if self.path:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(blob)
+            self._offsets.append((offset, len(blob)))
+        else:
+            self._blobs.append(blob)
+
+    def pop(self) -> List[Segment]:
+        if self.path:
+            offset, size = self._offsets.pop()
+            with open(self.path, "r+b") as f:
+                f.seek(offset)
+                blob = f.read(size)
+                # Es una pila: lo ultimo escrito es lo primero en salir
+                f.truncate(offset)
+        else:
+            blob = self._blobs.pop()
+        self.bytes_stored -= len(blob)
+        raw = zlib.decompress(blob)
+        self.bytes_raw -= len(raw)
+        return [(text, list(tags)) for text, tags in json.loads(raw)]
+
+    def clear(self):
+        self._blobs.clear()
+        self._offsets.clear()
+        self.bytes_raw = 0
+        self.bytes_stored = 0
+        if self.path:
+            open(self.path, "wb").close()
+
+
 class ChatRenderer:
     def __init__(
         self,
@@ -28,6 +92,9 @@ class ChatRenderer:
         character_colors: CharacterColors,
         *,
         base_font: Optional[tkfont.Font] = None,
+        max_live_turns: Optional[int] = None,
+        restore_page: int = 10,
+        archive_path: Optional[str] = None,
     ):
         self.chat = text_widget
         self.colors = character_colors
@@ -47,6 +114,25 @@ class ChatRenderer:
 
         self._font_size = int(self.base_font.cget("size"))
 
+        # Tags ya configurados en el widget (nombre -> color)
+        self._tag_registry: Dict[str, str] = {}
+
+        # Zona "en vivo" al final del chat para mostrar la respuesta mientras se genera
+        self._live_active = False
+
+        # Scrollback acotado: solo los ultimos N turnos viven en el widget; los anteriores
+        # se archivan comprimidos y se recargan al llegar arriba del todo con el scroll
+        if max_live_turns is None:
+            max_live_turns = int(os.getenv("TABERNA_SCROLLBACK_TURNS", "50"))
+        self.max_live_turns = max(1, max_live_turns)
+        self.restore_page = max(1, restore_page)
+        self.archive = ScrollbackArchive(archive_path)
+        self._scrollbar: Optional[Any] = None
+        self._restore_pending = False
+        self._block_seq = 0
+        # Marcas de inicio de cada bloque (turno) vivo, de arriba abajo; el bloque 0 es el saludo
+        self._blocks: List[str] = [self._new_block_mark("1.0")]
+
     def set_font_size(self, size: int):
         # Ajusta tamaño de fuentes usadas por todos los tags
         size = int(size)
@@ -66,41 +152,48 @@ class ChatRenderer:
         body_color: str,
         italic: bool,
     ) -> Tuple[str, str]:
+        # Registro en Python: evita consultar tag_names() (una llamada Tcl que crece con los tags)
         speaker_key = (speaker or "anon").replace(" ", "-")
         speaker_tag = f"speaker-{speaker_key}"
-        if speaker_tag not in self.chat.tag_names():
+        known = self._tag_registry.get(speaker_tag)
+        if known is None:
             self.chat.tag_configure(
                 speaker_tag,
                 foreground=speaker_color,
                 font=self.speaker_font,
             )
-        else:
+            self._tag_registry[speaker_tag] = speaker_color
+        elif known != speaker_color:
             # Por si el color cambiara (raro, pero evita inconsistencias)
             self.chat.tag_configure(speaker_tag, foreground=speaker_color)
+            self._tag_registry[speaker_tag] = speaker_color
 
         body_tag = f"body-{body_color.replace('#', '')}-{'i' if italic else 'n'}"
-        if body_tag not in self.chat.tag_names():
+        if body_tag not in self._tag_registry:
             self.chat.tag_configure(
                 body_tag,
                 foreground=body_color,
                 font=self.body_italic_font if italic else self.body_font,
             )
+            self._tag_registry[body_tag] = body_color
 
         return speaker_tag, body_tag
 
-    def _insert_with_asterisk_italics(self, text: str, normal_tag: str, italic_tag: str):
+    def _asterisk_segments(self, text: str, normal_tag: str, italic_tag: str) -> List[Tuple[str, str]]:
         s = text or ""
+        out: List[Tuple[str, str]] = []
         last = 0
-        for m in re.finditer(r"\*(.+?)\*", s):
+        for m in _ASTERISK_RE.finditer(s):
             start, end = m.span()
             if start > last:
-                self.chat.insert("end", s[last:start], normal_tag)
-            self.chat.insert("end", m.group(1), italic_tag)
+                out.append((s[last:start], normal_tag))
+            out.append((m.group(1), italic_tag))
             last = end
         if last < len(s):
-            self.chat.insert("end", s[last:], normal_tag)
+            out.append((s[last:], normal_tag))
+        return out
 
-    def append(
+    def _message_segments(
         self,
         speaker: str,
         text: str,
@@ -110,25 +203,224 @@ class ChatRenderer:
         italic: bool = False,
         show_speaker: bool = True,
         italicize_asterisks: bool = False,
-    ):
-        self.chat.configure(state="normal")
-
+    ) -> List[Tuple[str, str]]:
+        # Construye los pares (texto, tag) de un mensaje sin tocar el widget
         speaker_tag, body_tag = self._ensure_tags(speaker, speaker_color, body_color, italic)
-        _, body_italic_tag = self._ensure_tags(speaker, speaker_color, body_color, True)
+        out: List[Tuple[str, str]] = []
 
         if show_speaker and speaker:
-            self.chat.insert("end", f"{speaker}: ", speaker_tag)
+            out.append((f"{speaker}: ", speaker_tag))
 
         if italicize_asterisks and not italic:
-            self._insert_with_asterisk_italics(text, body_tag, body_italic_tag)
-            self.chat.insert("end", "\n\n", body_tag)
+            _, body_italic_tag = self._ensure_tags(speaker, speaker_color, body_color, True)
+            out.extend(self._asterisk_segments(text, body_tag, body_italic_tag))
+            out.append(("\n\n", body_tag))
         else:
-            self.chat.insert("end", f"{text}\n\n", body_tag)
+            out.append((f"{text}\n\n", body_tag))
+        return out
+
+    def _emit(self, segments: List[Tuple[str, str]], *, replace_from: Optional[str] = None):
+        # Un solo cambio de estado, un solo insert con todos los pares y un solo see()
+        if not segments and replace_from is None:
+            return
+        args: List[str] = []
+        for text, tag in segments:
+            if args and args[-1] == tag:
+                args[-2] += text
+            else:
+                args.extend((text, tag))
+
+        self.chat.configure(state="normal")
+        if replace_from is not None:
+            self.chat.delete(replace_from, "end-1c")
+        if args:
+            self.chat.insert("end", *args)
+        self.chat.configure(state="disabled")
+        if args:
+            self.chat.see("end")
+
+    def append(
+        self,
+        speaker: str,
+        text: str,
+        *,
+        speaker_color: str = "#e6e8ee",
+        body_color: str = "#e6e8ee",
+        italic: bool = False,
+        show_speaker: bool = True,
+        italicize_asterisks: bool = False,
+    ):
+        self._emit(
+            self._message_segments(
+                speaker,
+                text,
+                speaker_color=speaker_color,
+                body_color=body_color,
+                italic=italic,
+                show_speaker=show_speaker,
+                italicize_asterisks=italicize_asterisks,
+            )
+        )
+
+    def _narration_segments(self, narration: str) -> List[Tuple[str, str]]:
+        narration = (narration or "").strip()
+        if not narration:
+            return []
+        return self._message_segments(
+            "Narrador",
+            narration,
+            speaker_color="#b7beca",
+            body_color="#b7beca",
+            italic=True,
+        )
+
+    def _character_segments(self, name: str, dialog: str) -> List[Tuple[str, str]]:
+        name = (name or "").strip() or "Personaje"
+        dialog = (dialog or "").strip()
+        if not dialog:
+            return []
+        color = self.colors.get(name)
+        return self._message_segments(name, dialog, speaker_color=color, body_color=color, italic=False)
+
+    def _event_segments(self, ev: Any) -> List[Tuple[str, str]]:
+        if not isinstance(ev, dict):
+            return []
+        tipo = (ev.get("tipo") or "").strip().lower() if isinstance(ev.get("tipo"), str) else ""
+        texto = ev.get("texto", "")
+        if not isinstance(texto, str):
+            return []
+        if tipo == "narracion":
+            return self._narration_segments(texto)
+        if tipo == "dialogo":
+            nombre = ev.get("nombre", "")
+            if isinstance(nombre, str):
+                return self._character_segments(nombre, texto)
+        return []
 
+    def _choices_segments(self, choices: Any) -> List[Tuple[str, str]]:
+        if not isinstance(choices, list):
+            return []
+        clean = [c.strip() for c in choices if isinstance(c, str) and c.strip()]
+        if not clean:
+            return []
+
+        header = "Opciones sugeridas a continuación"
+        out = self._message_segments(
+            header, "", speaker_color="#a78bfa", body_color="#a78bfa", italic=False, show_speaker=True
+        )
+        lines = "\n".join(f"- {opt}" for opt in clean)
+        out.extend(
+            self._message_segments("", lines, speaker_color="#a78bfa", body_color="#a78bfa", italic=False, show_speaker=False)
+        )
+        return out
+
+    def _new_block_mark(self, index: str) -> str:
+        name = f"sb-{self._block_seq}"
+        self._block_seq += 1
+        self.chat.mark_set(name, index)
+        self.chat.mark_gravity(name, "left")
+        return name
+
+    def start_block(self):
+        # Cada mensaje del usuario abre un turno nuevo; los mas antiguos salen del widget
+        self._blocks.append(self._new_block_mark("end-1c"))
+        self._trim_blocks()
+
+    def _dump_segments(self, start: str, end: str) -> List[Segment]:
+        segments: List[Segment] = []
+        active: List[str] = []
+        for key, value, _index in self.chat.dump(start, end, text=True, tag=True):
+            if key == "tagon":
+                if value != "sel" and value not in active:
+                    active.append(value)
+            elif key == "tagoff":
+                if value in active:
+                    active.remove(value)
+            elif key == "text":
+                if segments and segments[-1][1] == active:
+                    segments[-1] = (segments[-1][0] + value, segments[-1][1])
+                else:
+                    segments.append((value, list(active)))
+        return segments
+
+    def _trim_blocks(self):
+        if len(self._blocks) <= self.max_live_turns:
+            return
+        self.chat.configure(state="normal")
+        while len(self._blocks) > self.max_live_turns:
+            first = self._blocks.pop(0)
+            end = self._blocks[0]
+            self.archive.push(self._dump_segments("1.0", end))
+            self.chat.delete("1.0", end)
+            self.chat.mark_unset(first)
+        self.chat.configure(state="disabled")
+
+    def attach_scrollbar(self, scrollbar: Any):
+        # Intercepta yscrollcommand para detectar cuando se llega al principio del chat
+        self._scrollbar = scrollbar
+        self.chat.configure(yscrollcommand=self._on_yscroll)
+
+    def _on_yscroll(self, first: str, last: str):
+        if self._scrollbar is not None:
+            self._scrollbar.set(first, last)
+        if float(first) <= 0.0 and len(self.archive) and not self._restore_pending:
+            # No se modifica el widget dentro del propio callback de scroll
+            self._restore_pending = True
+            self.chat.after_idle(self.restore_older)
+
+    def restore_older(self, count: Optional[int] = None):
+        # Reinserta arriba los turnos archivados mas recientes manteniendo la vista en su sitio
+        self._restore_pending = False
+        count = self.restore_page if count is None else count
+        if not len(self.archive) or count <= 0:
+            return
+        self.chat.mark_set("sb-view", "@0,0")
+        self.chat.mark_gravity("sb-view", "right")
+        self.chat.configure(state="normal")
+        for _ in range(min(count, len(self.archive))):
+            segments = self.archive.pop()
+            # La marca del primer bloque vivo debe desplazarse con el texto insertado
+            self.chat.mark_gravity(self._blocks[0], "right")
+            args: List[Any] = []
+            for text, tags in segments:
+                args.extend((text, tuple(tags)))
+            if args:
+                self.chat.insert("1.0", *args)
+            self.chat.mark_gravity(self._blocks[0], "left")
+            self._blocks.insert(0, self._new_block_mark("1.0"))
+        self.chat.configure(state="disabled")
+        self.chat.yview("sb-view")
+        self.chat.mark_unset("sb-view")
+
+    def clear(self):
+        self.end_live()
+        self.chat.configure(state="normal")
+        self.chat.delete("1.0", "end")
         self.chat.configure(state="disabled")
-        self.chat.see("end")
+        for name in self._blocks:
+            self.chat.mark_unset(name)
+        self.archive.clear()
+        self._blocks = [self._new_block_mark("1.0")]
+
+    def scrollback_stats(self) -> Dict[str, int]:
+        return {
+            "live_turns": len(self._blocks),
+            "archived_turns": len(self.archive),
+            "archived_bytes_raw": self.archive.bytes_raw,
+            "archived_bytes_stored": self.archive.bytes_stored,
+        }
+
+    def render_turn(self, eventos: Any, opciones: Any = None):
+        # Pinta un turno completo (eventos + opciones) en un unico lote de llamadas Tcl
+        segments: List[Tuple[str, str]] = []
+        if isinstance(eventos, list):
+            for ev in eventos:
+                segments.extend(self._event_segments(ev))
+        segments.extend(self._choices_segments(opciones))
+        self._emit(segments)
 
     def append_user(self, user_text: str):
+        self.start_block()
         self.append(
             "Usuario",
             user_text,
@@ -139,39 +431,57 @@ class ChatRenderer:
         )
 
     def append_narration(self, narration: str):
-        narration = (narration or "").strip()
-        if narration:
-            self.append(
-                "Narrador",
-                narration,
-                speaker_color="#b7beca",
-                body_color="#b7beca",
-                italic=True,
-            )
+        self._emit(self._narration_segments(narration))
 
     def append_character(self, name: str, dialog: str):
-        name = (name or "").strip() or "Personaje"
-        dialog = (dialog or "").strip()
-        if not dialog:
-            return
-        color = self.colors.get(name)
-        self.append(name, dialog, speaker_color=color, body_color=color, italic=False)
+        self._emit(self._character_segments(name, dialog))
 
     def append_choices(self, choices: Any):
-        if not isinstance(choices, list):
-            return
-        clean = [c.strip() for c in choices if isinstance(c, str) and c.strip()]
-        if not clean:
+        self._emit(self._choices_segments(choices))
+
+    def mark_turn(self):
+        # Marca el inicio de la respuesta del turno (para poder descartarla si falla)
+        self.chat.mark_set("turn_start", "end-1c")
+        self.chat.mark_gravity("turn_start", "left")
+
+    def discard_turn(self):
+        self.end_live()
+        if "turn_start" not in self.chat.mark_names():
             return
+        self.chat.configure(state="normal")
+        self.chat.delete("turn_start", "end-1c")
+        self.chat.configure(state="disabled")
+        self.chat.mark_unset("turn_start")
 
-        header = "Opciones sugeridas a continuación"
-        self.append(header, "", speaker_color="#a78bfa", body_color="#a78bfa", italic=False, show_speaker=True)
+    def begin_live(self):
+        self.end_live()
+        self.chat.mark_set("live_start", "end-1c")
+        self.chat.mark_gravity("live_start", "left")
+        self._live_active = True
 
-        lines = "\n".join(f"- {opt}" for opt in clean)
-        self.append("", lines, speaker_color="#a78bfa", body_color="#a78bfa", italic=False, show_speaker=False)
+    def update_live(self, events: List[Dict[str, Any]]):
+        # Repinta la zona en vivo con los eventos parciales (ultimo texto puede estar incompleto)
+        if not self._live_active:
+            return
+        segments: List[Tuple[str, str]] = []
+        for ev in events:
+            segments.extend(self._event_segments(ev))
+        self._emit(segments, replace_from="live_start")
+
+    def end_live(self):
+        if not self._live_active:
+            return
+        self.chat.configure(state="normal")
+        self.chat.delete("live_start", "end-1c")
+        self.chat.configure(state="disabled")
+        self.chat.mark_unset("live_start")
+        self._live_active = False
 
     def append_raw_ai(self, raw: str):
         self.append("IA", raw.strip(), speaker_color="#f59e0b", body_color="#e6e8ee")
 
+    def append_notice(self, text: str):
+        self.append("Sistema", text, speaker_color="#94a3b8", body_color="#94a3b8", italic=True)
+
     def append_error(self, err: str):
         self.append("Error", err, speaker_color="#ef4444", body_color="#ef4444")
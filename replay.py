@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from llm_client import LLMClient
+from llm_service import LLMService
+from logger import iter_log_turns
+from parser import ResponseParser
+
+INPUT_FIELDS = ("input", "user_input", "text", "prompt")
+
+
+def iter_jsonl_inputs(path: str, field: Optional[str] = None) -> Iterator[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(item, str):
+                value: Any = item
+            elif isinstance(item, dict):
+                fields = (field,) if field else INPUT_FIELDS
+                value = next((item[k] for k in fields if isinstance(item.get(k), str)), None)
+            else:
+                value = None
+            if isinstance(value, str) and value.strip():
+                yield value.strip()
+
+
+def iter_log_inputs(path: str) -> Iterator[str]:
+    for turn in iter_log_turns(path):
+        if turn["user_input"].strip():
+            yield turn["user_input"].strip()
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ReplayRunner:
+    # Pasa un corpus de entradas por LLMService.chat + ResponseParser.parse con un pool de hilos.
+    # Cada turno es independiente (sin memoria) para que el resultado no dependa del orden.
+
+    def __init__(
+        self,
+        *,
+        prompt_path: str = "prompts/predefined_prompt.txt",
+        workers: int = 4,
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        seed: Optional[int] = None,
+    ):
+        self.prompt_path = prompt_path
+        self.workers = max(1, workers)
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.seed = seed
+
+        self.client = LLMClient(pool_size=self.workers)
+        self.parser = ResponseParser()
+        self._local = threading.local()
+
+    def _service(self) -> LLMService:
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = LLMService(self.prompt_path, memory_tokens=0, client=self.client)
+            self._local.service = service
+        return service
+
+    def run_one(self, index: int, user_input: str) -> Dict[str, Any]:
+        service = self._service()
+        t0 = time.perf_counter()
+        record: Dict[str, Any] = {"index": index, "input": user_input}
+        try:
+            raw = service.chat(user_input, temperature=self.temperature, max_tokens=self.max_tokens, seed=self.seed)
+            outcome = self.parser.parse(raw)
+            record.update(raw=raw, parse_ok=outcome.parse_ok, format_ok=outcome.format_ok, error=outcome.error)
+        except Exception as e:
+            record.update(raw="", parse_ok=False, format_ok=False, error=f"[ERROR] {e}")
+        record["latency_ms"] = round(1000 * (time.perf_counter() - t0), 1)
+        record["prompt_rev"] = service.prompt_revision
+        record["retries"] = self.client.last_retries
+        if self.client.last_result is not None:
+            record["completion"] = self.client.last_result.as_dict()
+        if self.client.last_truncation:
+            record["truncation"] = dict(self.client.last_truncation)
+        if service.last_candidates:
+            record["candidates"] = dict(service.last_candidates)
+        return record
+
+    def run(self, inputs: Iterator[str], out_path: str, limit: Optional[int] = None) -> Dict[str, Any]:
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        latencies: List[float] = []
+        counts = {"total": 0, "parse_ok": 0, "format_ok": 0, "errors": 0}
+        t0 = time.perf_counter()
+
+        # Ventana acotada de trabajos en vuelo: el corpus se lee en streaming
+        pending: Set[Future] = set()
+        window = self.workers * 2
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="replay") as ex, open(
+            out_path, "w", encoding="utf-8"
+        ) as out:
+
+            def drain():
+                nonlocal pending
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    rec = fut.result()
+                    out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                    counts["total"] += 1
+                    counts["parse_ok"] += int(rec["parse_ok"])
+                    counts["format_ok"] += int(rec["format_ok"])
+                    counts["errors"] += int(rec["error"].startswith("[ERROR]"))
+                    latencies.append(rec["latency_ms"])
+
+            for i, user_input in enumerate(inputs):
+                if limit is not None and i >= limit:
+                    break
+                pending.add(ex.submit(self.run_one, i, user_input))
+                if len(pending) >= window:
+                    drain()
+            while pending:
+                drain()
+
+        elapsed = time.perf_counter() - t0
+        total = counts["total"]
+        return {
+            "total": total,
+            "parse_ok_rate": round(counts["parse_ok"] / total, 4) if total else 0.0,
+            "format_ok_rate": round(counts["format_ok"] / total, 4) if total else 0.0,
+            "errors": counts["errors"],
+            "elapsed_s": round(elapsed, 2),
+            "turns_per_s": round(total / elapsed, 3) if elapsed > 0 else 0.0,
+            "latency_ms_p50": percentile(latencies, 0.50),
+            "latency_ms_p90": percentile(latencies, 0.90),
+            "latency_ms_p95": percentile(latencies, 0.95),
+            "latency_ms_p99": percentile(latencies, 0.99),
+            "truncation": self.client.truncation_stats(),
+            "out": out_path,
+        }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Reproduce un corpus de entradas contra el pipeline del Master")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--jsonl", help="fichero JSONL con entradas (campo input/user_input/text/prompt o strings)")
+    src.add_argument("--log", help="log de partida (formato de GameLogger) del que sacar las entradas USER")
+    ap.add_argument("--field", help="campo del JSONL con la entrada del jugador")
+    ap.add_argument("--out", default=None, help="JSONL de resultados (por defecto outputs/replay_<fecha>.jsonl)")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--limit", type=int, default=None)
+    ap.add_argument("--prompt", default="prompts/predefined_prompt.txt")
+    ap.add_argument("--temperature", type=float, default=0.7)
+    ap.add_argument("--max-tokens", type=int, default=1024)
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args(argv)
+
+    inputs = iter_jsonl_inputs(args.jsonl, args.field) if args.jsonl else iter_log_inputs(args.log)
+    out_path = args.out or os.path.join("outputs", f"replay_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+
+    runner = ReplayRunner(
+        prompt_path=args.prompt,
+        workers=args.workers,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        seed=args.seed,
+    )
+    summary = runner.run(inputs, out_path, limit=args.limit)
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,506 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import struct
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+from llm_client import LLMClient
+from llm_service import LLMService
+from logger import GameLogger
+from parser import ResponseParser
+
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class FairScheduler:
+    # Limita las peticiones en vuelo al numero de slots del backend y reparte los
+    # huecos en round-robin entre sesiones, para que un jugador muy activo no acapare.
+
+    def __init__(self, slots: int):
+        self.slots = max(1, int(slots))
+        self.in_flight = 0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def acquire(self, key: str) -> float:
+        # Devuelve el tiempo de espera en cola (segundos)
+        if self.in_flight < self.slots and not self._queues:
+            self.in_flight += 1
+            return 0.0
+
+        t0 = time.perf_counter()
+        fut = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Se le concedio el slot justo antes de cancelarse
+                self.release()
+            else:
+                q = self._queues.get(key)
+                if q is not None and fut in q:
+                    q.remove(fut)
+                    if not q:
+                        del self._queues[key]
+            raise
+        return time.perf_counter() - t0
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.in_flight < self.slots and self._queues:
+            key, q = next(iter(self._queues.items()))
+            fut = q.popleft()
+            if q:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if fut.done():
+                continue
+            self.in_flight += 1
+            fut.set_result(None)
+
+
+class ServerMetrics:
+    def __init__(self, window_s: float = 60.0, samples: int = 1000):
+        self.started = time.time()
+        self.window_s = window_s
+        self.turns = 0
+        self.errors = 0
+        self._done_at: Deque[float] = deque()
+        self._waits: Deque[float] = deque(maxlen=samples)
+        self._latencies: Deque[float] = deque(maxlen=samples)
+
+    def record(self, wait_s: float, latency_s: float, ok: bool):
+        now = time.time()
+        self.turns += 1
+        if not ok:
+            self.errors += 1
+        self._done_at.append(now)
+        self._waits.append(wait_s)
+        self._latencies.append(latency_s)
+
+    def _percentile(self, values: Deque[float], q: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self, scheduler: FairScheduler, sessions: int) -> Dict[str, Any]:
+        now = time.time()
+        while self._done_at and self._done_at[0] < now - self.window_s:
+            self._done_at.popleft()
+        span = min(self.window_s, max(1e-6, now - self.started))
+        return {
+            "uptime_s": round(now - self.started, 1),
+            "sessions": sessions,
+            "turns_total": self.turns,
+            "errors_total": self.errors,
+            "turns_per_s": round(len(self._done_at) / span, 3),
+            "in_flight": scheduler.in_flight,
+            "queued": scheduler.queued,
+            "slots": scheduler.slots,
+            "queue_wait_ms_avg": round(1000 * sum(self._waits) / len(self._waits), 1) if self._waits else 0.0,
+            "queue_wait_ms_p95": round(1000 * self._percentile(self._waits, 0.95), 1),
+            "latency_ms_p50": round(1000 * self._percentile(self._latencies, 0.50), 1),
+            "latency_ms_p95": round(1000 * self._percentile(self._latencies, 0.95), 1),
+        }
+
+
+class Session:
+    def __init__(self, session_id: str, service: LLMService):
+        self.id = session_id
+        self.service = service
+        # Los turnos de una misma sesion van en orden
+        self.lock = asyncio.Lock()
+        self.last_seen = time.time()
+
+
+class TavernServer:
+    def __init__(
+        self,
+        *,
+        prompt_path: str = "prompts/predefined_prompt.txt",
+        log_path: str = os.path.join("outputs", "sessions.jsonl"),
+        slots: int = 4,
+        memory_tokens: int = 1200,
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        session_ttl: float = 1800.0,
+        max_body: int = 64 * 1024,
+    ):
+        # Cada candidata ocuparia un slot por su cuenta, fuera del reparto del scheduler
+        if int(os.getenv("LLAMA_CANDIDATES", "1")) > 1:
+            raise ValueError("LLAMA_CANDIDATES > 1 no esta soportado en el servidor multi-sesion")
+
+        self.prompt_path = prompt_path
+        self.memory_tokens = memory_tokens
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        # Sesiones sin actividad durante session_ttl segundos se descartan (0 = nunca)
+        self.session_ttl = session_ttl
+        # Tamano maximo de un cuerpo HTTP o de un mensaje WebSocket
+        self.max_body = max_body
+        self.sessions_evicted = 0
+        self._last_sweep = time.time()
+
+        # Un solo cliente (pool de conexiones) para todas las sesiones
+        self.client = LLMClient(pool_size=slots)
+        self.parser = ResponseParser()
+        # Un solo logger de fondo para todas las sesiones (cada registro lleva su sesion)
+        self.logger = GameLogger(log_path=log_path)
+        self.scheduler = FairScheduler(slots)
+        self.metrics = ServerMetrics()
+        self.sessions: Dict[str, Session] = {}
+        self._executor = ThreadPoolExecutor(max_workers=slots + 2, thread_name_prefix="taberna")
+
+    def get_session(self, session_id: str) -> Session:
+        # Se llama desde el bucle de eventos (run_turn)
+        self._evict_idle()
+        session = self.sessions.get(session_id)
+        if session is None:
+            loop = asyncio.get_running_loop()
+            service = LLMService(
+                self.prompt_path,
+                memory_tokens=self.memory_tokens,
+                client=self.client,
+                candidates=1,
+                memory_gate=lambda: self._scheduled(loop, session_id),
+            )
+            session = Session(session_id, service)
+            self.sessions[session_id] = session
+        session.last_seen = time.time()
+        return session
+
+    def _evict_idle(self):
+        # Barrido como mucho una vez por minuto; las sesiones con un turno en curso no se tocan
+        now = time.time()
+        if not self.session_ttl or now - self._last_sweep < min(60.0, self.session_ttl):
+            return
+        self._last_sweep = now
+        idle = [
+            sid
+            for sid, session in self.sessions.items()
+            if now - session.last_seen > self.session_ttl and not session.lock.locked()
+        ]
+        for sid in idle:
+            del self.sessions[sid]
+        self.sessions_evicted += len(idle)
+
+    @contextmanager
+    def _scheduled(self, loop: asyncio.AbstractEventLoop, key: str) -> Iterator[None]:
+        # Trabajo de fondo de la memoria (resumenes) desde otro hilo: ocupa un slot como un turno
+        asyncio.run_coroutine_threadsafe(self.scheduler.acquire(key), loop).result()
+        try:
+            yield
+        finally:
+            loop.call_soon_threadsafe(self.scheduler.release)
+
+    def _chat(self, service: LLMService, user_input: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        # En el hilo del executor: la telemetria de la completion es por hilo
+        raw = service.chat(user_input, self.temperature, self.max_tokens)
+        result = service.client.last_result
+        return raw, result.as_dict() if result is not None else None
+
+    async def run_turn(self, session_id: str, user_input: str) -> Dict[str, Any]:
+        session = self.get_session(session_id)
+        loop = asyncio.get_running_loop()
+
+        async with session.lock:
+            t0 = time.perf_counter()
+            wait_s = await self.scheduler.acquire(session_id)
+            try:
+                raw, completion = await loop.run_in_executor(self._executor, self._chat, session.service, user_input)
+                outcome = self.parser.parse(raw)
+                error = outcome.error
+            except Exception as e:
+                raw, outcome, error, completion = f"[ERROR] {e}", None, str(e), None
+            finally:
+                self.scheduler.release()
+            latency_s = time.perf_counter() - t0
+
+            parse_ok = bool(outcome and outcome.parse_ok)
+            format_ok = bool(outcome and outcome.format_ok)
+            self.logger.log_turn(
+                user_input=user_input,
+                raw_response=raw,
+                parse_ok=parse_ok,
+                format_ok=format_ok,
+                error=error,
+                stats={"prompt_rev": session.service.prompt_revision},
+                timings={"queue_wait": round(1000 * wait_s, 1), "total": round(1000 * latency_s, 1)},
+                session=session_id,
+                completion=completion,
+                data=outcome.data if outcome else None,
+            )
+
+        self.metrics.record(wait_s, latency_s, outcome is not None)
+        return {
+            "session": session_id,
+            "parse_ok": parse_ok,
+            "format_ok": format_ok,
+            "error": error,
+            "data": outcome.data if outcome and format_ok else None,
+            "raw": None if format_ok else raw,
+            "queue_wait_ms": round(1000 * wait_s, 1),
+            "latency_ms": round(1000 * latency_s, 1),
+        }
+
+    def drop_session(self, session_id: str) -> bool:
+        return self.sessions.pop(session_id, None) is not None
+
+    def metrics_snapshot(self) -> Dict[str, Any]:
+        snapshot = self.metrics.snapshot(self.scheduler, len(self.sessions))
+        snapshot["sessions_evicted"] = self.sessions_evicted
+        if self.client.cache is not None:
+            snapshot["cache"] = self.client.cache.stats()
+        snapshot["truncation"] = self.client.truncation_stats()
+        if self.client.router is not None:
+            snapshot["router"] = self.client.router.stats()
+        snapshot["log"] = self.logger.stats()
+        return snapshot
+
+    # --- HTTP ---
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except RequestTooLarge as e:
+                    await self._write_json(writer, 413, {"error": str(e)}, False)
+                    break
+                except ValueError:
+                    await self._write_json(writer, 400, {"error": "peticion invalida"}, False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                if headers.get("upgrade", "").lower() == "websocket" and path.startswith("/ws/"):
+                    await self._handle_websocket(path[len("/ws/") :], headers, reader, writer)
+                    break
+
+                status, payload = await self._route(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._write_json(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) < 2:
+            return None
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            if ":" in line:
+                k, v = line.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+        length = int(headers.get("content-length", "0") or 0)
+        if length < 0:
+            raise ValueError("content-length negativo")
+        if length > self.max_body:
+            raise RequestTooLarge(f"cuerpo demasiado grande ({length} > {self.max_body} bytes)")
+        body = await reader.readexactly(length) if length else b""
+        return parts[0].upper(), parts[1], headers, body
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics_snapshot()
+
+        m = re.match(r"^/sessions/([^/]+)(/turn)?$", path)
+        if not m or not SESSION_ID_RE.match(m.group(1)):
+            return 404, {"error": "ruta no encontrada"}
+        session_id = m.group(1)
+
+        if method == "DELETE" and not m.group(2):
+            return (200, {"deleted": session_id}) if self.drop_session(session_id) else (404, {"error": "sesion no existe"})
+
+        if method == "POST" and m.group(2):
+            user_input = self._extract_input(body)
+            if not user_input:
+                return 400, {"error": "falta 'input'"}
+            return 200, await self.run_turn(session_id, user_input)
+
+        return 405, {"error": "metodo no permitido"}
+
+    def _extract_input(self, body: bytes) -> str:
+        text = body.decode("utf-8", errors="replace").strip()
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            return text
+        if isinstance(data, dict):
+            value = data.get("input")
+            return value.strip() if isinstance(value, str) else ""
+        return ""
+
+    async def _write_json(self, writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any], keep_alive: bool):
+        reasons = {
+            200: "OK",
+            400: "Bad Request",
+            404: "Not Found",
+            405: "Method Not Allowed",
+            413: "Payload Too Large",
+        }
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {reasons.get(status, 'OK')}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    # --- WebSocket (RFC 6455, solo lo necesario: texto, ping y cierre) ---
+
+    async def _handle_websocket(
+        self,
+        session_id: str,
+        headers: Dict[str, str],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        key = headers.get("sec-websocket-key", "")
+        if not key or not SESSION_ID_RE.match(session_id):
+            await self._write_json(writer, 400, {"error": "handshake websocket invalido"}, False)
+            return
+
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode("ascii")).digest()).decode("ascii")
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+
+        while True:
+            frame = await self._read_ws_message(reader, writer)
+            if frame is None:
+                break
+            user_input = self._extract_input(frame)
+            if not user_input:
+                result: Dict[str, Any] = {"error": "falta 'input'"}
+            else:
+                result = await self.run_turn(session_id, user_input)
+            await self._send_ws(writer, 0x1, json.dumps(result, ensure_ascii=False).encode("utf-8"))
+
+    async def _read_ws_message(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[bytes]:
+        message = b""
+        while True:
+            b1, b2 = await reader.readexactly(2)
+            fin, opcode = b1 & 0x80, b1 & 0x0F
+            length = b2 & 0x7F
+            if length == 126:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+            elif length == 127:
+                (length,) = struct.unpack("!Q", await reader.readexactly(8))
+            if len(message) + length > self.max_body:
+                # 1009: mensaje demasiado grande; no se lee el resto
+                await self._send_ws(writer, 0x8, struct.pack("!H", 1009))
+                return None
+            mask = await reader.readexactly(4) if b2 & 0x80 else b""
+            data = await reader.readexactly(length)
+            if mask:
+                data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+            if opcode == 0x8:
+                await self._send_ws(writer, 0x8, data[:2])
+                return None
+            if opcode == 0x9:
+                await self._send_ws(writer, 0xA, data)
+                continue
+            if opcode == 0xA:
+                continue
+
+            message += data
+            if fin:
+                return message
+
+    async def _send_ws(self, writer: asyncio.StreamWriter, opcode: int, data: bytes):
+        head = bytes([0x80 | opcode])
+        n = len(data)
+        if n < 126:
+            head += bytes([n])
+        elif n < 65536:
+            head += bytes([126]) + struct.pack("!H", n)
+        else:
+            head += bytes([127]) + struct.pack("!Q", n)
+        writer.write(head + data)
+        await writer.drain()
+
+
+async def serve(host: str, port: int, server: TavernServer):
+    srv = await asyncio.start_server(server.handle_connection, host, port)
+    print(f"Taberna escuchando en http://{host}:{port} (slots={server.scheduler.slots})")
+    async with srv:
+        await srv.serve_forever()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Servidor headless multi-sesion (HTTP + WebSocket)")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--slots", type=int, default=int(os.getenv("LLAMA_SLOTS", "4")))
+    ap.add_argument("--prompt", default="prompts/predefined_prompt.txt")
+    ap.add_argument("--log", default=os.path.join("outputs", "sessions.jsonl"))
+    ap.add_argument("--memory-tokens", type=int, default=1200)
+    ap.add_argument("--session-ttl", type=float, default=1800.0, help="segundos sin actividad (0 = sin limite)")
+    ap.add_argument("--max-body", type=int, default=64 * 1024, help="bytes por peticion o mensaje WebSocket")
+    args = ap.parse_args()
+
+    try:
+        server = TavernServer(
+            prompt_path=args.prompt,
+            log_path=args.log,
+            slots=args.slots,
+            memory_tokens=args.memory_tokens,
+            session_ttl=args.session_ttl,
+            max_body=args.max_body,
+        )
+    except ValueError as e:
+        ap.error(str(e))
+    try:
+        asyncio.run(serve(args.host, args.port, server))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.logger.close()
+
+
+if __name__ == "__main__":
+    main()
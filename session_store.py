@@ -0,0 +1,50 @@
+import json
+import os
+import re
+import zlib
+from datetime import datetime
+from typing import Any, Dict
+
+from logger import TS_FORMAT
+
+# Cabecera + JSON comprimido con zlib; la version cambia si cambia la estructura
+MAGIC = b"TABERNA-SESSION\n"
+SESSION_VERSION = 1
+
+_UNSAFE_RE = re.compile(r"[^\w.-]")
+
+
+def slot_filename(session_key: str) -> str:
+    # llama.cpp solo acepta nombres de fichero simples dentro de --slot-save-path
+    return f"taberna-{_UNSAFE_RE.sub('_', session_key)}.bin"
+
+
+def save_session(path: str, state: Dict[str, Any]) -> int:
+    # state: transcript, colors, llm (LLMService.snapshot) y slot (LLMService.save_slot).
+    # Escritura atomica: una partida guardada nunca queda a medias. Devuelve los bytes escritos
+    record = {"v": SESSION_VERSION, "saved_at": datetime.now().strftime(TS_FORMAT), **state}
+    raw = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    blob = MAGIC + zlib.compress(raw, 9)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(blob)
+
+
+def load_session(path: str) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        blob = f.read()
+    if not blob.startswith(MAGIC):
+        raise ValueError(f"{path} no es una partida guardada")
+    try:
+        record = json.loads(zlib.decompress(blob[len(MAGIC) :]))
+    except (zlib.error, json.JSONDecodeError) as e:
+        raise ValueError(f"partida guardada corrupta: {e}")
+    if not isinstance(record, dict) or record.get("v") != SESSION_VERSION:
+        raise ValueError(f"version de partida no soportada: {record.get('v') if isinstance(record, dict) else '?'}")
+    return record
@@ -0,0 +1,93 @@
+import re
+from collections import Counter
+from typing import Optional, Set, Tuple
+
+from parser import IncrementalParser, ResponseParser
+
+# Esqueleto JSON del turno: se quita antes de buscar repeticiones (se repite por diseño)
+_SKELETON_RE = re.compile(r'"(?:eventos|opciones|tipo|nombre|texto)"\s*:|"(?:narracion|dialogo)"|[{}\[\],:"]')
+_WORD_RE = re.compile(r"\w+")
+# Strings entre comillas del prompt (ejemplos de turno): copiarlos no es eco de instrucciones
+_QUOTED_RE = re.compile(r'"[^"\n]*"')
+
+
+class GuardTripped(Exception):
+    def __init__(self, reason: str, tokens: int):
+        super().__init__(f"generacion abortada ({reason}) tras {tokens} tokens")
+        self.reason = reason
+        self.tokens = tokens
+
+
+class GenerationGuard:
+    # Vigila el stream de una generacion y la corta en cuanto degenera:
+    #  - "repeticion": algun n-grama de palabras aparece max_repeats veces
+    #  - "eco": buena parte de lo generado son n-gramas copiados de reference (las instrucciones)
+    #  - "sin_progreso": progress_tokens fragmentos sin cerrar ningun evento/opciones
+    #  - "estructura": el JSON ya no puede ser valido
+    # Los fragmentos del stream de llama.cpp son ~1 token cada uno.
+    def __init__(
+        self,
+        reference: str,
+        validator: Optional[ResponseParser] = None,
+        *,
+        ngram: int = 6,
+        max_repeats: int = 3,
+        echo_ngram: int = 8,
+        echo_ratio: float = 0.5,
+        echo_min: int = 10,
+        progress_tokens: int = 400,
+        check_every: int = 16,
+    ):
+        self.ngram = ngram
+        self.max_repeats = max_repeats
+        self.echo_ngram = echo_ngram
+        self.echo_ratio = echo_ratio
+        self.echo_min = echo_min
+        self.progress_tokens = progress_tokens
+        self.check_every = check_every
+
+        self._prompt_ngrams = self._ngrams(self._words(_QUOTED_RE.sub(" ", reference)), echo_ngram)
+        self._parser = IncrementalParser(validator)
+        self.tokens = 0
+        self._last_progress = 0
+        self.reason = ""
+
+    @staticmethod
+    def _words(text: str):
+        return _WORD_RE.findall(_SKELETON_RE.sub(" ", text).lower())
+
+    @staticmethod
+    def _ngrams(words, n: int) -> Set[Tuple[str, ...]]:
+        return {tuple(words[i : i + n]) for i in range(len(words) - n + 1)}
+
+    def feed(self, piece: str) -> Optional[str]:
+        # Devuelve el motivo si hay que abortar (y lo deja en self.reason)
+        if self.reason:
+            return self.reason
+        self.tokens += 1
+        if self._parser.feed(piece):
+            self._last_progress = self.tokens
+        if self._parser.error:
+            self.reason = "estructura"
+        elif self._parser.done:
+            return None
+        elif self.tokens - self._last_progress > self.progress_tokens:
+            self.reason = "sin_progreso"
+        elif self.tokens % self.check_every == 0:
+            self.reason = self._check_text(self._parser.text)
+        return self.reason or None
+
+    def _check_text(self, text: str) -> str:
+        words = self._words(text)
+        n = self.ngram
+        if len(words) >= n * self.max_repeats:
+            counts = Counter(tuple(words[i : i + n]) for i in range(len(words) - n + 1))
+            if counts and counts.most_common(1)[0][1] >= self.max_repeats:
+                return "repeticion"
+
+        grams = [tuple(words[i : i + self.echo_ngram]) for i in range(len(words) - self.echo_ngram + 1)]
+        if len(grams) >= self.echo_min:
+            echoed = sum(1 for g in grams if g in self._prompt_ngrams)
+            if echoed / len(grams) >= self.echo_ratio:
+                return "eco"
+        return ""
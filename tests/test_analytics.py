@@ -0,0 +1,55 @@
+import json
+
+import numpy as np
+
+from analytics import load_columns
+from benchmarks.stub_server import MALFORMED, SAMPLE_TURN
+from logger import GameLogger
+from parser import ResponseParser
+
+
+def _write_log(path, with_shape: bool):
+    parser = ResponseParser()
+    logger = GameLogger(str(path), fsync="never")
+    raws = [json.dumps(SAMPLE_TURN, ensure_ascii=False), *MALFORMED, '["no", "objeto"]']
+    for i, raw in enumerate(raws * 3):
+        outcome = parser.parse(raw)
+        logger.log_turn(
+            f"turno {i}",
+            raw,
+            outcome.parse_ok,
+            outcome.format_ok,
+            outcome.error,
+            timings={"total": 10.0 + i},
+            data=outcome.data,
+        )
+    logger.close()
+    if not with_shape:
+        # Log de una version anterior: sin el campo shape
+        with open(path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        with open(path, "w", encoding="utf-8") as f:
+            for r in records:
+                r.pop("shape", None)
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+
+def test_shape_matches_decoding_raw(tmp_path, monkeypatch):
+    new, old = tmp_path / "new.jsonl", tmp_path / "old.jsonl"
+    _write_log(new, with_shape=True)
+    _write_log(old, with_shape=False)
+
+    import analytics
+
+    calls = []
+    real = analytics._load_data
+    monkeypatch.setattr(analytics, "_load_data", lambda p, raw: calls.append(raw) or real(p, raw))
+    cols_new = load_columns([str(new)])
+    assert calls == []
+    cols_old = load_columns([str(old)])
+    assert calls
+
+    for name in ("n_eventos", "n_opciones", "speaker", "speaker_chars", "latency_ms"):
+        assert np.array_equal(getattr(cols_new, name), getattr(cols_old, name)), name
+    assert cols_new.speakers == cols_old.speakers
+    assert int(cols_new.n_eventos.max()) == len(SAMPLE_TURN["eventos"])
@@ -0,0 +1,60 @@
+import queue
+import socket
+import threading
+import time
+
+import pytest
+
+tk = pytest.importorskip("tkinter")
+
+from app import ChatUI  # noqa: E402
+
+
+class FakeRenderer:
+    def __init__(self):
+        self.errors = []
+
+    def append_error(self, text: str):
+        self.errors.append(text)
+
+
+def _headless_ui() -> ChatUI:
+    # Solo el estado que usan _init_backend y on_send: sin ventana (no hay DISPLAY en CI)
+    ui = ChatUI.__new__(ChatUI)
+    ui._t0 = time.perf_counter()
+    ui.startup = {}
+    ui.result_q = queue.Queue()
+    ui._backend_ready = threading.Event()
+    ui._painted = threading.Event()
+    ui._backend_error = ""
+    ui.prefetch = None
+    ui.renderer = FakeRenderer()
+    return ui
+
+
+def test_backend_init_failure_is_reported(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    busy = socket.socket()
+    busy.bind(("127.0.0.1", 0))
+    busy.listen()
+    monkeypatch.setenv("TABERNA_METRICS_PORT", str(busy.getsockname()[1]))
+    monkeypatch.setenv("LLAMA_CACHE", "off")
+    try:
+        ui = _headless_ui()
+        ui._init_backend()
+    finally:
+        busy.close()
+
+    assert not ui._backend_ready.is_set()
+    status, _turn, _input, payload, _stats = ui.result_q.get_nowait()
+    assert status == "backend_error" and payload == ui._backend_error
+
+    # on_send ya no reintenta en bucle: informa del fallo
+    class Entry:
+        def get(self):
+            return "hola"
+
+    ui.entry = Entry()
+    monkeypatch.setattr(ChatUI, "after", lambda *_a: pytest.fail("on_send no debe reprogramarse"), raising=False)
+    ui.on_send()
+    assert ui.renderer.errors == [ui._backend_error]
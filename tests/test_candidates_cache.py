@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from benchmarks.stub_server import SAMPLE_TURN, StubLlamaServer
+from llm_cache import ResponseCache
+
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    server = StubLlamaServer().start()
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", server.completion_url)
+    from llm_client import LLMClient
+    from llm_service import LLMService
+
+    client = LLMClient(cache=ResponseCache(str(tmp_path / "cache")))
+    svc = LLMService(client=client, candidates=3, guard=False, memory_tokens=0)
+    yield svc
+    client.close()
+    server.stop()
+
+
+def _disk_entries(svc) -> int:
+    return sum(1 for _ in svc.client.cache._disk_files())
+
+
+def test_race_with_random_seeds_does_not_fill_the_cache(service):
+    for _ in range(3):
+        assert json.loads(service.chat("Entro en la taberna")) == SAMPLE_TURN
+    assert _disk_entries(service) == 0
+    assert service.client.cache.stats()["memory_entries"] == 0
+
+
+def test_race_with_caller_seed_is_cached(service):
+    raw = service.chat("Entro en la taberna", seed=7)
+    assert _disk_entries(service) >= 1
+    hits = service.client.cache.stats()["hits"]
+    assert service.chat("Entro en la taberna", seed=7) == raw
+    assert service.client.cache.stats()["hits"] > hits
@@ -0,0 +1,58 @@
+import socket
+import threading
+
+import pytest
+import requests
+
+
+def _client(monkeypatch, url: str):
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", url)
+    monkeypatch.setenv("LLAMA_CACHE", "off")
+    from llm_client import LLMClient
+
+    client = LLMClient(max_retries=2, backoff_base=0.0, backoff_max=0.0)
+    return client
+
+
+def test_connect_failure_is_retried(monkeypatch):
+    # Puerto sin nadie escuchando: la peticion no llega a salir
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    client = _client(monkeypatch, f"http://127.0.0.1:{port}/completion")
+    try:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.complete_with_grammar("hola")
+        assert client.last_retries == 2
+    finally:
+        client.close()
+
+
+def test_reset_after_sending_is_not_retried(monkeypatch):
+    # El servidor recibe la peticion (y podria estar generando) y corta la conexion
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            accepted.append(conn)
+            conn.recv(65536)
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    client = _client(monkeypatch, f"http://127.0.0.1:{listener.getsockname()[1]}/completion")
+    try:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.complete_with_grammar("hola")
+        assert client.last_retries == 0
+        assert len(accepted) == 1
+    finally:
+        client.close()
+        listener.close()
@@ -0,0 +1,99 @@
+import json
+import time
+
+import pytest
+
+from benchmarks.stub_server import SAMPLE_TURN, StubLlamaServer
+
+
+@pytest.fixture
+def client(monkeypatch):
+    server = StubLlamaServer().start()
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", server.completion_url)
+    monkeypatch.setenv("LLAMA_CACHE", "off")
+    monkeypatch.setenv("LLAMA_MAX_CONTINUATIONS", "2")
+    monkeypatch.setenv("LLAMA_CONTINUE_TOKENS", "400")
+    from llm_client import LLMClient
+
+    c = LLMClient()
+    yield c
+    c.close()
+    server.stop()
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_result_is_the_only_telemetry(client, stream):
+    if stream:
+        raw = "".join(client.stream_with_grammar("hola", max_tokens=1024))
+    else:
+        raw = client.complete_with_grammar("hola", max_tokens=1024)
+    assert json.loads(raw) == SAMPLE_TURN
+    assert not hasattr(client, "last_prompt_stats")
+
+    result = client.last_result
+    assert result.content == raw
+    assert result.stop_type == "eos" and result.id_slot == 0
+    assert result.prompt_n > 0 and result.predicted_n > 0
+    assert result.base_url == client.base_url
+    assert "prompt_stats" not in client.call_stats()
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_truncation_reads_the_result(client, stream):
+    if stream:
+        raw = "".join(client.stream_with_grammar("hola", max_tokens=20))
+    else:
+        raw = client.complete_with_grammar("hola", max_tokens=20)
+    assert json.loads(raw) == SAMPLE_TURN
+
+    info = client.last_truncation
+    result = client.last_result
+    assert info["predicted_n"] == 20 and info["resolved"]
+    assert result.continuations == info["continuations"] == 1
+    if not stream:
+        # En stream la conexion se corta al cerrarse el JSON, antes del evento final con timings
+        assert result.predicted_n > 20 and result.stop_type == "eos"
+
+
+def test_stub_stream_delivers_each_token_as_it_is_generated(monkeypatch):
+    from benchmarks.stub_server import StubConfig
+    from llm_client import LLMClient
+
+    server = StubLlamaServer(config=StubConfig(tokens_per_s=20)).start()
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", server.completion_url)
+    monkeypatch.setenv("LLAMA_CACHE", "off")
+    client = LLMClient()
+    try:
+        t0 = time.perf_counter()
+        stream = client.stream_with_grammar("hola", max_tokens=1024)
+        next(stream)
+        # Con el stream bufferizado el primer fragmento llegaba con una docena de tokens de retraso
+        assert time.perf_counter() - t0 < 0.3
+        stream.close()
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_cache_hit_after_truncated_turn_does_not_recount(monkeypatch, tmp_path):
+    from llm_cache import ResponseCache
+    from llm_client import LLMClient
+    from llm_service import LLMService
+
+    server = StubLlamaServer().start()
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", server.completion_url)
+    monkeypatch.setenv("LLAMA_MAX_CONTINUATIONS", "0")
+    client = LLMClient(cache=ResponseCache(str(tmp_path / "cache")))
+    service = LLMService(client=client, candidates=1, guard=False, memory_tokens=0)
+    try:
+        # Cortada en n_predict y sin continuaciones: la salva el parser
+        first = service.chat("hola", max_tokens=80, seed=7)
+        stats = client.truncation_stats()
+        assert stats["repaired"] == 1 and stats["salvaged_tokens"] == 80
+
+        assert service.chat("hola", max_tokens=80, seed=7) == first
+        assert client.last_result.cached and client.last_truncation == {}
+        assert client.truncation_stats() == stats
+    finally:
+        client.close()
+        server.stop()
@@ -0,0 +1,55 @@
+import threading
+import time
+
+from memory import ConversationMemory
+
+
+class SlowTokenizer:
+    # Cliente falso: /tokenize tarda y cuenta una palabra por token
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def count_tokens(self, text: str) -> int:
+        self.release.wait(5.0)
+        self.calls += 1
+        return len(text.split())
+
+    def complete_plain(self, prompt: str, temperature: float = 0.3, max_tokens: int = 256) -> str:
+        return "resumen"
+
+
+def _wait(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_add_turn_does_not_wait_for_tokenize():
+    client = SlowTokenizer()
+    memory = ConversationMemory(client, token_budget=1000)
+
+    t0 = time.perf_counter()
+    memory.add_turn("Entro en la taberna", "Aida te mira desde la barra")
+    assert time.perf_counter() - t0 < 0.5
+    assert memory.turns[0].estimated and memory.recent_tokens() > 0
+
+    client.release.set()
+    assert _wait(lambda: not memory.turns[0].estimated)
+    assert client.calls == 1
+    assert memory.recent_tokens() == len(memory.turns[0].as_text().split())
+
+
+def test_exact_count_reenforces_the_budget():
+    client = SlowTokenizer()
+    # Con la estimacion (~4 caracteres/token) caben; con la cuenta exacta (palabras) no
+    memory = ConversationMemory(client, token_budget=22)
+    memory.add_turn("a b c d e f g", "h i j")
+    memory.add_turn("k l m n o p q", "r s t")
+    assert len(memory.turns) == 2
+
+    client.release.set()
+    assert _wait(lambda: len(memory.turns) == 1 and memory.summary == "resumen")
@@ -0,0 +1,36 @@
+import builtins
+import json
+import os
+import threading
+
+from metrics import TurnMetrics
+
+
+def test_finish_turn_does_not_write_on_the_calling_thread(tmp_path, monkeypatch):
+    path = os.path.join(tmp_path, "metrics.jsonl")
+    metrics = TurnMetrics(jsonl_path=path)
+    writer_ident = metrics._writer._thread.ident
+
+    real_open = builtins.open
+    callers = []
+
+    def spy_open(file, *args, **kwargs):
+        if file == path:
+            callers.append(threading.get_ident())
+        return real_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", spy_open)
+
+    turn_id = metrics.start_turn()
+    metrics.record(turn_id, "llm", 0.25)
+    metrics.finish_turn(turn_id, chars=42)
+    metrics.record_event("startup", {"ready_ms": 12.5})
+    assert metrics.flush(5.0)
+    metrics.close()
+
+    assert callers and set(callers) == {writer_ident}
+    with real_open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert records[0]["turn_id"] == turn_id and records[0]["chars"] == 42
+    assert records[0]["spans_ms"]["llm"] == 250.0
+    assert records[1]["event"] == "startup"
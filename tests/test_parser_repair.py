@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from benchmarks.stub_server import MALFORMED, SAMPLE_TURN
+from parser import ResponseParser
+
+FULL = json.dumps(SAMPLE_TURN, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("cut, n_eventos, format_ok", [(260, 1, False), (330, 2, False), (len(FULL) - 5, 3, True)])
+def test_truncated_response_is_repaired(cut, n_eventos, format_ok):
+    # Solo cumple el formato si las opciones llegaron a completarse; si no, queda marcada como reparada
+    outcome = ResponseParser().parse(FULL[:cut])
+    assert outcome.parse_ok and outcome.repaired
+    assert outcome.format_ok is format_ok
+    assert len(outcome.data["eventos"]) == n_eventos
+    if not format_ok:
+        assert outcome.data["opciones"] == [] and "sin opciones" in outcome.error
+
+
+def test_repair_is_skipped_without_a_closed_evento(monkeypatch):
+    parser = ResponseParser()
+    calls = []
+    monkeypatch.setattr(parser, "repair_truncated", lambda raw: calls.append(raw))
+    for raw in MALFORMED:
+        assert not parser.parse(raw).repaired
+    # Ni el texto plano, ni el corte sin eventos cerrados, ni el JSON valido con formato malo
+    assert calls == []
@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from benchmarks.stub_server import StubLlamaServer
+
+
+@pytest.fixture
+def prefetcher(monkeypatch):
+    server = StubLlamaServer().start()
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", server.completion_url)
+    monkeypatch.setenv("LLAMA_CACHE", "off")
+    from llm_service import LLMService
+    from prefetch import SpeculativePrefetcher
+
+    service = LLMService(candidates=1, guard=False, memory_tokens=0)
+    p = SpeculativePrefetcher(service)
+    yield p
+    p.close()
+    service.client.close()
+    server.stop()
+
+
+def test_close_releases_a_claimed_spec_still_queued(prefetcher, monkeypatch):
+    # El hilo de fondo queda ocupado con la primera especulacion hasta despues del cierre
+    busy = threading.Event()
+    release = threading.Event()
+
+    def blocked(spec):
+        busy.set()
+        release.wait(5.0)
+
+    monkeypatch.setattr(prefetcher, "_generate", blocked)
+    prefetcher.schedule(["Pedir una bebida", "Preguntar por Sable"])
+    assert busy.wait(2.0)
+    spec = prefetcher.claim("preguntar por sable")
+    assert spec is not None
+
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(spec.wait()))
+    waiter.start()
+    prefetcher.close()
+    waiter.join(1.0)
+    release.set()
+    assert not waiter.is_alive() and result == [None]
+
+
+def test_schedule_after_close_is_ignored(prefetcher):
+    prefetcher.close()
+    prefetcher.schedule(["Pedir una bebida"])
+    assert prefetcher.claim("pedir una bebida") is None
+    assert prefetcher.stats()["scheduled"] == 0
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import struct
+import threading
+
+import pytest
+
+from benchmarks.stub_server import StubLlamaServer
+
+
+@pytest.fixture
+def tavern(monkeypatch, tmp_path):
+    stub = StubLlamaServer().start()
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", stub.completion_url)
+    monkeypatch.setenv("LLAMA_CACHE", "off")
+    monkeypatch.delenv("LLAMA_CANDIDATES", raising=False)
+    from server import TavernServer
+
+    server = TavernServer(log_path=str(tmp_path / "sessions.jsonl"), slots=1, max_body=1024)
+    yield server
+    server.logger.close()
+    server.client.close()
+    stub.stop()
+
+
+async def _exchange(server, data: bytes) -> bytes:
+    srv = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+    port = srv.sockets[0].getsockname()[1]
+    async with srv:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 5.0)
+        writer.close()
+    return response
+
+
+def test_oversized_body_is_rejected(tavern):
+    head = b"POST /sessions/a/turn HTTP/1.1\r\nContent-Length: 1000000000\r\n\r\n"
+    response = asyncio.run(_exchange(tavern, head))
+    assert response.startswith(b"HTTP/1.1 413 ")
+    assert not tavern.sessions
+
+
+def test_oversized_ws_frame_is_closed(tavern):
+    handshake = (
+        b"GET /ws/a HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n"
+    )
+    # Cabecera de un frame de texto con longitud de 64 bits (sin cuerpo)
+    frame = bytes([0x81, 0x80 | 127]) + struct.pack("!Q", 2**40) + b"\0\0\0\0"
+    response = asyncio.run(_exchange(tavern, handshake + frame))
+    head, _, rest = response.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 101 ")
+    assert rest == bytes([0x88, 2]) + struct.pack("!H", 1009)
+
+
+def test_idle_sessions_are_evicted(tavern):
+    tavern.session_ttl = 60.0
+
+    async def scenario():
+        await tavern.run_turn("vieja", "Entro en la taberna")
+        tavern.sessions["vieja"].last_seen -= 120
+        tavern._last_sweep -= 120
+        result = await tavern.run_turn("nueva", "Pido una cerveza")
+        return result
+
+    assert asyncio.run(scenario())["format_ok"]
+    assert list(tavern.sessions) == ["nueva"]
+    assert tavern.metrics_snapshot()["sessions_evicted"] == 1
+
+
+def test_memory_work_waits_for_a_scheduler_slot(tavern):
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        await tavern.scheduler.acquire("turno")
+        entered = threading.Event()
+
+        def background():
+            with tavern._scheduled(loop, "memoria"):
+                entered.set()
+
+        worker = threading.Thread(target=background)
+        worker.start()
+        await asyncio.sleep(0.1)
+        blocked = not entered.is_set() and tavern.scheduler.queued == 1
+        tavern.scheduler.release()
+        await loop.run_in_executor(None, worker.join, 5.0)
+        await asyncio.sleep(0)
+        return blocked, entered.is_set(), tavern.scheduler.in_flight
+
+    assert asyncio.run(scenario()) == (True, True, 0)
+
+
+def test_candidates_are_rejected(monkeypatch, tmp_path):
+    from server import TavernServer
+
+    monkeypatch.setenv("LLAMA_CANDIDATES", "3")
+    with pytest.raises(ValueError):
+        TavernServer(log_path=str(tmp_path / "sessions.jsonl"))
+
+
+def test_turn_roundtrip(tavern):
+    body = json.dumps({"input": "Entro en la taberna"}).encode("utf-8")
+    request = b"POST /sessions/a/turn HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+    response = asyncio.run(_exchange(tavern, request))
+    head, _, payload = response.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200 ")
+    assert json.loads(payload)["format_ok"]
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from benchmarks.stub_server import SAMPLE_TURN, StubLlamaServer, split_tokens
+from stream_guard import GenerationGuard
+
+
+@pytest.fixture
+def service(monkeypatch):
+    server = StubLlamaServer().start()
+    monkeypatch.setenv("LLAMA_COMPLETION_URL", server.completion_url)
+    monkeypatch.setenv("LLAMA_CACHE", "off")
+    from llm_service import LLMService
+
+    svc = LLMService(guard=True)
+    yield svc
+    svc.client.close()
+    server.stop()
+
+
+def _feed(guard: GenerationGuard, raw: str) -> str:
+    for piece in split_tokens(raw):
+        if guard.feed(piece):
+            break
+    return guard.reason
+
+
+def test_multi_turn_session_does_not_trip_echo(service):
+    # El stub responde siempre lo mismo: desde el segundo turno la respuesta esta en la memoria
+    for user_input in ("Entro en la taberna", "Pido una cerveza", "Pregunto por Sable"):
+        raw = "".join(service.chat_stream(user_input))
+        assert json.loads(raw) == SAMPLE_TURN
+    assert "Turnos recientes" in service.build_prompt("x")
+    assert service.guard_stats()["tripped"] == 0
+
+
+def test_echo_of_instructions_still_trips(service):
+    # Copiar las instrucciones del system prompt sigue contando como eco
+    instructions = " ".join(service.client.system_prompt.replace('"', " ").split())
+    raw = json.dumps({"eventos": [{"tipo": "narracion", "texto": instructions}], "opciones": ["a", "b"]})
+    assert _feed(GenerationGuard(service._echo_reference(), service.parser), raw) == "eco"
+
+
+def test_repetition_trips(service):
+    texto = "Aida te mira. " + "Pides una bebida caliente y preguntas por el hombre del fondo. " * 6
+    raw = json.dumps({"eventos": [{"tipo": "narracion", "texto": texto}], "opciones": ["a", "b"]})
+    assert _feed(GenerationGuard(service._echo_reference(), service.parser), raw) == "repeticion"
+
+
+def test_guard_is_opt_in(monkeypatch, service):
+    from llm_service import LLMService
+
+    monkeypatch.delenv("LLAMA_GUARD", raising=False)
+    assert LLMService(client=service.client).guard is False
+    monkeypatch.setenv("LLAMA_GUARD", "on")
+    assert LLMService(client=service.client).guard is True
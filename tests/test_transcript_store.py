@@ -0,0 +1,37 @@
+import sqlite3
+
+from transcript_store import SQLiteTranscriptStore
+
+
+def _record(session: str, raw):
+    return {
+        "ts": "2026-01-01 10:00:00",
+        "user_input": "hola",
+        "parse_ok": False,
+        "format_ok": False,
+        "error": "",
+        "raw_response": raw,
+        "session": session,
+    }
+
+
+def test_session_is_reinserted_after_a_rolled_back_batch(tmp_path):
+    db = str(tmp_path / "turnos.db")
+    store = SQLiteTranscriptStore(db)
+    # Sin el hilo de fondo: los lotes se escriben aqui para controlar como se agrupan
+    store.close()
+    try:
+        # raw_response NULL viola NOT NULL: el lote entero se deshace, sesion incluida
+        store._write([_record("s1", "ok"), _record("s1", None)])
+        assert store.stats()["write_errors"] == 1
+        store._write([_record("s1", "otra vez")])
+        assert store.stats()["written"] == 1
+    finally:
+        store._close_file()
+
+    conn = sqlite3.connect(db)
+    try:
+        assert conn.execute("SELECT id FROM sessions").fetchall() == [("s1",)]
+        assert conn.execute("SELECT COUNT(*) FROM turns WHERE session_id = 's1'").fetchone() == (1,)
+    finally:
+        conn.close()
@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from logger import TS_FORMAT, GameLogger, iter_log_turns
+from parser import ResponseParser
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    started_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL REFERENCES sessions(id),
+    ts TEXT NOT NULL,
+    user_input TEXT NOT NULL,
+    raw_response TEXT NOT NULL,
+    parse_ok INTEGER NOT NULL,
+    format_ok INTEGER NOT NULL,
+    error TEXT NOT NULL DEFAULT '',
+    stats TEXT,
+    timings TEXT,
+    completion TEXT
+);
+CREATE TABLE IF NOT EXISTS eventos (
+    turn_id INTEGER NOT NULL REFERENCES turns(id),
+    idx INTEGER NOT NULL,
+    tipo TEXT NOT NULL,
+    nombre TEXT,
+    texto TEXT NOT NULL,
+    PRIMARY KEY (turn_id, idx)
+);
+CREATE INDEX IF NOT EXISTS idx_turns_ts ON turns(ts);
+CREATE INDEX IF NOT EXISTS idx_turns_session ON turns(session_id, ts);
+CREATE INDEX IF NOT EXISTS idx_turns_status ON turns(format_ok, parse_ok, ts);
+CREATE INDEX IF NOT EXISTS idx_eventos_nombre ON eventos(nombre, turn_id);
+"""
+
+
+# Columnas añadidas despues de crear el esquema: se migran las bases antiguas al conectar
+MIGRATIONS = (("turns", "completion", "TEXT"),)
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    for table, column, decl in MIGRATIONS:
+        if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return conn
+
+
+class SQLiteTranscriptStore(GameLogger):
+    # Backend alternativo de GameLogger: sesiones, turnos y eventos en SQLite (WAL) con indices.
+    # Reutiliza la cola y el hilo de fondo de GameLogger; cada lote va en una sola transaccion.
+
+    def __init__(
+        self,
+        db_path: str,
+        *,
+        session: Optional[str] = None,
+        max_queue: int = 1000,
+        batch_size: int = 64,
+        flush_interval: float = 0.5,
+    ):
+        # Antes de super().__init__: el hilo de escritura arranca ahi
+        self.db_path = db_path
+        self.session = session or datetime.now().strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+        self.parser = ResponseParser()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._known_sessions: set = set()
+        super().__init__(db_path, max_queue=max_queue, batch_size=batch_size, flush_interval=flush_interval)
+
+    def import_turns(self, turns: Iterable[Dict[str, Any]], session: str) -> int:
+        # Importacion: se respeta la fecha original y no se descarta nada (put bloqueante)
+        n = 0
+        for turn in turns:
+            record = {
+                "ts": turn.get("ts") or datetime.now().strftime(TS_FORMAT),
+                "user_input": turn.get("user_input", ""),
+                "parse_ok": bool(turn.get("parse_ok")),
+                "format_ok": bool(turn.get("format_ok")),
+                "error": turn.get("error", ""),
+                "raw_response": turn.get("raw_response", ""),
+                "session": turn.get("session") or session,
+            }
+            if turn.get("stats"):
+                record["stats"] = turn["stats"]
+            if turn.get("timings"):
+                record["timings"] = turn["timings"]
+            if turn.get("completion"):
+                record["completion"] = turn["completion"]
+            self._q.put(record)
+            n += 1
+        return n
+
+    def _write(self, records: List[Dict[str, Any]]):
+        try:
+            if self._conn is None:
+                self._conn = connect(self.db_path)
+            # Las sesiones nuevas del lote solo se dan por conocidas si la transaccion se confirma:
+            # tras un rollback hay que volver a insertarlas
+            new_sessions: set = set()
+            with self._conn:
+                for r in records:
+                    self._insert(self._conn, r, new_sessions)
+            self._known_sessions |= new_sessions
+            with self._lock:
+                self.written += len(records)
+        except (sqlite3.Error, ValueError) as e:
+            with self._lock:
+                self.write_errors += 1
+                self.last_error = str(e)
+
+    def _insert(self, conn: sqlite3.Connection, r: Dict[str, Any], new_sessions: set):
+        session = r.get("session") or self.session
+        if session not in self._known_sessions and session not in new_sessions:
+            conn.execute("INSERT OR IGNORE INTO sessions (id, started_at) VALUES (?, ?)", (session, r["ts"]))
+            new_sessions.add(session)
+
+        cur = conn.execute(
+            "INSERT INTO turns"
+            " (session_id, ts, user_input, raw_response, parse_ok, format_ok, error, stats, timings, completion)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                session,
+                r["ts"],
+                r["user_input"],
+                r["raw_response"],
+                int(r["parse_ok"]),
+                int(r["format_ok"]),
+                r.get("error", ""),
+                json.dumps(r["stats"], ensure_ascii=False) if r.get("stats") else None,
+                json.dumps(r["timings"], ensure_ascii=False) if r.get("timings") else None,
+                json.dumps(r["completion"], ensure_ascii=False) if r.get("completion") else None,
+            ),
+        )
+
+        # Los eventos se extraen aqui (hilo de fondo), no en la UI
+        outcome = self.parser.parse(r["raw_response"]) if r["parse_ok"] else None
+        if outcome is None or not outcome.data or not isinstance(outcome.data.get("eventos"), list):
+            return
+        rows = []
+        for i, ev in enumerate(outcome.data["eventos"]):
+            if isinstance(ev, dict) and isinstance(ev.get("texto"), str):
+                nombre = ev.get("nombre") if isinstance(ev.get("nombre"), str) else None
+                rows.append((cur.lastrowid, i, str(ev.get("tipo", "")), nombre, ev["texto"]))
+        conn.executemany("INSERT INTO eventos (turn_id, idx, tipo, nombre, texto) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _maybe_rotate(self):
+        pass
+
+    def _maybe_fsync(self, force: bool):
+        pass
+
+    def _close_file(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def query_turns(
+    db_path: str,
+    *,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    session: Optional[str] = None,
+    parse_ok: Optional[bool] = None,
+    format_ok: Optional[bool] = None,
+    limit: int = 100,
+) -> List[Dict[str, Any]]:
+    where, params = [], []
+    for column, value in (("parse_ok", parse_ok), ("format_ok", format_ok)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(int(value))
+    if since:
+        where.append("ts >= ?")
+        params.append(since)
+    if until:
+        where.append("ts < ?")
+        params.append(until)
+    if session:
+        where.append("session_id = ?")
+        params.append(session)
+
+    sql = "SELECT id, session_id, ts, user_input, parse_ok, format_ok, error FROM turns"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ts DESC LIMIT ?"
+    params.append(limit)
+
+    conn = connect(db_path)
+    try:
+        conn.row_factory = sqlite3.Row
+        return [dict(row) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def dialogue_lines(db_path: str, nombre: str, limit: int = 100) -> List[Dict[str, Any]]:
+    conn = connect(db_path)
+    try:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            "SELECT t.ts, t.session_id, e.texto FROM eventos e JOIN turns t ON t.id = e.turn_id"
+            " WHERE e.nombre = ? ORDER BY t.ts DESC LIMIT ?",
+            (nombre, limit),
+        )
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def _bool_arg(value: str) -> bool:
+    return value.strip().lower() in ("1", "true", "si", "yes")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Almacen SQLite de transcripciones")
+    ap.add_argument("--db", default=os.path.join("outputs", "transcripts.db"))
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    imp = sub.add_parser("import", help="importar logs existentes (texto antiguo o JSONL)")
+    imp.add_argument("logs", nargs="+")
+    imp.add_argument("--session", help="sesion a asignar (por defecto import:<fichero>)")
+
+    q = sub.add_parser("turns", help="consultar turnos")
+    q.add_argument("--since")
+    q.add_argument("--until")
+    q.add_argument("--session")
+    q.add_argument("--parse-ok", type=_bool_arg)
+    q.add_argument("--format-ok", type=_bool_arg)
+    q.add_argument("--limit", type=int, default=100)
+
+    d = sub.add_parser("dialogo", help="lineas de dialogo de un personaje")
+    d.add_argument("nombre")
+    d.add_argument("--limit", type=int, default=100)
+
+    args = ap.parse_args(argv)
+    os.makedirs(os.path.dirname(args.db) or ".", exist_ok=True)
+
+    if args.cmd == "import":
+        store = SQLiteTranscriptStore(args.db)
+        total = 0
+        for path in args.logs:
+            total += store.import_turns(iter_log_turns(path), args.session or f"import:{os.path.basename(path)}")
+        store.close(timeout=600)
+        print(json.dumps({"imported": total, **store.stats()}, ensure_ascii=False))
+        return 0 if not store.write_errors else 1
+
+    if args.cmd == "turns":
+        rows = query_turns(
+            args.db,
+            since=args.since,
+            until=args.until,
+            session=args.session,
+            parse_ok=args.parse_ok,
+            format_ok=args.format_ok,
+            limit=args.limit,
+        )
+    else:
+        rows = dialogue_lines(args.db, args.nombre, args.limit)
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import functools
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class StringField:
+    name: str
+    max_chars: int
+    # min_chars se comprueba sobre el texto sin espacios (nombre vacio = invalido)
+    min_chars: int = 0
+
+
+@dataclass(frozen=True)
+class EventType:
+    tipo: str
+    fields: Tuple[StringField, ...]
+
+
+@dataclass(frozen=True)
+class TurnSchema:
+    # Fuente unica del formato de turno: de aqui salen la gramatica GBNF, las reglas del
+    # system prompt y la validacion del parser. Cambiar cualquier limite => subir version
+    version: int
+    event_types: Tuple[EventType, ...]
+    min_events: int = 1
+    max_events: int = 10
+    min_opciones: int = 2
+    max_opciones: int = 4
+    opcion_max_chars: int = 120
+    # Espacios entre tokens JSON: acotados para que el modelo no se enrolle con el formato
+    max_ws: int = 16
+
+    def event_type(self, tipo: str) -> Optional[EventType]:
+        for et in self.event_types:
+            if et.tipo == tipo:
+                return et
+        return None
+
+
+DEFAULT_SCHEMA = TurnSchema(
+    version=1,
+    event_types=(
+        EventType("narracion", (StringField("texto", 800),)),
+        EventType("dialogo", (StringField("nombre", 40, min_chars=1), StringField("texto", 500))),
+    ),
+)
+
+
+def _literal(s: str) -> str:
+    # Literal GBNF que produce el string JSON "s"
+    return '"\\"' + s + '\\""'
+
+
+def _repeat(item: str, lo: int, hi: int) -> str:
+    # item (sep item){lo-1,hi-1}, opcional entero si lo == 0
+    sep = f'(wsp "," wsp {item})'
+    rest = f"{sep}{{{max(0, lo - 1)},{hi - 1}}}" if hi > 1 else ""
+    body = f"{item} {rest}".strip()
+    return body if lo > 0 else f"({body})?"
+
+
+def _string_rule(field: StringField) -> str:
+    return f'"\\"" char{{{field.min_chars},{field.max_chars}}} "\\""'
+
+
+@functools.lru_cache(maxsize=8)
+def compile_grammar(schema: TurnSchema) -> str:
+    # GBNF de llama.cpp generada a partir del esquema (cacheada por esquema/version)
+    rules: List[Tuple[str, str]] = [
+        ("root", "object"),
+        (
+            "object",
+            f'"{{" wsp {_literal("eventos")} wsp ":" wsp eventos wsp "," wsp '
+            f'{_literal("opciones")} wsp ":" wsp opciones wsp "}}"',
+        ),
+        ("eventos", f'"[" wsp {_repeat("evento", schema.min_events, schema.max_events)} wsp "]"'),
+        ("evento", " | ".join(f"ev-{et.tipo}" for et in schema.event_types)),
+    ]
+    for et in schema.event_types:
+        parts = [f'"{{" wsp {_literal("tipo")} wsp ":" wsp {_literal(et.tipo)}']
+        for field in et.fields:
+            parts.append(f'wsp "," wsp {_literal(field.name)} wsp ":" wsp str-{et.tipo}-{field.name}')
+            rules.append((f"str-{et.tipo}-{field.name}", _string_rule(field)))
+        parts.append('wsp "}"')
+        rules.append((f"ev-{et.tipo}", " ".join(parts)))
+
+    rules += [
+        ("opciones", f'"[" wsp {_repeat("opcion", schema.min_opciones, schema.max_opciones)} wsp "]"'),
+        ("opcion", _string_rule(StringField("opcion", schema.opcion_max_chars, min_chars=1))),
+        ("char", "escape | safe-char"),
+        ("escape", '"\\\\" ["\\\\/bfnrt]'),
+        # Sin comillas, barras ni caracteres de control (json.loads los rechaza sin escapar)
+        ("safe-char", '[^"\\\\\\x00-\\x1f]'),
+        ("wsp", f"[ \\t\\n]{{0,{schema.max_ws}}}"),
+    ]
+    return "\n".join(f"{name} ::= {body}" for name, body in rules) + "\n"
+
+
+@functools.lru_cache(maxsize=8)
+def describe_schema(schema: TurnSchema) -> str:
+    # Lineas del system prompt que describen la estructura y sus limites
+    shapes = []
+    for et in schema.event_types:
+        fields = ", ".join(f'"{f.name}": string' for f in et.fields)
+        shapes.append(f'{{ "tipo": "{et.tipo}", {fields} }}')
+    opciones = ", ".join(["string"] * schema.min_opciones)
+    limits = "; ".join(
+        f"{f.name} de {et.tipo} hasta {f.max_chars} caracteres" for et in schema.event_types for f in et.fields
+    )
+    return (
+        "Estructura\n"
+        f'{{ "eventos": [ {", ".join(shapes)} ], "opciones": [ {opciones} ] }}\n'
+        "Eventos en orden cronologico alterna lo necesario\n"
+        f"Entre {schema.min_events} y {schema.max_events} eventos; {limits}\n"
+        f"Tipos {' o '.join(et.tipo for et in schema.event_types)}\n"
+        f"Campos {'; '.join(et.tipo + ' ' + ' y '.join(f.name for f in et.fields) for et in schema.event_types)}\n"
+        f"Opciones {schema.min_opciones} a {schema.max_opciones} strings coherentes "
+        f"de hasta {schema.opcion_max_chars} caracteres\n"
+    )